@@ -1,142 +1,152 @@
 import os
 import json
 import base64
-import sqlite3
-from datetime import datetime
-from flask import Flask, render_template, request, jsonify, send_from_directory
+from functools import wraps
+from flask import Flask, Response, abort, render_template, request, jsonify, make_response, send_from_directory
 from flask_cors import CORS
+from werkzeug.exceptions import RequestEntityTooLarge
+
+from database.jobs import JobQueue
+from database.ingest import InvalidImage
+from database.leaderboard import BOARDS, Leaderboard
+from database.likes import LIKE_REWARD
+from database.notifications import LIKE, UPLOAD, NotificationQueue
+from database.packs import CHUNK_SIZE, PackStore, absorb_upload
+from database.pagination import MAX_PAGE_SIZE, decode_cursor, page_size
+from database.phash import SIMILAR_DISTANCE
+from database.renditions import ensure_rendition, parse_rendition, rendition_urls, telegram_photo_urls
+from database.response_cache import ResponseCache
+from database.search import SEARCH_LIMIT
+from database.shop_catalog import ShopCatalog
+from database.sprites import SpriteSheets
+from database.strokes import STROKES_MIMETYPE, raster_path, save_strokes
+from database.storage import (ALREADY_OWNED, DRAWING_FAILED, DRAWING_PENDING, DRAWING_READY, NOT_ENOUGH_COINS,
+                              get_storage)
+from database.uploads import (UploadError, UploadTooLarge, is_content_addressed, process_upload, save_bytes,
+                              save_stream)
+from database.views import ViewCounter
+from database.write_behind import LikeBatcher
 
 app = Flask(__name__, static_folder='static', template_folder='templates')
 CORS(app)
 
 # Настройки
 app.config['UPLOAD_FOLDER'] = 'static/drawings'
-app.config['DATABASE'] = 'drawfy.db'
+# Превью рисунков (создаются при первом запросе, см. database/renditions.py)
+app.config['RENDITIONS_FOLDER'] = 'static/renditions'
+# Листы превью для страниц ленты (database/sprites.py)
+app.config['SPRITES_FOLDER'] = 'static/sprites'
+# Файл SQLite или postgresql://... (несколько веб-серверов на одной базе)
+app.config['DATABASE'] = os.environ.get('DATABASE_URL', 'drawfy.db')
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'dev-secret-key-123')
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB
+# Отложенная запись лайков: очередь в памяти и одна транзакция раз в интервал
+app.config['LIKES_WRITE_BEHIND'] = os.environ.get('LIKES_WRITE_BEHIND', '0') == '1'
+app.config['LIKES_FLUSH_INTERVAL'] = float(os.environ.get('LIKES_FLUSH_INTERVAL', '1.0'))
+# Просмотры копятся в памяти и пишутся пачкой; повтор от того же зрителя в окне не считается
+app.config['VIEWS_FLUSH_INTERVAL'] = float(os.environ.get('VIEWS_FLUSH_INTERVAL', '10'))
+app.config['VIEWS_DEDUP_WINDOW'] = int(os.environ.get('VIEWS_DEDUP_WINDOW', '1800'))
+# Рисунки в больших файлах-сегментах вместо отдельных файлов (database/packs.py); пусто - выключено
+app.config['PACKS_FOLDER'] = os.environ.get('DRAWING_PACKS') or None
+# Проверка и превью новых рисунков в фоне (процесс jobs в Procfile), очередь - в своем файле SQLite
+app.config['IMAGE_JOBS'] = os.environ.get('IMAGE_JOBS', '1') == '1'
+app.config['JOBS_DATABASE'] = os.environ.get('JOBS_DATABASE', 'jobs.db')
+# Уведомления авторам в Telegram (сводки лайков и загрузок); отправляет процесс бота
+app.config['NOTIFICATIONS'] = os.environ.get('NOTIFICATIONS', '1') == '1'
+app.config['NOTIFY_DATABASE'] = os.environ.get('NOTIFY_DATABASE', 'notifications.db')
+# Как часто рейтинг перечитывается из базы (изменения других воркеров)
+app.config['LEADERBOARD_REFRESH'] = float(os.environ.get('LEADERBOARD_REFRESH', '60'))
+# Как часто воркер сверяет версию каталога магазина (секунды)
+app.config['SHOP_CATALOG_CHECK'] = float(os.environ.get('SHOP_CATALOG_CHECK', '30'))
+# Сколько готовых ответов API держать в памяти воркера
+app.config['RESPONSE_CACHE_SIZE'] = int(os.environ.get('RESPONSE_CACHE_SIZE', '512'))
 
 # Создаем папки если их нет
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 os.makedirs('static/avatars', exist_ok=True)
 
+# Хранилище данных (SQLite или PostgreSQL, database/storage.py)
+storage = get_storage(app.config['DATABASE'])
+
+# Сегменты рисунков (None - рисунки лежат отдельными файлами)
+pack_store = PackStore(app.config['PACKS_FOLDER']) if app.config['PACKS_FOLDER'] else None
+
+# Листы превью: одна картинка на страницу ленты вместо запроса на каждую плитку
+sprite_sheets = SpriteSheets(app.config['UPLOAD_FOLDER'], app.config['RENDITIONS_FOLDER'],
+                             app.config['SPRITES_FOLDER'], pack_store)
+
+# Очередь фоновых задач (None - обработка не ставится, превью строятся при первом запросе)
+job_queue = JobQueue(app.config['JOBS_DATABASE']) if app.config['IMAGE_JOBS'] else None
+
+# Журнал штрихов принимается целиком в память, он на порядки меньше PNG
+MAX_STROKES_LENGTH = 2 * 1024 * 1024
+
+# События для уведомлений (None - уведомления выключены)
+notification_queue = NotificationQueue(app.config['NOTIFY_DATABASE']) if app.config['NOTIFICATIONS'] else None
+
+# Награда за загрузку рисунка
+UPLOAD_REWARD = {'experience': 10, 'coins': 10}
+
+# Сколько похожих рисунков отдавать по умолчанию
+SIMILAR_LIMIT = 12
+
+# Срок кэширования файлов, названных по содержимому (год)
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
+# Рейтинг художников (в памяти воркера, обновляется при загрузках и лайках)
+leaderboard = Leaderboard(storage, refresh_interval=app.config['LEADERBOARD_REFRESH'])
+
+def on_likes_recorded(added):
+    """Лайки записаны в базу - обновляем рейтинг и копим уведомления авторам"""
+    leaderboard.add_likes(added, LIKE_REWARD['experience'])
+    if notification_queue is not None:
+        notify_likes(added)
+
+def notify_likes(added):
+    """События лайков для сводок авторам (свои лайки не в счет); ошибка не мешает лайку"""
+    try:
+        per_drawing = {}
+        for user_id, drawing_id, author_id in added:
+            if author_id is not None and author_id != user_id:
+                per_drawing.setdefault((author_id, drawing_id), 0)
+                per_drawing[(author_id, drawing_id)] += 1
+        if not per_drawing:
+            return
+        authors = storage.user_names({author_id for author_id, _ in per_drawing})
+        notification_queue.add_events([
+            (authors[author_id]['telegram_id'], LIKE, drawing_id, None, count, None)
+            for (author_id, drawing_id), count in per_drawing.items() if author_id in authors
+        ])
+    except Exception as e:
+        print(f"❌ Ошибка уведомления о лайках: {e}")
+
+def notify_upload(telegram_id, drawing_id, title, filename):
+    """Событие публикации для сводки автору (с файлом - бот пришлет рисунок фотографией)"""
+    try:
+        notification_queue.add_events([(telegram_id, UPLOAD, drawing_id, title, 1, filename)])
+    except Exception as e:
+        print(f"❌ Ошибка уведомления о загрузке: {e}")
+
+# Очередь лайков (None - лайки пишутся сразу в обработчике)
+like_batcher = (LikeBatcher(storage, interval=app.config['LIKES_FLUSH_INTERVAL'],
+                            on_flush=on_likes_recorded)
+                if app.config['LIKES_WRITE_BEHIND'] else None)
+
+# Кэш ответов API, инвалидируется поколениями из таблицы cache_generations
+response_cache = ResponseCache(max_entries=app.config['RESPONSE_CACHE_SIZE'])
+
+# Каталог магазина в памяти воркера
+shop_catalog = ShopCatalog(storage, check_interval=app.config['SHOP_CATALOG_CHECK'])
+
+# Счетчик просмотров
+view_counter = ViewCounter(storage, interval=app.config['VIEWS_FLUSH_INTERVAL'],
+                           dedup_window=app.config['VIEWS_DEDUP_WINDOW'])
+
 # ==================== ИНИЦИАЛИЗАЦИЯ БАЗЫ ДАННЫХ ====================
 
 def init_database():
     """Создаем базу данных и таблицы если их нет"""
-    conn = sqlite3.connect(app.config['DATABASE'])
-    cursor = conn.cursor()
-    
-    # Таблица пользователей (из Telegram)
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            telegram_id INTEGER UNIQUE NOT NULL,
-            username TEXT,
-            first_name TEXT,
-            last_name TEXT,
-            balance INTEGER DEFAULT 100,
-            experience INTEGER DEFAULT 0,
-            level INTEGER DEFAULT 1,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    
-    # Таблица рисунков
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS drawings (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            title TEXT NOT NULL,
-            description TEXT,
-            filename TEXT NOT NULL,
-            likes INTEGER DEFAULT 0,
-            views INTEGER DEFAULT 0,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users (id)
-        )
-    ''')
-    
-    # Таблица лайков
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS likes (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            drawing_id INTEGER NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            UNIQUE(user_id, drawing_id),
-            FOREIGN KEY (user_id) REFERENCES users (id),
-            FOREIGN KEY (drawing_id) REFERENCES drawings (id)
-        )
-    ''')
-    
-    # Таблица комментариев
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS comments (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            drawing_id INTEGER NOT NULL,
-            text TEXT NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users (id),
-            FOREIGN KEY (drawing_id) REFERENCES drawings (id)
-        )
-    ''')
-    
-    # Таблица товаров магазина
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS shop_items (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT NOT NULL,
-            description TEXT,
-            price INTEGER NOT NULL,
-            type TEXT,
-            image_url TEXT
-        )
-    ''')
-    
-    # Таблица покупок
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS purchases (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            item_id INTEGER NOT NULL,
-            purchased_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users (id),
-            FOREIGN KEY (item_id) REFERENCES shop_items (id)
-        )
-    ''')
-    
-    # Добавляем тестовые товары если таблица пуста
-    cursor.execute('SELECT COUNT(*) FROM shop_items')
-    if cursor.fetchone()[0] == 0:
-        test_items = [
-            ('Кисть "Акварель"', 'Реалистичная акварельная кисть', 100, 'brush', '🖌️'),
-            ('Кисть "Масло"', 'Текстурная масляная кисть', 150, 'brush', '🎨'),
-            ('Золотая рамка', 'Элегантная рамка для работ', 200, 'frame', '🖼️'),
-            ('Фон "Космос"', 'Космический фон для рисунков', 300, 'background', '🌌'),
-            ('Аниме-стиль', 'Фильтр для аниме-стилизации', 250, 'filter', '🌸'),
-            ('Профессиональный набор', '10 премиум кистей + 5 фонов', 1000, 'bundle', '🎁')
-        ]
-        cursor.executemany(
-            'INSERT INTO shop_items (name, description, price, type, image_url) VALUES (?, ?, ?, ?, ?)',
-            test_items
-        )
-    
-    # Добавляем тестовых пользователей если нужно
-    cursor.execute('SELECT COUNT(*) FROM users')
-    if cursor.fetchone()[0] == 0:
-        test_users = [
-            (123456789, 'art_lover', 'Анна', 'Художникова'),
-            (987654321, 'creative_soul', 'Максим', 'Творец'),
-            (555555555, 'digital_artist', 'Ольга', 'Арт')
-        ]
-        cursor.executemany(
-            'INSERT INTO users (telegram_id, username, first_name, last_name, balance) VALUES (?, ?, ?, ?, ?)',
-            [(id, user, first, last, 500) for id, user, first, last in test_users]
-        )
-    
-    conn.commit()
-    conn.close()
+    storage.init_schema()
     print("✅ База данных инициализирована")
 
 # Инициализируем БД при запуске
@@ -144,33 +154,52 @@ init_database()
 
 # ==================== ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ====================
 
-def get_db_connection():
-    """Создает соединение с базой данных"""
-    conn = sqlite3.connect(app.config['DATABASE'])
-    conn.row_factory = sqlite3.Row
-    return conn
+def cached_response(*generations):
+    """Кэшировать успешный ответ, пока не изменятся поколения данных
+    
+    Ответ получает строгий ETag; на совпадающий If-None-Match отдаем 304.
+    Поколения хранятся в базе, поэтому запись в любом воркере сбрасывает кэш во всех.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            # Поколения читаем до данных: тело никогда не старее своих поколений
+            current = storage.read_generations(generations)
+            
+            key = (request.path, tuple(sorted(request.args.items(multi=True))))
+            entry = response_cache.get(key, current)
+            if entry is None:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+                entry = response_cache.put(key, current, response.get_data(), response.mimetype)
+            
+            response = app.response_class(entry.body, mimetype=entry.mimetype)
+            response.set_etag(entry.etag)
+            response.headers['Cache-Control'] = 'no-cache'
+            return response.make_conditional(request)
+        return wrapper
+    return decorator
+
+def page_sprite(drawings):
+    """Лист превью для страницы; координаты плиток кладутся в сами рисунки"""
+    try:
+        sheet = sprite_sheets.sheet_for([drawing['filename'] for drawing in drawings])
+    except (OSError, ValueError) as e:
+        # Без листа галерея обойдется отдельными превью
+        print(f"❌ Лист превью: {e}")
+        return None
+    if sheet is None:
+        return None
+    for drawing in drawings:
+        rect = sheet['tiles'].get(drawing['filename'])
+        if rect:
+            drawing['sprite'] = dict(zip(('x', 'y', 'width', 'height'), rect))
+    return {'url': sheet['url'], 'width': sheet['width'], 'height': sheet['height']}
 
 def get_or_create_user(telegram_id, username=None, first_name=None, last_name=None):
     """Получить или создать пользователя"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    cursor.execute('SELECT * FROM users WHERE telegram_id = ?', (telegram_id,))
-    user = cursor.fetchone()
-    
-    if not user:
-        cursor.execute('''
-            INSERT INTO users (telegram_id, username, first_name, last_name) 
-            VALUES (?, ?, ?, ?)
-        ''', (telegram_id, username, first_name, last_name))
-        conn.commit()
-        user_id = cursor.lastrowid
-        
-        cursor.execute('SELECT * FROM users WHERE id = ?', (user_id,))
-        user = cursor.fetchone()
-    
-    conn.close()
-    return dict(user) if user else None
+    return storage.get_or_create_user(telegram_id, username, first_name, last_name)
 
 # ==================== СТРАНИЦЫ WEB APP ====================
 
@@ -235,32 +264,36 @@ def telegram_auth():
 # ==================== API ДЛЯ РИСУНКОВ ====================
 
 @app.route('/api/drawings', methods=['GET'])
+@cached_response('feed', 'views')
 def get_drawings():
-    """Получить все рисунки"""
+    """Получить рисунки (страницами, от новых к старым)
+    
+    ?limit=N - размер страницы, ?before=<next_cursor> - следующая страница
+    
+    sprite - лист превью всей страницы, у рисунка sprite {'x', 'y', 'width', 'height'} -
+    его плитка на листе (нет - если превью не удалось построить)
+    """
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        # Получаем рисунки с информацией о пользователях
-        cursor.execute('''
-            SELECT 
-                d.*,
-                u.username,
-                u.first_name,
-                u.last_name,
-                (SELECT COUNT(*) FROM likes WHERE drawing_id = d.id) as like_count,
-                (SELECT COUNT(*) FROM comments WHERE drawing_id = d.id) as comment_count
-            FROM drawings d
-            JOIN users u ON d.user_id = u.id
-            ORDER BY d.created_at DESC
-            LIMIT 100
-        ''')
+        limit = page_size(request.args.get('limit'), default=MAX_PAGE_SIZE)
+        before = request.args.get('before')
+        if before:
+            try:
+                # Ключ последней строки предыдущей страницы
+                before = decode_cursor(before)
+            except ValueError as e:
+                return jsonify({'success': False, 'error': str(e)}), 400
+        
+        # Рисунки с информацией о пользователях, по индексу ленты
+        rows, next_cursor = storage.feed_page(limit, before)
         
         drawings = []
-        for row in cursor.fetchall():
-            drawing = dict(row)
-            # Формируем URL к изображению
+        for drawing in rows:
+            # Формируем URL к изображению и его превью
             drawing['image_url'] = f"/static/drawings/{drawing['filename']}"
+            drawing.update(rendition_urls(drawing['filename']))
+            # Просмотры - только записанные в базу: тело кэшируется по поколениям и
+            # одинаково во всех воркерах, а несброшенные просмотры у каждого воркера свои.
+            # Запись пачки просмотров меняет поколение views, и ответ обновится
             # Формируем имя автора
             drawing['author_name'] = f"{drawing['first_name']} {drawing['last_name'] or ''}".strip()
             if drawing['username']:
@@ -268,20 +301,110 @@ def get_drawings():
             
             drawings.append(drawing)
         
-        conn.close()
+        sprite = page_sprite(drawings)
+        return jsonify({'success': True, 'drawings': drawings, 'next_cursor': next_cursor, 'sprite': sprite})
+        
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/drawings/<int:drawing_id>/similar', methods=['GET'])
+@cached_response('feed')
+def get_similar_drawings(drawing_id):
+    """Похожие рисунки (по перцептивному хэшу), ближние первыми
+
+    ?limit=N - сколько вернуть
+    """
+    try:
+        limit = page_size(request.args.get('limit'), default=SIMILAR_LIMIT)
+        phash = storage.drawing_phash(drawing_id)
+        if phash is None:
+            return jsonify({'success': False, 'error': 'Рисунок не найден'}), 404
+        
+        drawings = []
+        for drawing in storage.similar_drawings(phash, SIMILAR_DISTANCE, limit, exclude_id=drawing_id):
+            # Просмотры отдает только лента: этот ответ не сбрасывается их записью
+            drawing.pop('views', None)
+            drawing['image_url'] = f"/static/drawings/{drawing['filename']}"
+            drawing.update(rendition_urls(drawing['filename']))
+            drawing['author_name'] = f"{drawing['first_name']} {drawing['last_name'] or ''}".strip()
+            if drawing['username']:
+                drawing['author_name'] += f" (@{drawing['username']})"
+            drawings.append(drawing)
+        
         return jsonify({'success': True, 'drawings': drawings})
         
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
+@app.route('/api/drawings/search', methods=['GET'])
+@cached_response('feed', 'users')
+def search_drawings():
+    """Поиск рисунков по названию, описанию и автору (инлайн-режим бота)
+
+    ?q=... - слова запроса (ищутся как префиксы), ?limit=N, ?offset=<next_offset> - следующая страница
+    
+    У рисунка есть photo_url и photo_thumbnail_url - JPEG для результатов Telegram
+    """
+    try:
+        limit = page_size(request.args.get('limit'), default=SEARCH_LIMIT)
+        try:
+            offset = max(0, int(request.args.get('offset') or 0))
+        except ValueError:
+            return jsonify({'success': False, 'error': 'Неверное смещение'}), 400
+        
+        rows, next_offset = storage.search_drawings(request.args.get('q', ''), limit, offset)
+        
+        drawings = []
+        for drawing in rows:
+            drawing.pop('views', None)
+            drawing['image_url'] = f"/static/drawings/{drawing['filename']}"
+            drawing.update(rendition_urls(drawing['filename']))
+            drawing.update(telegram_photo_urls(drawing['filename']))
+            drawing['author_name'] = f"{drawing['first_name']} {drawing['last_name'] or ''}".strip()
+            if drawing['username']:
+                drawing['author_name'] += f" (@{drawing['username']})"
+            drawings.append(drawing)
+        
+        return jsonify({'success': True, 'drawings': drawings, 'next_offset': next_offset})
+        
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
 @app.route('/api/drawings/upload', methods=['POST'])
 def upload_drawing():
-    """Загрузить новый рисунок"""
+    """Загрузить новый рисунок
+    
+    Тело запроса:
+      multipart/form-data - поля token, title, description и файл image
+      image/png           - сам файл; token, title, description в строке запроса
+                            (token можно передать заголовком Authorization: Bearer ...)
+      application/json    - {'token', 'title', 'description', 'image': base64} (старые клиенты)
+      application/x-drawfy-strokes - журнал штрихов (database/strokes.py), остальное как у image/png
+    Файл из multipart и image/png пишется на диск потоком, без копии в памяти,
+    и в запросе проверяется только его заголовок: полная проверка, перекодирование
+    и хэш идут фоновой задачей, награда начисляется после них.
+    PNG рисунка из штрихов строится при первом запросе.
+    """
     try:
-        data = request.json
+        strokes = None
+        if request.is_json:
+            data, image = request.json, None
+        elif request.mimetype == STROKES_MIMETYPE:
+            data, image = request.args, None
+            strokes = request.stream.read(MAX_STROKES_LENGTH + 1)
+            if len(strokes) > MAX_STROKES_LENGTH:
+                raise UploadTooLarge('Журнал штрихов слишком большой')
+        elif request.mimetype == 'multipart/form-data':
+            data, image = request.form, request.files.get('image')
+            if image is None:
+                return jsonify({'error': 'Нет изображения'}), 400
+            image = image.stream
+        else:
+            # Сырое тело: метаданные в строке запроса, тело читаем позже кусками
+            data, image = request.args, request.stream
         
         # Проверяем токен (в реальном проекте нужно проверять JWT)
-        user_token = data.get('token')
+        user_token = data.get('token') or request.headers.get('Authorization', '').removeprefix('Bearer ')
         if not user_token or not user_token.startswith('user_'):
             return jsonify({'error': 'Неавторизован'}), 401
         
@@ -292,51 +415,90 @@ def upload_drawing():
         
         title = data.get('title', 'Без названия')
         description = data.get('description', '')
-        image_data = data.get('image')  # base64
-        
-        if not image_data:
-            return jsonify({'error': 'Нет изображения'}), 400
-        
-        # Декодируем base64
-        if ',' in image_data:
-            image_data = image_data.split(',')[1]
         
-        # Сохраняем файл
-        filename = f"drawing_{user['id']}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.png"
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        
-        with open(filepath, 'wb') as f:
-            f.write(base64.b64decode(image_data))
-        
-        # Сохраняем в базу данных
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            INSERT INTO drawings (user_id, title, description, filename) 
-            VALUES (?, ?, ?, ?)
-        ''', (user['id'], title, description, filename))
-        
-        drawing_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
-        
-        # Начисляем опыт за загрузку
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute('UPDATE users SET experience = experience + 10, balance = balance + 10 WHERE id = ?', 
-                      (user['id'],))
-        conn.commit()
-        conn.close()
-        
-        return jsonify({
+        if strokes is not None:
+            filename, original_size, size, phash = save_strokes(strokes, app.config['UPLOAD_FOLDER'])
+        elif image is not None:
+            # Потоком во временный файл, с проверкой размера, затем атомарное переименование
+            filename, original_size, size, phash = save_stream(image, app.config['UPLOAD_FOLDER'],
+                                                               app.config['MAX_CONTENT_LENGTH'])
+        else:
+            image_data = data.get('image')  # base64
+            
+            if not image_data:
+                return jsonify({'error': 'Нет изображения'}), 400
+            
+            # Декодируем base64
+            if ',' in image_data:
+                image_data = image_data.split(',')[1]
+            
+            # Сохраняем файл (одинаковые рисунки - один файл)
+            filename, original_size, size, phash = save_bytes(base64.b64decode(image_data),
+                                                              app.config['UPLOAD_FOLDER'])
+        
+        # Журнал штрихов остается файлом: по нему строится PNG
+        if pack_store is not None and strokes is None:
+            absorb_upload(pack_store, app.config['UPLOAD_FOLDER'], filename)
+        
+        # Журнал уже проверен при разборе, а растр и превью строятся по запросу
+        background = job_queue is not None and strokes is None
+        
+        if strokes is not None:
+            drawing_id = storage.add_drawing(user['id'], title, description, filename, status=DRAWING_READY,
+                                             size=size, original_size=original_size)
+            # Почти такой же рисунок автора уже есть - сохраняем, но без награды
+            duplicate_of = storage.complete_upload(drawing_id, filename, size, phash, reward=UPLOAD_REWARD)
+            reward = None if duplicate_of else UPLOAD_REWARD
+        else:
+            # Рисунок не виден в ленте, пока загрузка не обработана
+            drawing_id = storage.add_drawing(user['id'], title, description, filename, status=DRAWING_PENDING,
+                                             size=size, original_size=original_size)
+            payload = {'drawing_id': drawing_id, 'filename': filename, 'reward': UPLOAD_REWARD,
+                       'telegram_id': telegram_id, 'title': title}
+            reward = duplicate_of = None
+            if background:
+                # Тяжелая обработка - в фоне, ответ не ждет ее
+                job_queue.enqueue('process_drawing', payload)
+            else:
+                # Без очереди та же обработка идет в запросе
+                try:
+                    processed = process_upload(app.config['UPLOAD_FOLDER'], filename, pack_store)
+                except InvalidImage as e:
+                    storage.set_drawing_status(drawing_id, DRAWING_FAILED, str(e))
+                    raise UploadError(str(e)) from e
+                if pack_store is not None and processed[0] != filename:
+                    absorb_upload(pack_store, app.config['UPLOAD_FOLDER'], processed[0])
+                filename = processed[0]
+                duplicate_of = storage.complete_upload(drawing_id, *processed, reward=UPLOAD_REWARD)
+                reward = None if duplicate_of else UPLOAD_REWARD
+                storage.set_drawing_status(drawing_id, DRAWING_READY)
+        
+        result = {
             'success': True,
             'message': 'Рисунок успешно сохранен!',
             'drawing_id': drawing_id,
             'image_url': f"/static/drawings/{filename}",
-            'reward': {'experience': 10, 'coins': 10}
-        })
-        
+            'processing_status': DRAWING_PENDING if background else DRAWING_READY,
+            'reward': reward or {'experience': 0, 'coins': 0}
+        }
+        if background:
+            # Награду и уведомление выдаст обработчик задач (jobs_worker.py)
+            result['message'] = 'Рисунок сохранен и обрабатывается, награда будет начислена после проверки'
+            result['reward'] = None
+        elif reward:
+            leaderboard.add_experience(user['id'], reward['experience'])
+            if notification_queue is not None:
+                notify_upload(telegram_id, drawing_id, title, filename)
+        else:
+            result['message'] = 'Рисунок сохранен, но он почти совпадает с вашим уже загруженным - награды нет'
+            result['duplicate_of'] = duplicate_of
+        
+        return jsonify(result)
+        
+    except (UploadTooLarge, RequestEntityTooLarge):
+        return jsonify({'success': False, 'error': 'Файл слишком большой'}), 413
+    except UploadError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
@@ -356,99 +518,74 @@ def like_drawing(drawing_id):
         if not user:
             return jsonify({'error': 'Пользователь не найден'}), 404
         
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        # Проверяем, не лайкал ли уже
-        cursor.execute('SELECT id FROM likes WHERE user_id = ? AND drawing_id = ?', 
-                      (user['id'], drawing_id))
-        
-        if cursor.fetchone():
-            conn.close()
+        # Режим отложенной записи: лайк попадает в очередь, в базу - пачкой
+        if like_batcher is not None:
+            if not like_batcher.submit(user['id'], drawing_id):
+                return jsonify({'error': 'Вы уже лайкнули этот рисунок'}), 400
+            
+            return jsonify({
+                'success': True,
+                'message': 'Лайк принят!',
+                'queued': True,
+                'reward': LIKE_REWARD
+            }), 202
+        
+        # Добавляем лайк и начисляем опыт автору рисунка (повтор не запишется)
+        added = storage.add_likes([(user['id'], drawing_id)])
+        if not added:
             return jsonify({'error': 'Вы уже лайкнули этот рисунок'}), 400
         
-        # Добавляем лайк
-        cursor.execute('INSERT INTO likes (user_id, drawing_id) VALUES (?, ?)', 
-                      (user['id'], drawing_id))
-        cursor.execute('UPDATE drawings SET likes = likes + 1 WHERE id = ?', 
-                      (drawing_id,))
-        
-        # Начисляем опыт автору рисунка
-        cursor.execute('SELECT user_id FROM drawings WHERE id = ?', (drawing_id,))
-        author_row = cursor.fetchone()
-        if author_row:
-            author_id = author_row['user_id']
-            cursor.execute('UPDATE users SET experience = experience + 1, balance = balance + 1 WHERE id = ?', 
-                          (author_id,))
-        
-        conn.commit()
-        conn.close()
+        on_likes_recorded(added)
         
         return jsonify({
             'success': True,
             'message': 'Лайк добавлен!',
-            'reward': {'experience': 1, 'coins': 1}
+            'reward': LIKE_REWARD
         })
         
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
+@app.route('/api/drawings/<int:drawing_id>/view', methods=['POST'])
+def view_drawing(drawing_id):
+    """Засчитать просмотр рисунка (пишется в базу пачкой)"""
+    try:
+        data = request.get_json(silent=True) or {}
+        # Зритель определяется по токену; без токена просмотр считается всегда
+        counted = view_counter.record(drawing_id, viewer=data.get('token'))
+        return jsonify({'success': True, 'counted': counted})
+        
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
 # ==================== API ДЛЯ ПОЛЬЗОВАТЕЛЕЙ ====================
 
 @app.route('/api/users/<int:user_id>', methods=['GET'])
+@cached_response('feed', 'users')
 def get_user_profile(user_id):
     """Получить профиль пользователя"""
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        # Основная информация
-        cursor.execute('SELECT * FROM users WHERE id = ?', (user_id,))
-        user = cursor.fetchone()
-        
-        if not user:
-            conn.close()
+        # Пользователь и готовая статистика - один поиск по первичному ключу
+        user_data = storage.get_profile(user_id)
+        if not user_data:
             return jsonify({'error': 'Пользователь не найден'}), 404
         
-        user_data = dict(user)
-        
-        # Статистика
-        cursor.execute('SELECT COUNT(*) FROM drawings WHERE user_id = ?', (user_id,))
-        drawings_count = cursor.fetchone()[0]
-        
-        cursor.execute('SELECT SUM(likes) FROM drawings WHERE user_id = ?', (user_id,))
-        total_likes = cursor.fetchone()[0] or 0
-        
-        cursor.execute('''
-            SELECT COUNT(DISTINCT drawing_id) 
-            FROM likes 
-            WHERE drawing_id IN (SELECT id FROM drawings WHERE user_id = ?)
-        ''', (user_id,))
-        unique_likers = cursor.fetchone()[0] or 0
+        stats = {key: user_data.pop(key)
+                 for key in ('drawings_count', 'total_likes', 'unique_likers', 'last_upload_at')}
         
         # Последние работы
-        cursor.execute('''
-            SELECT * FROM drawings 
-            WHERE user_id = ? 
-            ORDER BY created_at DESC 
-            LIMIT 5
-        ''', (user_id,))
-        
         recent_drawings = []
-        for row in cursor.fetchall():
-            drawing = dict(row)
+        for drawing in storage.user_drawings(user_id, limit=5):
+            drawing.pop('views', None)
             drawing['image_url'] = f"/static/drawings/{drawing['filename']}"
+            drawing.update(rendition_urls(drawing['filename']))
             recent_drawings.append(drawing)
         
-        conn.close()
-        
         return jsonify({
             'success': True,
             'user': user_data,
             'stats': {
-                'drawings_count': drawings_count,
-                'total_likes': total_likes,
-                'unique_likers': unique_likers,
+                **stats,
                 'level': user_data['level'],
                 'experience': user_data['experience'],
                 'balance': user_data['balance']
@@ -459,20 +596,57 @@ def get_user_profile(user_id):
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
+@app.route('/api/leaderboard', methods=['GET'])
+def get_leaderboard():
+    """Рейтинг художников
+    
+    ?board=experience|likes|weekly, ?limit=N, ?user_id= или ?telegram_id= - место пользователя
+    """
+    try:
+        board = request.args.get('board', 'experience')
+        if board not in BOARDS:
+            return jsonify({'success': False, 'error': 'Неизвестный рейтинг'}), 400
+        limit = page_size(request.args.get('limit'), default=10)
+        
+        user_id = request.args.get('user_id', type=int)
+        telegram_id = request.args.get('telegram_id', type=int)
+        top = leaderboard.top(board, limit)
+        
+        if user_id is None and telegram_id is not None:
+            user = storage.get_user(telegram_id)
+            user_id = user['id'] if user else None
+        
+        # Имена только для тех, кто попал в выдачу
+        names = storage.user_names(entry['user_id'] for entry in top)
+        
+        for entry in top:
+            user = names.get(entry['user_id'], {})
+            entry['username'] = user.get('username')
+            entry['author_name'] = f"{user.get('first_name') or ''} {user.get('last_name') or ''}".strip()
+        
+        return jsonify({
+            'success': True,
+            'board': board,
+            'top': top,
+            'me': leaderboard.rank(board, user_id) if user_id is not None else None
+        })
+        
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
 # ==================== API ДЛЯ МАГАЗИНА ====================
 
 @app.route('/api/shop/items', methods=['GET'])
 def get_shop_items():
-    """Получить товары магазина"""
+    """Получить товары магазина (?type= - только товары одного типа)"""
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
+        # Готовое тело из каталога в памяти, без запроса к базе
+        body, etag = shop_catalog.body(request.args.get('type'))
         
-        cursor.execute('SELECT * FROM shop_items ORDER BY price')
-        items = [dict(row) for row in cursor.fetchall()]
-        
-        conn.close()
-        return jsonify({'success': True, 'items': items})
+        response = app.response_class(body, mimetype='application/json')
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'public, max-age=300'
+        return response.make_conditional(request)
         
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
@@ -494,45 +668,23 @@ def buy_item():
         if not user:
             return jsonify({'error': 'Пользователь не найден'}), 404
         
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        # Получаем информацию о товаре
-        cursor.execute('SELECT * FROM shop_items WHERE id = ?', (item_id,))
-        item = cursor.fetchone()
-        
-        if not item:
-            conn.close()
+        # Получаем информацию о товаре из каталога в памяти
+        item_data = shop_catalog.get(item_id)
+        if not item_data:
             return jsonify({'error': 'Товар не найден'}), 404
+        item_id = item_data['id']
         
-        item_data = dict(item)
-        
-        # Проверяем баланс
-        if user['balance'] < item_data['price']:
-            conn.close()
+        # Проверка покупки, списание и запись - одной транзакцией
+        result, new_balance = storage.buy_item(user['id'], item_id, item_data['price'])
+        if result == NOT_ENOUGH_COINS:
             return jsonify({'error': 'Недостаточно монет'}), 400
-        
-        # Проверяем, не куплен ли уже
-        cursor.execute('SELECT id FROM purchases WHERE user_id = ? AND item_id = ?', 
-                      (user['id'], item_id))
-        
-        if cursor.fetchone():
-            conn.close()
+        if result == ALREADY_OWNED:
             return jsonify({'error': 'Уже куплено'}), 400
         
-        # Списываем деньги и добавляем покупку
-        cursor.execute('UPDATE users SET balance = balance - ? WHERE id = ?', 
-                      (item_data['price'], user['id']))
-        cursor.execute('INSERT INTO purchases (user_id, item_id) VALUES (?, ?)', 
-                      (user['id'], item_id))
-        
-        conn.commit()
-        conn.close()
-        
         return jsonify({
             'success': True,
             'message': f'Товар "{item_data["name"]}" куплен!',
-            'new_balance': user['balance'] - item_data['price']
+            'new_balance': new_balance
         })
         
     except Exception as e:
@@ -542,8 +694,65 @@ def buy_item():
 
 @app.route('/static/drawings/<filename>')
 def serve_drawing(filename):
-    """Отдать рисунок"""
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    """Отдать рисунок (из сегмента, подпапки или, до конца миграции, из общей папки)
+
+    Рисунок из штрихов растрируется при первом запросе, дальше отдается готовый PNG.
+    """
+    if pack_store is not None:
+        view = pack_store.get(filename)
+        if view is not None:
+            return immutable(pack_response(view, filename), filename)
+    path = raster_path(app.config['UPLOAD_FOLDER'], filename)
+    if path is None:
+        abort(404)
+    response = send_from_directory(os.path.abspath(os.path.dirname(path)), filename)
+    return immutable(response, filename)
+
+@app.route('/static/renditions/<int:width>/<name>')
+def serve_rendition(width, name):
+    """Отдать превью рисунка (создается при первом запросе и кэшируется на диске)"""
+    rendition = parse_rendition(width, name)
+    if rendition is None:
+        abort(404)
+    filename, fmt = rendition
+    path = ensure_rendition(app.config['UPLOAD_FOLDER'], app.config['RENDITIONS_FOLDER'],
+                            filename, width, fmt, pack_store)
+    if path is None:
+        abort(404)
+    response = send_from_directory(os.path.abspath(os.path.dirname(path)), os.path.basename(path))
+    return immutable(response, filename)
+
+def pack_response(view, filename):
+    """Ответ из среза mmap: тело отдается кусками, в памяти не больше одного куска
+
+    WSGI-серверы принимают только bytes, поэтому каждый срез копируется.
+    """
+    chunks = (bytes(view[i:i + CHUNK_SIZE]) for i in range(0, len(view), CHUNK_SIZE))
+    response = Response(chunks, mimetype='image/png', direct_passthrough=True)
+    response.content_length = len(view)
+    response.set_etag(filename)
+    return response.make_conditional(request)
+
+def immutable(response, filename):
+    """Файл, названный по содержимому, под этим URL никогда не меняется - кэшируем навсегда"""
+    if is_content_addressed(filename):
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = IMMUTABLE_MAX_AGE
+        response.cache_control.immutable = True
+    return response
+
+@app.route('/static/sprites/<name>')
+def serve_sprite(name):
+    """Отдать лист превью (имя - хэш состава листа, содержимое не меняется)"""
+    if not name.endswith('.webp'):
+        abort(404)
+    response = send_from_directory(os.path.abspath(app.config['SPRITES_FOLDER']), name)
+    response.cache_control.no_cache = None
+    response.cache_control.public = True
+    response.cache_control.max_age = IMMUTABLE_MAX_AGE
+    response.cache_control.immutable = True
+    return response
 
 @app.route('/static/<path:path>')
 def serve_static(path):
@@ -557,13 +766,15 @@ if __name__ == '__main__':
     print(f"🚀 Drawfy Server запускается...")
     print(f"📡 API доступен на: http://localhost:{port}")
     print(f"🌐 Web App: http://localhost:{port}/")
-    print(f"💾 База данных: {app.config['DATABASE']}")
+    print(f"💾 База данных: {storage.name}")
     print(f"📁 Загрузки: {app.config['UPLOAD_FOLDER']}")
     print("\n📌 Доступные эндпоинты:")
-    print(f"  GET  /api/drawings          - Все рисунки")
-    print(f"  POST /api/drawings/upload   - Загрузить рисунок")
+    print(f"  GET  /api/drawings          - Лента рисунков (?limit=, ?before=)")
+    print(f"  POST /api/drawings/upload   - Загрузить рисунок (multipart, image/png или JSON)")
+    print(f"  POST /api/drawings/<id>/view - Засчитать просмотр")
     print(f"  POST /api/telegram-auth     - Авторизация Telegram")
     print(f"  GET  /api/users/<id>        - Профиль пользователя")
+    print(f"  GET  /api/leaderboard       - Рейтинг художников")
     print(f"  GET  /api/shop/items        - Товары магазина")
     print("\n✨ Сервер готов! Нажми Ctrl+C чтобы остановить")
     
@@ -0,0 +1,245 @@
+"""Нагрузочные замеры Drawfy
+
+Каждый сценарий запускается в отдельном процессе с чистой базой во временной
+папке, чтобы замеры не влияли друг на друга:
+
+    python benchmark.py pool --seconds 5 --threads 4
+    python benchmark.py likes
+    python benchmark.py upload --threads 1
+    python benchmark.py dispatch --threads 2
+"""
+import argparse
+import base64
+import io
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def seed(db_pool, users=200, drawings=300, likes=1000):
+    """Заполнить базу тестовыми данными"""
+    with db_pool.connection() as conn:
+        conn.executemany(
+            'INSERT OR IGNORE INTO users (telegram_id, username, first_name) VALUES (?, ?, ?)',
+            [(1000 + i, f'user{i}', f'Художник {i}') for i in range(users)]
+        )
+        user_ids = [row[0] for row in conn.execute('SELECT id FROM users')]
+        conn.executemany(
+            'INSERT INTO drawings (user_id, title, filename) VALUES (?, ?, ?)',
+            [(random.choice(user_ids), f'Рисунок {i}', f'bench_{i}.png') for i in range(drawings)]
+        )
+        drawing_ids = [row[0] for row in conn.execute('SELECT id FROM drawings')]
+        conn.executemany(
+            'INSERT OR IGNORE INTO likes (user_id, drawing_id) VALUES (?, ?)',
+            [(random.choice(user_ids), random.choice(drawing_ids)) for _ in range(likes)]
+        )
+    return user_ids, drawing_ids
+
+
+def run_requests(app, make_request, seconds, threads):
+    """Гонять запросы из нескольких потоков, вернуть число запросов в секунду"""
+    done = [0] * threads
+    errors = [0] * threads
+    deadline = time.perf_counter() + seconds
+
+    def loop(n):
+        client = app.test_client()
+        while time.perf_counter() < deadline:
+            response = make_request(client)
+            if response.status_code >= 500:
+                errors[n] += 1
+            done[n] += 1
+
+    workers = [threading.Thread(target=loop, args=(n,)) for n in range(threads)]
+    started = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - started
+    return sum(done) / elapsed, sum(errors)
+
+
+def scenario_pool(args):
+    """Смешанная нагрузка: лента, профиль и лайки (каждый десятый запрос)"""
+    import app as drawfy
+
+    user_ids, drawing_ids = seed(drawfy.storage.pool)
+    with drawfy.storage.pool.connection() as conn:
+        telegram_ids = [row[0] for row in conn.execute('SELECT telegram_id FROM users')]
+
+    def make_request(client):
+        roll = random.random()
+        if roll < 0.1:
+            return client.post(f'/api/drawings/{random.choice(drawing_ids)}/like',
+                               json={'token': f'user_{random.choice(telegram_ids)}'})
+        if roll < 0.3:
+            return client.get(f'/api/users/{random.choice(user_ids)}')
+        return client.get('/api/drawings')
+
+    rps, errors = run_requests(drawfy.app, make_request, args.seconds, args.threads)
+    print(f'{rps:.1f} {errors}')
+
+
+def scenario_likes(args):
+    """Волна лайков на один популярный рисунок от разных пользователей"""
+    import app as drawfy
+
+    seed(drawfy.storage.pool, users=20000, drawings=10, likes=0)
+    with drawfy.storage.pool.connection() as conn:
+        telegram_ids = [row[0] for row in conn.execute('SELECT telegram_id FROM users')]
+    random.shuffle(telegram_ids)
+    lock = threading.Lock()
+
+    def make_request(client):
+        with lock:
+            telegram_id = telegram_ids.pop() if telegram_ids else 1000
+        return client.post('/api/drawings/1/like', json={'token': f'user_{telegram_id}'})
+
+    rps, errors = run_requests(drawfy.app, make_request, args.seconds, args.threads)
+    if drawfy.like_batcher is not None:
+        drawfy.like_batcher.flush()
+    print(f'{rps:.1f} {errors}')
+
+
+def scenario_upload(args):
+    """Загрузка больших рисунков: пропускная способность и прирост пиковой памяти процесса"""
+    import app as drawfy
+    from PIL import Image
+
+    # Шум не сжимается: PNG получается почти ровно upload_mb и проходит проверку при приеме
+    side = int((args.upload_mb * 1024 * 1024 / 3) ** 0.5)
+    buffer = io.BytesIO()
+    Image.frombytes('RGB', (side, side), os.urandom(side * side * 3)).save(buffer, 'PNG', compress_level=0)
+    image = buffer.getvalue()
+    if args.mode == 'json':
+        body = json.dumps({'token': 'user_123456789',
+                           'image': 'data:image/png;base64,' + base64.b64encode(image).decode('ascii')})
+        content_type, path = 'application/json', '/api/drawings/upload'
+    else:
+        body, content_type, path = image, 'image/png', '/api/drawings/upload?token=user_123456789'
+    del image
+
+    def make_request(client):
+        return client.post(path, data=body, content_type=content_type)
+
+    # Прогрев, затем замер: ru_maxrss растет только если запрос превысил прежний пик
+    make_request(drawfy.app.test_client())
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    rps, errors = run_requests(drawfy.app, make_request, args.seconds, args.threads)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(f'{rps:.1f} {errors} {(peak - baseline) / 1024:.1f}')
+
+
+def scenario_dispatch(args):
+    """Тысячи синтетических обновлений бота через диспетчер: скорость, порядок в чатах, очередь
+
+    Обработчик спит, как при отправке ответа в Telegram; один чат заметно
+    медленнее остальных. Отправители (--threads) делят чаты между собой,
+    поэтому порядок внутри чата задан однозначно. Ошибки - нарушения порядка.
+    """
+    from database.dispatch import ChatDispatcher
+
+    total, chats, slow_chat = 5000, 300, 0
+    last_seen = {}
+    violations = [0]
+    lock = threading.Lock()
+
+    def handler(update):
+        message = update['message']
+        chat = message['chat']['id']
+        time.sleep(0.05 if chat == slow_chat else random.expovariate(1 / 0.005))
+        with lock:
+            if last_seen.get(chat, 0) >= message['message_id']:
+                violations[0] += 1
+            last_seen[chat] = message['message_id']
+
+    dispatcher = ChatDispatcher(handler, workers=int(os.environ['BOT_WORKERS']), max_pending=500)
+    updates = [{'update_id': n, 'message': {'message_id': n, 'chat': {'id': random.randrange(chats)}}}
+               for n in range(1, total + 1)]
+
+    def produce(part):
+        for update in updates:
+            if update['message']['chat']['id'] % args.threads == part:
+                dispatcher.submit(update, block=True)
+
+    producers = [threading.Thread(target=produce, args=(n,)) for n in range(args.threads)]
+    started = time.perf_counter()
+    for producer in producers:
+        producer.start()
+    for producer in producers:
+        producer.join()
+    dispatcher.join()
+    elapsed = time.perf_counter() - started
+    metrics = dispatcher.metrics.snapshot()
+    print(f"{total / elapsed:.1f} {violations[0]} {metrics['wait_p95_ms']} {metrics['max_queue_depth']}")
+
+
+SCENARIOS = {
+    'pool': (scenario_pool, [('DB_POOL=0', {'DB_POOL': '0'}), ('DB_POOL=1', {'DB_POOL': '1'})]),
+    'likes': (scenario_likes, [('сразу', {'LIKES_WRITE_BEHIND': '0'}),
+                               ('очередь', {'LIKES_WRITE_BEHIND': '1'})]),
+    'upload': (scenario_upload, [('json', {'UPLOAD_MODE': 'json'}), ('поток', {'UPLOAD_MODE': 'stream'})]),
+    'dispatch': (scenario_dispatch, [(f'потоков={n}', {'BOT_WORKERS': str(n)}) for n in (1, 8, 32)]),
+}
+
+# Дополнительные поля результата сценария (после запросов/с и ошибок)
+DETAILS = {
+    'upload': lambda peak: f", пик памяти +{peak} МБ",
+    'dispatch': lambda wait, depth: f", ожидание p95 {wait} мс, макс. очередь {depth}",
+}
+
+
+def run_variant(name, env, args):
+    """Запустить сценарий в отдельном процессе с чистой базой"""
+    workdir = tempfile.mkdtemp(prefix='drawfy-bench-')
+    try:
+        result = subprocess.run(
+            [sys.executable, os.path.join(BASE_DIR, 'benchmark.py'), name,
+             '--child', '--seconds', str(args.seconds), '--threads', str(args.threads),
+             '--upload-mb', str(args.upload_mb)],
+            cwd=workdir,
+            # Сценарии заполняют базу напрямую через SQLite
+            env={**os.environ, 'DATABASE_URL': 'drawfy.db', **env, 'PYTHONPATH': BASE_DIR},
+            capture_output=True,
+            text=True,
+            check=True
+        )
+        return result.stdout.strip().splitlines()[-1]
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Замеры производительности Drawfy')
+    parser.add_argument('scenario', choices=sorted(SCENARIOS))
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--upload-mb', type=int, default=8, help='Размер рисунка в сценарии upload')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    args.mode = os.environ.get('UPLOAD_MODE')
+
+    scenario, variants = SCENARIOS[args.scenario]
+    if args.child:
+        scenario(args)
+        return
+
+    print(f"📊 Сценарий '{args.scenario}': {args.threads} потоков, {args.seconds} с")
+    for label, env in variants:
+        rps, errors, *extra = run_variant(args.scenario, env, args).split()
+        details = DETAILS[args.scenario](*extra) if extra else ''
+        print(f"  {label:<12} {float(rps):>10.1f} запросов/с  (ошибок: {errors}{details})")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,8 @@
 import os
+import time
+import requests
 import telebot
+from telebot.types import Update
 from telebot.types import (
     InlineKeyboardMarkup, 
     InlineKeyboardButton,
@@ -9,17 +12,65 @@ from telebot.types import (
 )
 from dotenv import load_dotenv
 
+from database.dispatch import DISPATCH_WORKERS, MAX_PENDING, ChatDispatcher
+from database.file_ids import FileIdCache, rendition_key, source_version
+from database.notifications import NotificationQueue, Notifier, RetryLater, Undeliverable
+from database.renditions import TELEGRAM_PHOTO, ensure_rendition, rendition_url
+from database.response_cache import TTLCache
+from database.strokes import source_path
+from database.webhook import create_webhook_app
+
 load_dotenv()
 
 BOT_TOKEN = os.getenv('BOT_TOKEN')
 WEBAPP_URL = os.getenv('WEBAPP_URL', 'http://localhost:5000')
 
+# polling - опрос Telegram в цикле; webhook - Telegram сам присылает обновления
+# (на сервере вебхук запускается через gunicorn, см. bot_webhook.py)
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+# Публичный адрес вебхука (https://.../telegram/webhook); пусто - вебхук не регистрируется
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram/webhook')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('PORT', '8443'))
+# Обновления разных чатов обрабатываются параллельно, одного чата - по порядку
+BOT_WORKERS = int(os.getenv('BOT_WORKERS', str(DISPATCH_WORKERS)))
+BOT_QUEUE_SIZE = int(os.getenv('BOT_QUEUE_SIZE', str(MAX_PENDING)))
+# Долгий опрос: Telegram держит запрос до появления обновлений (секунды)
+POLL_TIMEOUT = int(os.getenv('POLL_TIMEOUT', '25'))
+# Записывать принятые обновления в JSONL для bot_replay.py
+BOT_RECORD_UPDATES = os.getenv('BOT_RECORD_UPDATES')
+# Уведомления авторам: события пишет веб-приложение, отправляет бот (та же папка на сервере)
+NOTIFICATIONS = os.getenv('NOTIFICATIONS', '1') == '1'
+NOTIFY_DATABASE = os.getenv('NOTIFY_DATABASE', 'notifications.db')
+# Инлайн-режим: статьи для пустого запроса не меняются, результаты поиска - часто.
+# cache_time - сколько секунд Telegram отдает ответ из своего кэша
+STATIC_CACHE_TIME = int(os.getenv('INLINE_STATIC_CACHE_TIME', '86400'))
+SEARCH_CACHE_TIME = int(os.getenv('INLINE_SEARCH_CACHE_TIME', '30'))
+# Ответы поиска в памяти бота (разные пользователи, один запрос)
+SEARCH_CACHE_TTL = float(os.getenv('INLINE_SEARCH_CACHE_TTL', '60'))
+SEARCH_CACHE_SIZE = int(os.getenv('INLINE_SEARCH_CACHE_SIZE', '1000'))
+INLINE_PAGE_SIZE = 20
+# Файлы рисунков, если бот на одном сервере с веб-приложением; файла нет - Telegram скачает его по WEBAPP_URL
+UPLOAD_FOLDER = os.getenv('UPLOAD_FOLDER', 'static/drawings')
+RENDITIONS_FOLDER = os.getenv('RENDITIONS_FOLDER', 'static/renditions')
+# file_id уже отправленных рисунков: повторная отправка без загрузки файла
+FILE_IDS_DATABASE = os.getenv('FILE_IDS_DATABASE', 'file_ids.db')
+# Другой адрес Bot API (локальный сервер или заглушка из bot_replay.py)
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL')
+if TELEGRAM_API_URL:
+    telebot.apihelper.API_URL = TELEGRAM_API_URL.rstrip('/') + '/bot{0}/{1}'
+
 if not BOT_TOKEN:
     print("❌ Ошибка: BOT_TOKEN не найден в .env файле!")
     print("📝 Добавьте в файл .env строку: BOT_TOKEN=ваш_токен_от_BotFather")
     exit(1)
 
-bot = telebot.TeleBot(BOT_TOKEN)
+# Обработчики вызываются в потоках диспетчера (database/dispatch.py), а не в пуле telebot
+bot = telebot.TeleBot(BOT_TOKEN, threaded=False)
+
+search_cache = TTLCache(SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL)
 
 # ==================== КОМАНДЫ БОТА ====================
 
@@ -59,6 +110,7 @@ def start_command(message):
 /gallery - Открыть галерею
 /shop - Открыть магазин
 /profile - Мой профиль
+/top - Рейтинг художников
 /help - Помощь
 
 ✨ *Рисуйте, делитесь, вдохновляйте!*
@@ -132,6 +184,48 @@ def draw_command(message):
         reply_markup=keyboard
     )
 
+# Названия рейтингов для /top [experience|likes|weekly]
+TOP_BOARDS = {
+    'experience': '⭐ По опыту',
+    'likes': '❤️ По лайкам',
+    'weekly': '🔥 Лайки за 7 дней',
+}
+
+@bot.message_handler(commands=['top'])
+def top_command(message):
+    """Рейтинг художников и место пользователя"""
+    args = message.text.split()[1:]
+    board = args[0] if args and args[0] in TOP_BOARDS else 'experience'
+    
+    try:
+        response = requests.get(
+            f"{WEBAPP_URL}/api/leaderboard",
+            params={'board': board, 'limit': 10, 'telegram_id': message.from_user.id},
+            timeout=5
+        )
+        data = response.json()
+    except Exception as e:
+        print(f"Ошибка загрузки рейтинга: {e}")
+        bot.send_message(message.chat.id, "Рейтинг временно недоступен, попробуйте позже 🙏")
+        return
+    
+    medals = {1: '🥇', 2: '🥈', 3: '🥉'}
+    lines = [f"🏆 *Топ художников* — {TOP_BOARDS[board]}\n"]
+    for entry in data.get('top', []):
+        name = entry.get('author_name') or entry.get('username') or f"Художник #{entry['user_id']}"
+        lines.append(f"{medals.get(entry['rank'], str(entry['rank']) + '.')} {name} — {entry['score']}")
+    if len(lines) == 1:
+        lines.append("Пока здесь пусто — станьте первым! 🎨")
+    
+    me = data.get('me')
+    if me and me.get('rank'):
+        lines.append(f"\n👤 Ваше место: *{me['rank']}* ({me['score']})")
+    else:
+        lines.append("\n👤 Вы пока не в рейтинге")
+    lines.append("\nДругие рейтинги: /top likes, /top weekly")
+    
+    bot.send_message(message.chat.id, "\n".join(lines), parse_mode='Markdown')
+
 @bot.message_handler(func=lambda message: message.text == "🖼️ Галерея")
 def gallery_button(message):
     """Обработка кнопки Галерея"""
@@ -190,62 +284,254 @@ def help_button(message):
 
 # ==================== ИНЛАЙН-РЕЖИМ ====================
 
-@bot.inline_handler(lambda query: query.query)
-def inline_query(inline_query):
-    try:
-        # Результат 1: Открыть Drawfy
-        r1 = telebot.types.InlineQueryResultArticle(
-            id='1',
-            title='🎨 Открыть Drawfy',
-            description='Рисуй, делись работами, вдохновляй!',
-            input_message_content=telebot.types.InputTextMessageContent(
-                message_text='Присоединяйтесь к Drawfy! 🎨\n\nРисуйте, делитесь работами и находите вдохновение в сообществе художников!'
-            ),
-            reply_markup=InlineKeyboardMarkup().add(
-                InlineKeyboardButton(
-                    "🎨 ОТКРЫТЬ DRAWFY",
-                    web_app=WebAppInfo(url=WEBAPP_URL)
-                )
+def static_inline_results():
+    """Статьи для пустого запроса: открыть приложение, галерею, холст"""
+    # Результат 1: Открыть Drawfy
+    r1 = telebot.types.InlineQueryResultArticle(
+        id='1',
+        title='🎨 Открыть Drawfy',
+        description='Рисуй, делись работами, вдохновляй!',
+        input_message_content=telebot.types.InputTextMessageContent(
+            message_text='Присоединяйтесь к Drawfy! 🎨\n\nРисуйте, делитесь работами и находите вдохновение в сообществе художников!'
+        ),
+        reply_markup=InlineKeyboardMarkup().add(
+            InlineKeyboardButton(
+                "🎨 ОТКРЫТЬ DRAWFY",
+                web_app=WebAppInfo(url=WEBAPP_URL)
             )
         )
-        
-        # Результат 2: Галерея
-        r2 = telebot.types.InlineQueryResultArticle(
-            id='2',
-            title='🖼️ Галерея Drawfy',
-            description='Смотри работы других художников',
-            input_message_content=telebot.types.InputTextMessageContent(
-                message_text='Посмотрите удивительные работы в галерее Drawfy! 🎨'
-            ),
-            reply_markup=InlineKeyboardMarkup().add(
-                InlineKeyboardButton(
-                    "🖼️ Открыть галерею",
-                    web_app=WebAppInfo(url=f"{WEBAPP_URL}/gallery")
-                )
+    )
+    
+    # Результат 2: Галерея
+    r2 = telebot.types.InlineQueryResultArticle(
+        id='2',
+        title='🖼️ Галерея Drawfy',
+        description='Смотри работы других художников',
+        input_message_content=telebot.types.InputTextMessageContent(
+            message_text='Посмотрите удивительные работы в галерее Drawfy! 🎨'
+        ),
+        reply_markup=InlineKeyboardMarkup().add(
+            InlineKeyboardButton(
+                "🖼️ Открыть галерею",
+                web_app=WebAppInfo(url=f"{WEBAPP_URL}/gallery")
             )
         )
-        
-        # Результат 3: Рисование
-        r3 = telebot.types.InlineQueryResultArticle(
-            id='3',
-            title='✏️ Начать рисовать',
-            description='Создай свой шедевр прямо сейчас!',
-            input_message_content=telebot.types.InputTextMessageContent(
-                message_text='Время творить! ✨\n\nОткройте Drawfy и создайте свой шедевр!'
-            ),
-            reply_markup=InlineKeyboardMarkup().add(
-                InlineKeyboardButton(
-                    "✏️ Начать рисовать",
-                    web_app=WebAppInfo(url=f"{WEBAPP_URL}/draw")
-                )
+    )
+    
+    # Результат 3: Рисование
+    r3 = telebot.types.InlineQueryResultArticle(
+        id='3',
+        title='✏️ Начать рисовать',
+        description='Создай свой шедевр прямо сейчас!',
+        input_message_content=telebot.types.InputTextMessageContent(
+            message_text='Время творить! ✨\n\nОткройте Drawfy и создайте свой шедевр!'
+        ),
+        reply_markup=InlineKeyboardMarkup().add(
+            InlineKeyboardButton(
+                "✏️ Начать рисовать",
+                web_app=WebAppInfo(url=f"{WEBAPP_URL}/draw")
             )
         )
+    )
+    return [r1, r2, r3]
+
+def inline_photo_result(drawing):
+    """Фото рисунка: по file_id, если Telegram его уже видел, иначе по ссылке на JPEG"""
+    fields = dict(
+        id=str(drawing['id']),
+        title=drawing['title'],
+        description=drawing['author_name'],
+        caption=f"🎨 {drawing['title']} — {drawing['author_name']}",
+        reply_markup=InlineKeyboardMarkup().add(
+            InlineKeyboardButton(
+                "🖼️ Открыть галерею",
+                web_app=WebAppInfo(url=f"{WEBAPP_URL}/gallery")
+            )
+        )
+    )
+    file_id = cached_photo_id(drawing['filename'])
+    if file_id is not None:
+        return telebot.types.InlineQueryResultCachedPhoto(photo_file_id=file_id, **fields)
+    return telebot.types.InlineQueryResultPhoto(
+        photo_url=WEBAPP_URL + drawing['photo_url'],
+        thumbnail_url=WEBAPP_URL + drawing['photo_thumbnail_url'],
+        **fields
+    )
+
+def search_inline_results(text, offset):
+    """Фото рисунков по запросу и next_offset ('' - страниц больше нет)
+
+    Ответ API держится в памяти SEARCH_CACHE_TTL секунд: пока пользователь
+    печатает, Telegram присылает один и тот же запрос много раз.
+    """
+    key = (' '.join(text.lower().split()), offset)
+    cached = search_cache.get(key)
+    if cached is not None:
+        return cached
+    
+    response = requests.get(
+        f"{WEBAPP_URL}/api/drawings/search",
+        params={'q': text, 'offset': offset or 0, 'limit': INLINE_PAGE_SIZE},
+        timeout=5
+    )
+    data = response.json()
+    if not data.get('success'):
+        raise RuntimeError(data.get('error'))
+    
+    results = [inline_photo_result(drawing) for drawing in data['drawings']]
+    next_offset = str(data['next_offset']) if data.get('next_offset') else ''
+    return search_cache.put(key, (results, next_offset))
+
+@bot.inline_handler(lambda query: True)
+def inline_query(inline_query):
+    """Пустой запрос - статьи о Drawfy, иначе - поиск рисунков"""
+    try:
+        text = inline_query.query.strip()
+        if text:
+            results, next_offset = search_inline_results(text, inline_query.offset)
+            if results or inline_query.offset:
+                bot.answer_inline_query(inline_query.id, results, cache_time=SEARCH_CACHE_TIME,
+                                        next_offset=next_offset)
+                return
         
-        bot.answer_inline_query(inline_query.id, [r1, r2, r3], cache_time=1)
+        # Статьи не меняются: Telegram может долго отдавать их из своего кэша
+        cache_time = STATIC_CACHE_TIME if not text else SEARCH_CACHE_TIME
+        bot.answer_inline_query(inline_query.id, static_inline_results(), cache_time=cache_time)
         
     except Exception as e:
         print(f"Ошибка в inline режиме: {e}")
 
+# ==================== ПРИЕМ ОБНОВЛЕНИЙ ====================
+
+_dispatcher = None
+
+def process_update(update):
+    """Передать обновление (dict от Telegram) обычным обработчикам telebot"""
+    bot.process_new_updates([Update.de_json(update)])
+
+def get_dispatcher():
+    """Диспетчер обновлений (создается при первом обращении)"""
+    global _dispatcher
+    if _dispatcher is None:
+        _dispatcher = ChatDispatcher(process_update, workers=BOT_WORKERS, max_pending=BOT_QUEUE_SIZE)
+    return _dispatcher
+
+def run_polling():
+    """Долгий опрос Telegram; заполненная очередь диспетчера приостанавливает опрос"""
+    bot.remove_webhook()
+    dispatcher = get_dispatcher()
+    offset = None
+    while True:
+        try:
+            updates = telebot.apihelper.get_updates(BOT_TOKEN, offset=offset, timeout=POLL_TIMEOUT,
+                                                    long_polling_timeout=POLL_TIMEOUT)
+        except Exception as e:
+            print(f"❌ Ошибка получения обновлений: {e}")
+            time.sleep(3)
+            continue
+        for update in updates:
+            dispatcher.submit(update, block=True)
+            offset = update['update_id'] + 1
+
+def create_webhook():
+    """Приложение вебхука: повторы отсекаются по update_id, обработка - в диспетчере"""
+    return create_webhook_app(get_dispatcher(), path=WEBHOOK_PATH, secret=WEBHOOK_SECRET,
+                              record_path=BOT_RECORD_UPDATES)
+
+def register_webhook():
+    """Зарегистрировать вебхук в Telegram (если задан WEBHOOK_URL)"""
+    if WEBHOOK_URL:
+        bot.remove_webhook()
+        bot.set_webhook(url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET,
+                        max_connections=min(BOT_WORKERS * 2, 100))
+        print(f"🪝 Вебхук: {WEBHOOK_URL}")
+
+def run_webhook():
+    """Принимать обновления встроенным сервером Flask - только для локальной работы
+
+    На сервере вебхук обслуживает gunicorn (bot_webhook.py).
+    """
+    register_webhook()
+    print("⚠️ Сервер разработки Flask; на сервере запускайте gunicorn bot_webhook:app")
+    create_webhook().run(host=WEBHOOK_HOST, port=WEBHOOK_PORT, threaded=True)
+
+# ==================== ОТПРАВКА РИСУНКОВ ====================
+
+# Рисунок уходит в Telegram JPEG-превью: PNG с прозрачностью Telegram показал бы на черном
+PHOTO_RENDITION = rendition_key(*TELEGRAM_PHOTO)
+
+_file_ids = None
+
+def get_file_ids():
+    """Кэш file_id (database/file_ids.py), база открывается при первой отправке"""
+    global _file_ids
+    if _file_ids is None:
+        _file_ids = FileIdCache(FILE_IDS_DATABASE)
+    return _file_ids
+
+def photo_version(filename):
+    """(путь к исходнику на этом сервере или None, версия для кэша file_id)
+
+    Исходник - PNG или журнал штрихов: для версии нужен только stat, растр
+    из штрихов строит ensure_rendition, когда файл действительно отправляется.
+    """
+    source = source_path(UPLOAD_FOLDER, filename)
+    return source, source_version(filename, source)
+
+def cached_photo_id(filename):
+    """file_id рисунка, если он уже отправлялся и файл с тех пор не менялся"""
+    _, version = photo_version(filename)
+    return get_file_ids().get(filename, PHOTO_RENDITION, version)
+
+def send_drawing(chat_id, filename, caption=None, reply_markup=None):
+    """Отправить рисунок фотографией; повторные отправки - по file_id, без загрузки файла"""
+    file_ids = get_file_ids()
+    source, version = photo_version(filename)
+    file_id = file_ids.get(filename, PHOTO_RENDITION, version)
+    if file_id is not None:
+        try:
+            return bot.send_photo(chat_id, file_id, caption=caption, reply_markup=reply_markup)
+        except telebot.apihelper.ApiTelegramException as e:
+            # file_id больше не действует - забываем и загружаем файл заново
+            if e.error_code != 400 or 'file' not in (e.description or '').lower():
+                raise
+            file_ids.invalidate(filename, PHOTO_RENDITION)
+    
+    if source is not None:
+        path = ensure_rendition(UPLOAD_FOLDER, RENDITIONS_FOLDER, filename, *TELEGRAM_PHOTO)
+        with open(path, 'rb') as photo:
+            message = bot.send_photo(chat_id, photo, caption=caption, reply_markup=reply_markup)
+    else:
+        # Файла на этом сервере нет (сегменты, другой сервер) - Telegram скачает превью сам
+        message = bot.send_photo(chat_id, WEBAPP_URL + rendition_url(filename, *TELEGRAM_PHOTO),
+                                 caption=caption, reply_markup=reply_markup)
+    if message.photo:
+        largest = message.photo[-1]
+        file_ids.put(filename, PHOTO_RENDITION, version, largest.file_id, largest.file_unique_id)
+    return message
+
+# ==================== УВЕДОМЛЕНИЯ ====================
+
+def send_notification(chat_id, text, photo=None):
+    """Отправить сообщение из outbox (photo - файл рисунка), переведя ошибки Telegram в понятные Notifier"""
+    try:
+        if photo:
+            send_drawing(chat_id, photo, caption=text)
+        else:
+            bot.send_message(chat_id, text)
+    except telebot.apihelper.ApiTelegramException as e:
+        if e.error_code == 429:
+            raise RetryLater(e.result_json.get('parameters', {}).get('retry_after', 1)) from e
+        if e.error_code in (400, 403):
+            raise Undeliverable(e.description) from e
+        raise
+
+def start_notifier():
+    """Фоновая отправка сводок с ограничением частоты (database/notifications.py)"""
+    notifier = Notifier(NotificationQueue(NOTIFY_DATABASE), send_notification)
+    notifier.start()
+    return notifier
+
 # ==================== ЗАПУСК БОТА ====================
 
 if __name__ == "__main__":
@@ -257,6 +543,11 @@ if __name__ == "__main__":
     print("🌐 Web App доступен по кнопке в меню бота")
     
     try:
-        bot.polling(none_stop=True, interval=0)
+        if NOTIFICATIONS:
+            start_notifier()
+        if BOT_MODE == 'webhook':
+            run_webhook()
+        else:
+            run_polling()
     except Exception as e:
         print(f"❌ Ошибка запуска бота: {e}")
\ No newline at end of file
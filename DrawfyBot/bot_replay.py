@@ -0,0 +1,356 @@
+"""Замер пропускной способности вебхука бота без Telegram
+
+Поднимает заглушку Bot API (и /api/leaderboard для /top) в отдельном процессе,
+запускает вебхук bot.py в этом процессе и отправляет в него обновления: записанные
+(BOT_RECORD_UPDATES=updates.jsonl) или синтетические. Результат - скорость
+приема и скорость обработки (до ответа в заглушку API):
+
+    python bot_replay.py --updates 5000 --threads 8
+    python bot_replay.py --file updates.jsonl --api-latency 50 --workers 16
+    python bot_replay.py --duplicates 0.2       - доля повторных доставок
+    python bot_replay.py --target http://localhost:8443/telegram/webhook  - в уже запущенный бот
+
+С --notify проверяется отправка уведомлений (database/notifications.py):
+события лайков сворачиваются в сводки и уходят в заглушку, которая, как
+Telegram, отвечает 429 при превышении общего лимита и лимита на чат:
+
+    python bot_replay.py --notify 20000 --authors 300
+
+С --photos проверяется отправка рисунков фотографиями и кэш file_id
+(database/file_ids.py): повторные отправки не должны загружать файл, а
+замененный на месте файл - загружаться заново:
+
+    python bot_replay.py --photos 2000 --drawings 100
+"""
+import argparse
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, deque
+
+import requests
+from flask import Flask, jsonify, request
+from werkzeug.serving import make_server
+
+FAKE_TOKEN = '123456:replay'
+
+# Лимиты заглушки в режиме flood: сообщений в секунду на бота и пауза между сообщениями в чат
+FLOOD_GLOBAL = 30
+FLOOD_CHAT_INTERVAL = 0.9
+FLOOD_KEY = 'flood_429'
+# Сколько байт файлов бот загрузил в заглушку (sendPhoto с файлом)
+UPLOAD_BYTES_KEY = 'upload_bytes'
+
+# Тексты синтетических сообщений: команды и кнопки из bot.py
+SYNTHETIC_TEXTS = ['/start', '/gallery', '/shop', '/profile', '/draw', '/top', '/top likes',
+                   '🖼️ Галерея', '🛒 Магазин', '👤 Мой профиль', '❓ Помощь']
+
+
+class FakeTelegram:
+    """Заглушка Bot API: отвечает ok на любой метод и считает вызовы (GET /stats)
+
+    С flood=True sendMessage сверх лимитов Telegram получает 429 с retry_after.
+    """
+
+    def __init__(self, latency=0.0, flood=False):
+        self.latency = latency
+        self.flood = flood
+        self.calls = Counter()
+        self._sent = deque()
+        self._chat_sent = {}
+        self._lock = threading.Lock()
+        self._message_ids = itertools.count(1)
+        self.app = Flask('fake_telegram')
+        self.app.add_url_rule('/bot<token>/<method>', view_func=self.api_method, methods=['GET', 'POST'])
+        self.app.add_url_rule('/api/leaderboard', view_func=self.leaderboard)
+        self.app.add_url_rule('/api/drawings/search', view_func=self.search)
+        self.app.add_url_rule('/stats', view_func=self.stats)
+
+    def api_method(self, token, method):
+        if self.latency:
+            time.sleep(self.latency)
+        params = {**request.args, **request.form, **(request.get_json(silent=True) or {})}
+        if method == 'sendMessage' and self.flood and self._flooded(params.get('chat_id')):
+            with self._lock:
+                self.calls[FLOOD_KEY] += 1
+            return jsonify({'ok': False, 'error_code': 429, 'description': 'Too Many Requests: retry after 1',
+                            'parameters': {'retry_after': 1}}), 429
+        if method == 'sendMessage':
+            result = {'message_id': next(self._message_ids), 'date': int(time.time()),
+                      'chat': {'id': int(params.get('chat_id', 0)), 'type': 'private'},
+                      'text': params.get('text', '')}
+        elif method == 'sendPhoto':
+            number = next(self._message_ids)
+            upload = request.files.get('photo')
+            if upload is not None:
+                with self._lock:
+                    self.calls[UPLOAD_BYTES_KEY] += len(upload.read())
+            result = {'message_id': number, 'date': int(time.time()),
+                      'chat': {'id': int(params.get('chat_id', 0)), 'type': 'private'},
+                      'photo': [{'file_id': f'photo-{number}', 'file_unique_id': f'unique-{number}',
+                                 'width': 640, 'height': 480}]}
+        elif method == 'getMe':
+            result = {'id': 123456, 'is_bot': True, 'first_name': 'Drawfy', 'username': 'drawfy_bot'}
+        else:
+            result = True
+        with self._lock:
+            self.calls[method] += 1
+        return jsonify({'ok': True, 'result': result})
+
+    def _flooded(self, chat_id):
+        now = time.monotonic()
+        with self._lock:
+            while self._sent and self._sent[0] <= now - 1:
+                self._sent.popleft()
+            if len(self._sent) >= FLOOD_GLOBAL or now - self._chat_sent.get(chat_id, -1) < FLOOD_CHAT_INTERVAL:
+                return True
+            self._sent.append(now)
+            self._chat_sent[chat_id] = now
+        return False
+
+    def leaderboard(self):
+        return jsonify({'board': request.args.get('board'), 'top': [], 'me': None})
+
+    def search(self):
+        return jsonify({'success': True, 'drawings': [], 'next_offset': None})
+
+    def stats(self):
+        with self._lock:
+            return jsonify(dict(self.calls))
+
+
+def serve(app, host='127.0.0.1'):
+    """Запустить WSGI-приложение в фоновом потоке. Возвращает базовый URL"""
+    server = make_server(host, 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://{host}:{server.server_port}"
+
+
+def _run_fake(latency, flood, urls):
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = make_server('127.0.0.1', 0, FakeTelegram(latency, flood).app, threaded=True)
+    urls.put(f"http://127.0.0.1:{server.server_port}")
+    server.serve_forever()
+
+
+def start_fake(latency=0.0, flood=False):
+    """Заглушка API в своем процессе - ее работа не делит GIL с ботом. Возвращает URL"""
+    urls = multiprocessing.Queue()
+    multiprocessing.Process(target=_run_fake, args=(latency, flood, urls), daemon=True).start()
+    return urls.get(timeout=30)
+
+
+def import_bot(fake_url, **settings):
+    """Импортировать bot.py, направив его в заглушку (bot.py читает настройки при импорте)"""
+    os.environ.update({'BOT_TOKEN': FAKE_TOKEN, 'TELEGRAM_API_URL': fake_url, 'WEBAPP_URL': fake_url, **settings})
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import bot
+    return bot
+
+
+def bot_calls(fake_url):
+    """Вызовы заглушки: {метод: число}"""
+    return requests.get(f"{fake_url}/stats", timeout=5).json()
+
+
+def wait_for_calls(fake_url, count, timeout):
+    """Дождаться count ответов бота. Возвращает (вызовы, дождались ли)"""
+    deadline = time.monotonic() + timeout
+    while True:
+        calls = bot_calls(fake_url)
+        if sum(value for key, value in calls.items() if key not in (FLOOD_KEY, UPLOAD_BYTES_KEY)) >= count:
+            return calls, True
+        if time.monotonic() > deadline:
+            return calls, False
+        time.sleep(0.05)
+
+
+def synthetic_updates(count, chats=500):
+    """Обновления как от живых пользователей: команды, кнопки и инлайн-запросы"""
+    updates = []
+    for update_id in range(1, count + 1):
+        user = {'id': random.randint(1, chats), 'is_bot': False, 'first_name': 'Художник'}
+        if random.random() < 0.15:
+            updates.append({'update_id': update_id, 'inline_query': {
+                'id': str(update_id), 'from': user, 'query': 'котик', 'offset': ''}})
+        else:
+            updates.append({'update_id': update_id, 'message': {
+                'message_id': update_id, 'date': int(time.time()), 'from': user,
+                'chat': {'id': user['id'], 'type': 'private'}, 'text': random.choice(SYNTHETIC_TEXTS)}})
+    return updates
+
+
+def load_updates(path):
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def post_updates(target, deliveries, threads, secret=None):
+    """Отправить доставки из нескольких потоков. Возвращает (секунд, Counter кодов ответа)"""
+    statuses = Counter()
+    lock = threading.Lock()
+    source = iter(deliveries)
+    headers = {'X-Telegram-Bot-Api-Secret-Token': secret} if secret else {}
+
+    def loop():
+        session = requests.Session()
+        while True:
+            with lock:
+                update = next(source, None)
+            if update is None:
+                return
+            status = session.post(target, json=update, headers=headers, timeout=30).status_code
+            with lock:
+                statuses[status] += 1
+
+    workers = [threading.Thread(target=loop) for _ in range(threads)]
+    started = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return time.perf_counter() - started, statuses
+
+
+def replay_notifications(args):
+    """Волна лайков на рисунки args.authors авторов, две сводки каждому - через заглушку с лимитами"""
+    from database.notifications import LIKE, NotificationQueue, Notifier
+
+    fake_url = start_fake(args.api_latency / 1000, flood=True)
+    bot = import_bot(fake_url, BOT_MODE='webhook')
+    workdir = tempfile.mkdtemp(prefix='drawfy-notify-')
+    try:
+        # Без окна: сводка собирается при каждом проходе отправителя
+        queue = NotificationQueue(os.path.join(workdir, 'notifications.db'), windows={LIKE: 0})
+        notifier = Notifier(queue, bot.send_notification)
+        authors = list(range(1, args.authors + 1))
+        print(f"📬 {args.notify} лайков -> {args.authors} авторов, две волны")
+        started = time.perf_counter()
+        for _ in range(2):
+            queue.add_events([(random.choice(authors), LIKE, random.randint(1, 5), None, 1, None)
+                              for _ in range(args.notify // 2)])
+            # Вторая волна идет в те же чаты: им придется ждать лимита на чат
+            notifier.flush()
+        deadline = time.monotonic() + args.timeout
+        while (queue.counts().get('queued') or queue.counts().get('sending')) and time.monotonic() < deadline:
+            time.sleep(0.2)
+            notifier.flush()
+        elapsed = time.perf_counter() - started
+        counts = queue.counts()
+        calls = bot_calls(fake_url)
+        print(f"  отправлено: {counts.get('sent', 0)} сводок за {elapsed:.2f} с "
+              f"({counts.get('sent', 0) / elapsed:.1f} сообщений/с)")
+        print(f"  ответов 429: {calls.get(FLOOD_KEY, 0)}, очередь: {counts}")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def replay_photos(args):
+    """args.photos отправок args.drawings рисунков; на середине часть файлов заменяется на месте"""
+    from PIL import Image
+
+    workdir = tempfile.mkdtemp(prefix='drawfy-photos-')
+    try:
+        uploads = os.path.join(workdir, 'drawings')
+        os.makedirs(uploads)
+        filenames = [f'drawing_{n}.png' for n in range(args.drawings)]
+
+        def draw(filename):
+            noise = Image.effect_noise((640, 480), random.randint(20, 100)).convert('RGB')
+            noise.save(os.path.join(uploads, filename))
+
+        for filename in filenames:
+            draw(filename)
+        fake_url = start_fake(args.api_latency / 1000)
+        bot = import_bot(fake_url, BOT_MODE='webhook', UPLOAD_FOLDER=uploads,
+                         RENDITIONS_FOLDER=os.path.join(workdir, 'renditions'),
+                         FILE_IDS_DATABASE=os.path.join(workdir, 'file_ids.db'))
+        replaced = filenames[:max(1, args.drawings // 10)]
+        print(f"🖼️ {args.photos} отправок {args.drawings} рисунков, {len(replaced)} заменяются на середине")
+        started = time.perf_counter()
+        for n in range(args.photos):
+            if n == args.photos // 2:
+                # Время изменения должно отличаться и на ФС с грубыми отметками
+                time.sleep(0.01)
+                for filename in replaced:
+                    draw(filename)
+            bot.send_drawing(random.randint(1, 1000), random.choice(filenames), caption='🎨')
+        elapsed = time.perf_counter() - started
+        calls = bot_calls(fake_url)
+        stats = bot.get_file_ids().stats()
+        print(f"  отправлено: {calls.get('sendPhoto', 0)} фото за {elapsed:.2f} с "
+              f"({calls.get('sendPhoto', 0) / elapsed:.1f} фото/с)")
+        print(f"  загружено файлов: {stats['uploads']}, {calls.get(UPLOAD_BYTES_KEY, 0) / 1024:.0f} КБ; "
+              f"по file_id: {stats['hits']}, устарело: {stats['stale']}, попаданий {100 * stats['hit_rate']:.1f}%")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Повтор обновлений Telegram в вебхук бота')
+    parser.add_argument('--file', help='JSONL с обновлениями (BOT_RECORD_UPDATES); без него - синтетические')
+    parser.add_argument('--updates', type=int, default=2000, help='Сколько синтетических обновлений')
+    parser.add_argument('--duplicates', type=float, default=0.0, help='Доля обновлений, доставляемых повторно')
+    parser.add_argument('--threads', type=int, default=8, help='Параллельных отправителей')
+    parser.add_argument('--workers', type=int, default=None, help='Потоков обработчиков в боте (BOT_WORKERS)')
+    parser.add_argument('--api-latency', type=float, default=0, help='Задержка ответа заглушки API, мс')
+    parser.add_argument('--target', help='URL вебхука уже запущенного бота (вместо запуска в процессе)')
+    parser.add_argument('--timeout', type=float, default=120)
+    parser.add_argument('--notify', type=int, default=0, help='Проверить уведомления: сколько событий лайков')
+    parser.add_argument('--authors', type=int, default=300, help='Авторов в проверке уведомлений')
+    parser.add_argument('--photos', type=int, default=0, help='Проверить кэш file_id: сколько отправок рисунков')
+    parser.add_argument('--drawings', type=int, default=100, help='Разных рисунков в проверке кэша file_id')
+    args = parser.parse_args()
+    # Журнал запросов dev-сервера werkzeug сам по себе становится узким местом
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    if args.notify:
+        replay_notifications(args)
+        return
+    if args.photos:
+        replay_photos(args)
+        return
+
+    updates = load_updates(args.file) if args.file else synthetic_updates(args.updates)
+    deliveries = updates + random.sample(updates, int(len(updates) * args.duplicates))
+    random.shuffle(deliveries)
+
+    secret = None
+    if args.target:
+        target = args.target
+    else:
+        fake_url = start_fake(args.api_latency / 1000)
+        settings = {'BOT_MODE': 'webhook', 'WEBHOOK_SECRET': 'replay'}
+        if args.workers:
+            settings['BOT_WORKERS'] = str(args.workers)
+        bot = import_bot(fake_url, **settings)
+        secret = bot.WEBHOOK_SECRET
+        webhook_url = serve(bot.create_webhook())
+        target = webhook_url + bot.WEBHOOK_PATH
+
+    print(f"📨 {len(updates)} обновлений ({len(deliveries) - len(updates)} повторов) -> {target}")
+    started = time.perf_counter()
+    seconds, statuses = post_updates(target, deliveries, args.threads, secret)
+    print(f"  прием:     {len(deliveries) / seconds:>10.1f} доставок/с  (ответы: {dict(statuses)})")
+    if args.target:
+        return
+    calls, done = wait_for_calls(fake_url, len(updates), args.timeout)
+    elapsed = time.perf_counter() - started
+    total = sum(calls.values())
+    print(f"  обработка: {total / elapsed:>10.1f} обновлений/с  "
+          f"({total} ответов бота за {elapsed:.2f} с{'' if done else ', не дождались всех'})")
+    print(f"  вызовы API: {calls}")
+    headers = {'X-Telegram-Bot-Api-Secret-Token': secret} if secret else {}
+    metrics = requests.get(f'{webhook_url}/telegram/metrics', headers=headers, timeout=5).json()
+    print(f"  диспетчер: {metrics}")
+
+
+if __name__ == '__main__':
+    main()
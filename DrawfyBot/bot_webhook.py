@@ -0,0 +1,21 @@
+"""WSGI-приложение вебхука бота Drawfy для gunicorn
+
+    gunicorn bot_webhook:app --workers 1 --threads 16 --bind 0.0.0.0:$PORT
+
+В Procfile вместо опроса (BOT_MODE=webhook, WEBHOOK_URL, WEBHOOK_SECRET):
+
+    worker: gunicorn bot_webhook:app --workers 1 --threads 16
+
+Процесс должен быть один и без --preload: повторы update_id, очередь
+диспетчера и порядок обновлений одного чата живут в памяти процесса,
+а потоки обработчиков и уведомлений запускаются при импорте.
+python bot.py с BOT_MODE=webhook поднимает тот же вебхук сервером
+разработки Flask - для локальной работы.
+"""
+from bot import NOTIFICATIONS, create_webhook, register_webhook, start_notifier
+
+register_webhook()
+if NOTIFICATIONS:
+    start_notifier()
+
+app = create_webhook()
@@ -0,0 +1,60 @@
+import atexit
+import os
+import threading
+
+
+class PeriodicFlusher:
+    """Фоновый поток, который раз в interval секунд вызывает flush()
+
+    Поток запускается лениво при первом использовании, то есть уже внутри
+    воркера gunicorn после fork. При выходе процесса делается последний flush.
+    Дочерний процесс после fork сбрасывает унаследованный буфер (after_fork),
+    иначе одни и те же данные записал бы и родитель, и каждый воркер.
+    """
+
+    name = 'flusher'
+    # Последний flush при выходе процесса (не нужен, если flush только читает)
+    flush_at_exit = True
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+        os.register_at_fork(after_in_child=self.after_fork)
+
+    def start(self):
+        """Запустить поток в текущем процессе, если он еще не запущен"""
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+            self._thread.start()
+            self._pid = os.getpid()
+            if self.flush_at_exit:
+                atexit.register(self._flush_safely)
+
+    def wake(self):
+        """Сбросить накопленное, не дожидаясь интервала"""
+        self._wakeup.set()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            self._flush_safely()
+
+    def _flush_safely(self):
+        try:
+            self.flush()
+        except Exception as e:
+            print(f"❌ Ошибка фоновой записи ({self.name}): {e}")
+
+    def flush(self):
+        raise NotImplementedError
+
+    def after_fork(self):
+        """Сбросить буфер, унаследованный от родительского процесса"""
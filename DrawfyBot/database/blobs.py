@@ -0,0 +1,155 @@
+# Файлы рисунков адресуются содержимым: имя - sha256 байтов (database/uploads.py).
+# blobs хранит размер файла и число рисунков, которые на него ссылаются;
+# refcount ведут триггеры на drawings, файл с refcount = 0 удаляет manage.py gc-blobs.
+import os
+import shutil
+import tempfile
+import time
+
+from database.layout import drawing_path, iter_drawing_files, sharded_path
+from database.renditions import RENDITION_WIDTHS, SAVE_OPTIONS
+from database.strokes import strokes_filename
+from database.uploads import content_filename, file_digest, is_content_addressed
+
+# Файл моложе этого (с) сборщик не удаляет
+GC_GRACE = 60 * 60
+
+TRIGGERS = [
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_blobs_drawing_insert AFTER INSERT ON drawings
+    BEGIN
+        UPDATE blobs SET refcount = refcount + 1 WHERE filename = NEW.filename;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_blobs_drawing_delete AFTER DELETE ON drawings
+    BEGIN
+        UPDATE blobs SET refcount = refcount - 1 WHERE filename = OLD.filename;
+    END
+    ''',
+]
+
+
+def create_blobs(cursor):
+    """Таблица blobs и триггеры счетчика ссылок"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS blobs (
+            filename TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            refcount INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        ) WITHOUT ROWID
+    ''')
+    for statement in TRIGGERS:
+        cursor.execute(statement)
+
+
+def register_blob(cursor, filename, size):
+    """Запись о файле (если ее нет); ссылку добавит триггер при вставке рисунка"""
+    cursor.execute('INSERT OR IGNORE INTO blobs (filename, size) VALUES (?, ?)', (filename, size))
+
+
+def rename_blob_references(cursor, old, new, size):
+    """Перевести рисунки со старого имени файла на новое. Возвращает число рисунков"""
+    register_blob(cursor, new, size)
+    cursor.execute('UPDATE drawings SET filename = ? WHERE filename = ?', (new, old))
+    moved = cursor.rowcount
+    if moved:
+        cursor.execute('UPDATE blobs SET refcount = refcount + ? WHERE filename = ?', (moved, new))
+        cursor.execute('UPDATE blobs SET refcount = refcount - ? WHERE filename = ?', (moved, old))
+    return moved
+
+
+def rehash_drawings(storage, upload_folder, renditions_folder):
+    """Переименовать старые файлы рисунков по их sha256. Возвращает (файлов, рисунков)
+
+    Каждый шаг повторяем: новое имя создается жесткой ссылкой (или копией),
+    затем ссылки рисунков переводятся в базе, и только после этого старый
+    файл удаляется - прерванную миграцию можно просто запустить еще раз.
+    """
+    files = drawings = 0
+    for filename, path in list(iter_drawing_files(upload_folder)):
+        if is_content_addressed(filename):
+            continue
+        digest, size = file_digest(path)
+        new_filename = content_filename(digest)
+        _link(path, drawing_path(upload_folder, new_filename) or sharded_path(upload_folder, new_filename))
+        drawings += storage.rename_drawing_file(filename, new_filename, size)
+        _move_renditions(renditions_folder, filename, new_filename)
+        os.remove(path)
+        files += 1
+    return files, drawings
+
+
+def collect_garbage(storage, upload_folder, renditions_folder, grace=GC_GRACE, packs=None):
+    """Удалить файлы, на которые не ссылается ни один рисунок. Возвращает число файлов
+
+    Файлы, записанные или повторно загруженные меньше grace секунд назад,
+    остаются: ссылка на них может быть еще не записана в базу.
+    Записи в сегментах packs удаляются из индекса (место освободит compact-packs).
+    """
+    cutoff = time.time() - grace
+
+    def remove(filename):
+        if packs is not None:
+            stored_at = packs.stored_at(filename)
+            if stored_at is not None:
+                if stored_at > cutoff:
+                    return False
+                packs.delete(filename)
+        # У рисунка из штрихов два файла: журнал и построенный по нему PNG
+        paths = [drawing_path(upload_folder, name) for name in (filename, strokes_filename(filename))]
+        paths = [path for path in paths if path is not None]
+        try:
+            if any(os.stat(path).st_mtime > cutoff for path in paths):
+                return False
+        except FileNotFoundError:
+            pass
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        _remove_renditions(renditions_folder, filename)
+        return True
+
+    return storage.delete_unreferenced_blobs(remove)
+
+
+def _link(source, target):
+    """Второе имя файла: жесткая ссылка, а если ФС не умеет - атомарная копия"""
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    try:
+        os.link(source, target)
+    except FileExistsError:
+        pass
+    except OSError:
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(target), prefix='.upload-', suffix='.part')
+        os.close(fd)
+        shutil.copyfile(source, temp_path)
+        os.replace(temp_path, target)
+
+
+def _rendition_paths(renditions_folder, filename):
+    stem = os.path.splitext(filename)[0]
+    for width in RENDITION_WIDTHS:
+        for fmt in SAVE_OPTIONS:
+            yield os.path.join(renditions_folder, str(width), f"{stem}.{fmt}"), width, fmt
+
+
+def _move_renditions(renditions_folder, old, new):
+    new_stem = os.path.splitext(new)[0]
+    for path, width, fmt in _rendition_paths(renditions_folder, old):
+        if not os.path.exists(path):
+            continue
+        target = os.path.join(renditions_folder, str(width), f"{new_stem}.{fmt}")
+        if os.path.exists(target):
+            os.remove(path)
+        else:
+            os.replace(path, target)
+
+
+def _remove_renditions(renditions_folder, filename):
+    for path, _, _ in _rendition_paths(renditions_folder, filename):
+        if os.path.exists(path):
+            os.remove(path)
@@ -0,0 +1,108 @@
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+# Прагмы для каждого нового соединения.
+# WAL позволяет читателям не ждать писателя, synchronous=NORMAL в режиме WAL
+# безопасен для целостности и экономит fsync на каждом коммите.
+DEFAULT_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'cache_size': -16000,        # ~16MB кэша страниц на соединение
+    'mmap_size': 128 * 1024 * 1024,
+    'busy_timeout': 5000,        # мс ожидания блокировки записи
+    'temp_store': 'MEMORY',
+}
+
+
+class ConnectionPool:
+    """Долгоживущие соединения SQLite: одно на поток (и на процесс)
+
+    Соединение открывается при первом обращении из потока и переиспользуется
+    всеми последующими запросами этого потока. После fork (gunicorn) дочерний
+    процесс не трогает унаследованные соединения и открывает свои.
+    """
+
+    def __init__(self, db_path, pragmas=None, pooled=True):
+        self.db_path = db_path
+        self.pragmas = dict(DEFAULT_PRAGMAS if pragmas is None else pragmas)
+        self.pooled = pooled
+        self._local = threading.local()
+        self._pid = os.getpid()
+
+    def _connect(self):
+        """Открыть соединение и применить прагмы"""
+        conn = sqlite3.connect(self.db_path, timeout=self.pragmas.get('busy_timeout', 5000) / 1000)
+        conn.row_factory = sqlite3.Row
+        if self.pooled:
+            for name, value in self.pragmas.items():
+                conn.execute(f'PRAGMA {name} = {value}')
+        return conn
+
+    def _state(self):
+        """Состояние текущего потока (сбрасывается после fork)"""
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._local = threading.local()
+        if not hasattr(self._local, 'depth'):
+            self._local.conn = None
+            self._local.depth = 0
+        return self._local
+
+    def get(self):
+        """Соединение текущего потока"""
+        state = self._state()
+        if state.conn is None:
+            state.conn = self._connect()
+        return state.conn
+
+    @contextmanager
+    def connection(self, immediate=False):
+        """Контекст работы с БД: коммит при успехе, откат при ошибке
+
+        Вложенные блоки используют ту же транзакцию, коммитит только внешний.
+        immediate=True сразу берет блокировку записи (BEGIN IMMEDIATE).
+        """
+        state = self._state()
+        conn = self.get()
+        outermost = state.depth == 0
+        if outermost and immediate and not conn.in_transaction:
+            conn.execute('BEGIN IMMEDIATE')
+        state.depth += 1
+        try:
+            yield conn
+            if outermost:
+                conn.commit()
+        except BaseException:
+            if outermost:
+                conn.rollback()
+            raise
+        finally:
+            state.depth -= 1
+            if outermost and not self.pooled:
+                conn.close()
+                state.conn = None
+
+    def close(self):
+        """Закрыть соединение текущего потока"""
+        state = self._state()
+        if state.conn is not None:
+            state.conn.close()
+            state.conn = None
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(db_path, pooled=None):
+    """Общий пул для файла базы данных (один на путь в процессе)"""
+    if pooled is None:
+        pooled = os.environ.get('DB_POOL', '1') != '0'
+    key = os.path.abspath(db_path)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = _pools[key] = ConnectionPool(db_path, pooled=pooled)
+        return pool
@@ -0,0 +1,45 @@
+from database.schema import COUNTERS, table_exists
+
+# Сколько рисунков проверять за один проход (короткие блокировки записи)
+RECONCILE_BATCH = 5000
+
+
+def _sources():
+    """Пары (таблица-источник, колонка-счетчик в drawings)"""
+    # Старый счетчик drawings.likes считается так же, как like_count
+    return list(COUNTERS.items()) + [('likes', 'likes')]
+
+
+def reconcile_range(cursor, first_id, last_id):
+    """Исправить счетчики рисунков с id в [first_id, last_id]. Возвращает {колонка: строк}"""
+    fixed = {}
+    for table, column in _sources():
+        if not table_exists(cursor, table):
+            continue
+        cursor.execute(f'''
+            UPDATE drawings
+            SET {column} = (SELECT COUNT(*) FROM {table} t WHERE t.drawing_id = drawings.id)
+            WHERE id BETWEEN ? AND ?
+              AND {column} IS NOT (SELECT COUNT(*) FROM {table} t WHERE t.drawing_id = drawings.id)
+        ''', (first_id, last_id))
+        fixed[column] = fixed.get(column, 0) + cursor.rowcount
+    return fixed
+
+
+def reconcile_batches(cursor, batch=RECONCILE_BATCH):
+    """Диапазоны id для пересчета пачками"""
+    cursor.execute('SELECT COALESCE(MIN(id), 0), COALESCE(MAX(id), 0) FROM drawings')
+    first, last = cursor.fetchone()
+    return [(start, min(start + batch - 1, last)) for start in range(first, last + 1, batch)]
+
+
+def reconcile_counters(cursor, batch=RECONCILE_BATCH):
+    """Пересчитать like_count, comment_count и likes по таблицам-источникам
+
+    Обновляются только разошедшиеся строки. Возвращает {колонка: исправлено строк}.
+    """
+    fixed = {}
+    for first_id, last_id in reconcile_batches(cursor, batch):
+        for column, count in reconcile_range(cursor, first_id, last_id).items():
+            fixed[column] = fixed.get(column, 0) + count
+    return fixed
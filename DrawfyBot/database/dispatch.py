@@ -0,0 +1,161 @@
+import threading
+import time
+from collections import deque
+
+# Потоков-обработчиков и сколько обновлений может ждать их в очереди
+DISPATCH_WORKERS = 8
+MAX_PENDING = 1000
+# Сколько последних замеров держать для перцентилей
+LATENCY_SAMPLES = 10000
+
+# Поля обновления, в которых есть сообщение с чатом
+MESSAGE_FIELDS = ('message', 'edited_message', 'channel_post', 'edited_channel_post')
+
+
+def chat_key(update):
+    """Ключ очереди обновления: чат сообщения, иначе отправитель, иначе само обновление"""
+    for field in MESSAGE_FIELDS:
+        message = update.get(field)
+        if message:
+            return message['chat']['id']
+    callback = update.get('callback_query')
+    if callback and callback.get('message'):
+        return callback['message']['chat']['id']
+    for value in update.values():
+        if isinstance(value, dict) and isinstance(value.get('from'), dict):
+            return value['from']['id']
+    # Без чата и отправителя упорядочивать не с чем
+    return ('update', update.get('update_id'))
+
+
+def percentile(samples, fraction):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+class DispatchMetrics:
+    """Счетчики диспетчера: глубина очереди, ожидание в очереди и время обработчика"""
+
+    def __init__(self, samples=LATENCY_SAMPLES):
+        self._lock = threading.Lock()
+        self.submitted = self.handled = self.failed = self.rejected = 0
+        self.depth = self.max_depth = 0
+        self._wait = deque(maxlen=samples)
+        self._latency = deque(maxlen=samples)
+
+    def queued(self, depth):
+        with self._lock:
+            self.submitted += 1
+            self.depth = depth
+            self.max_depth = max(self.max_depth, depth)
+
+    def rejected_one(self):
+        with self._lock:
+            self.rejected += 1
+
+    def done(self, depth, wait, latency, failed):
+        with self._lock:
+            self.handled += 1
+            self.failed += failed
+            self.depth = depth
+            self._wait.append(wait)
+            self._latency.append(latency)
+
+    def snapshot(self):
+        """Счетчики и перцентили (мс) последних LATENCY_SAMPLES обновлений"""
+        with self._lock:
+            wait, latency = list(self._wait), list(self._latency)
+            result = {'submitted': self.submitted, 'handled': self.handled, 'failed': self.failed,
+                      'rejected': self.rejected, 'queue_depth': self.depth, 'max_queue_depth': self.max_depth}
+        for name, samples in (('wait', wait), ('handler', latency)):
+            for label, fraction in (('p50', 0.5), ('p95', 0.95), ('p99', 0.99)):
+                value = percentile(samples, fraction)
+                result[f'{name}_{label}_ms'] = round(value * 1000, 2) if value is not None else None
+        return result
+
+
+class ChatDispatcher:
+    """Параллельная обработка обновлений разных чатов, строго по порядку внутри чата
+
+    У каждого чата своя очередь; чат с ожидающими обновлениями стоит в общей
+    очереди готовых. Поток берет чат, обрабатывает одно его обновление и, если
+    в чате есть еще, ставит его в конец очереди готовых - один чат никогда не
+    обрабатывается двумя потоками сразу, а медленный чат не задерживает остальные.
+    Всего ожидать может не больше max_pending обновлений: дальше submit либо
+    ждет места (опрос Telegram), либо сразу возвращает False (вебхук отвечает 503).
+    """
+
+    def __init__(self, handler, workers=DISPATCH_WORKERS, max_pending=MAX_PENDING, key=chat_key):
+        self.handler = handler
+        self.max_pending = max_pending
+        self.key = key
+        self.metrics = DispatchMetrics()
+        self._lock = threading.Lock()
+        self._not_full = threading.Condition(self._lock)
+        self._ready = threading.Condition(self._lock)
+        self._idle = threading.Condition(self._lock)
+        # ключ чата -> очередь (обновление, время постановки); ключ есть, пока чат в работе
+        self._chats = {}
+        self._runnable = deque()
+        self._pending = 0
+        self._threads = [threading.Thread(target=self._run, name=f'dispatch-{n}', daemon=True)
+                         for n in range(workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, update, block=False, timeout=None):
+        """Поставить обновление в очередь его чата. False - очередь заполнена"""
+        key = self.key(update)
+        with self._lock:
+            if self._pending >= self.max_pending and not (
+                    block and self._not_full.wait_for(lambda: self._pending < self.max_pending, timeout)):
+                self.metrics.rejected_one()
+                return False
+            queue = self._chats.get(key)
+            if queue is None:
+                queue = self._chats[key] = deque()
+                self._runnable.append(key)
+                self._ready.notify()
+            queue.append((update, time.perf_counter()))
+            self._pending += 1
+            self.metrics.queued(self._pending)
+        return True
+
+    def depth(self):
+        """Сколько обновлений ждут обработки или обрабатываются"""
+        with self._lock:
+            return self._pending
+
+    def join(self, timeout=None):
+        """Дождаться обработки всего принятого. False - не дождались"""
+        with self._lock:
+            return self._idle.wait_for(lambda: self._pending == 0, timeout)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                self._ready.wait_for(lambda: self._runnable)
+                key = self._runnable.popleft()
+                update, queued_at = self._chats[key].popleft()
+            started = time.perf_counter()
+            failed = False
+            try:
+                self.handler(update)
+            except Exception as e:
+                failed = True
+                print(f"❌ Ошибка обработки обновления {update.get('update_id')}: {e}")
+            finished = time.perf_counter()
+            with self._lock:
+                self._pending -= 1
+                if self._chats[key]:
+                    self._runnable.append(key)
+                    self._ready.notify()
+                else:
+                    del self._chats[key]
+                self._not_full.notify()
+                if self._pending == 0:
+                    self._idle.notify_all()
+                depth = self._pending
+            self.metrics.done(depth, started - queued_at, finished - started, failed)
@@ -0,0 +1,116 @@
+import os
+
+from database.connection import get_pool
+from database.uploads import is_content_addressed
+
+# Файл, который Telegram уже получил, можно отправлять повторно по file_id
+# без загрузки байтов. Ключ - имя файла рисунка и вид (превью '640.jpg'),
+# версия - размер и время изменения исходника: если файл со старым именем
+# заменили на месте, запись устаревает. Файлы, названные по содержимому,
+# не меняются, и версия у них пустая.
+ORIGINAL = 'original'
+
+COUNTERS = ('hits', 'misses', 'stale', 'uploads')
+
+
+def rendition_key(width, fmt):
+    """Вид файла в ключе кэша: '640.jpg'"""
+    return f'{width}.{fmt}'
+
+
+def source_version(filename, path):
+    """Версия исходника рисунка; '' - файл не меняется или недоступен этому процессу"""
+    if path is None or is_content_addressed(filename):
+        return ''
+    stat = os.stat(path)
+    return f'{stat.st_size}:{stat.st_mtime_ns}'
+
+
+class FileIdCache:
+    """file_id Telegram для файлов рисунков в отдельной базе SQLite
+
+    Как очередь уведомлений, это база процесса бота на сервере, а не
+    хранилище приложения. Счетчики попаданий хранятся в той же базе,
+    чтобы manage.py file-ids мог показать долю попаданий за все время.
+    """
+
+    def __init__(self, db_path):
+        self.pool = get_pool(db_path)
+        with self.pool.connection() as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS telegram_files (
+                    filename TEXT NOT NULL,
+                    rendition TEXT NOT NULL,
+                    version TEXT NOT NULL DEFAULT '',
+                    file_id TEXT NOT NULL,
+                    file_unique_id TEXT,
+                    uses INTEGER NOT NULL DEFAULT 0,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (filename, rendition)
+                )
+            ''')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS file_id_counters (
+                    name TEXT PRIMARY KEY,
+                    value INTEGER NOT NULL DEFAULT 0
+                )
+            ''')
+            conn.executemany('INSERT OR IGNORE INTO file_id_counters (name) VALUES (?)',
+                             [(name,) for name in COUNTERS])
+
+    def get(self, filename, rendition, version=''):
+        """file_id или None; запись другой версии удаляется"""
+        with self.pool.connection() as conn:
+            row = conn.execute('SELECT version, file_id FROM telegram_files WHERE filename = ? AND rendition = ?',
+                               (filename, rendition)).fetchone()
+            if row is not None and row['version'] == version:
+                conn.execute('UPDATE telegram_files SET uses = uses + 1 WHERE filename = ? AND rendition = ?',
+                             (filename, rendition))
+                self._count(conn, 'hits')
+                return row['file_id']
+            if row is not None:
+                conn.execute('DELETE FROM telegram_files WHERE filename = ? AND rendition = ?', (filename, rendition))
+                self._count(conn, 'stale')
+            self._count(conn, 'misses')
+        return None
+
+    def put(self, filename, rendition, version, file_id, file_unique_id=None):
+        """Запомнить file_id только что загруженного файла"""
+        with self.pool.connection() as conn:
+            conn.execute('''
+                INSERT OR REPLACE INTO telegram_files (filename, rendition, version, file_id, file_unique_id)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (filename, rendition, version, file_id, file_unique_id))
+            self._count(conn, 'uploads')
+
+    def invalidate(self, filename, rendition=None):
+        """Забыть file_id файла (все виды или один). Возвращает число записей"""
+        with self.pool.connection() as conn:
+            if rendition is None:
+                cursor = conn.execute('DELETE FROM telegram_files WHERE filename = ?', (filename,))
+            else:
+                cursor = conn.execute('DELETE FROM telegram_files WHERE filename = ? AND rendition = ?',
+                                      (filename, rendition))
+        return cursor.rowcount
+
+    def prune(self, exists):
+        """Удалить записи файлов, для которых exists(filename) ложно (переименованы или удалены)"""
+        with self.pool.connection() as conn:
+            filenames = [row[0] for row in conn.execute('SELECT DISTINCT filename FROM telegram_files')]
+        removed = 0
+        for filename in filenames:
+            if not exists(filename):
+                removed += self.invalidate(filename)
+        return removed
+
+    def stats(self):
+        """Записи, счетчики и доля попаданий (hit_rate, None - запросов еще не было)"""
+        with self.pool.connection() as conn:
+            result = dict(conn.execute('SELECT name, value FROM file_id_counters').fetchall())
+            result['entries'] = conn.execute('SELECT COUNT(*) FROM telegram_files').fetchone()[0]
+        lookups = result['hits'] + result['misses']
+        result['hit_rate'] = round(result['hits'] / lookups, 4) if lookups else None
+        return result
+
+    def _count(self, conn, name):
+        conn.execute('UPDATE file_id_counters SET value = value + 1 WHERE name = ?', (name,))
@@ -0,0 +1,39 @@
+# Счетчики поколений для инвалидации кэшей между воркерами.
+# Каждый путь записи увеличивает свое поколение (в SQLite - в той же
+# транзакции, в PostgreSQL - сразу после ее коммита, чтобы строка поколения
+# не блокировала параллельных писателей), а кэш ответа считается
+# действительным, пока поколения не изменились.
+
+# feed  - рисунки и лайки (лента, профили)
+# views - просмотры: пачки пишутся каждые несколько секунд, поэтому от них
+#         зависит только лента, а остальные ответы отдают рисунки без views
+# users - баланс и покупки
+# shop  - каталог магазина
+GENERATIONS = ('feed', 'views', 'users', 'shop')
+
+
+def create_generations(cursor):
+    """Таблица поколений"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS cache_generations (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID
+    ''')
+    cursor.executemany('INSERT OR IGNORE INTO cache_generations (name, value) VALUES (?, 0)',
+                       [(name,) for name in GENERATIONS])
+
+
+def bump_generation(cursor, *names):
+    """Увеличить поколения (вызывать внутри транзакции записи)"""
+    cursor.executemany('''
+        INSERT INTO cache_generations (name, value) VALUES (?, 1)
+        ON CONFLICT (name) DO UPDATE SET value = value + 1
+    ''', [(name,) for name in names])
+
+
+def read_generations(cursor, names):
+    """Текущие значения поколений в порядке names"""
+    cursor.execute('SELECT name, value FROM cache_generations')
+    values = dict(cursor.fetchall())
+    return tuple(values.get(name, 0) for name in names)
@@ -0,0 +1,93 @@
+import io
+
+from PIL import Image, ImageChops
+
+# Ограничения на размер холста
+MAX_DIMENSION = 4096
+MAX_PIXELS = 4096 * 4096
+# Палитра пробуется, если цветов не больше
+PALETTE_COLORS = 256
+
+
+class InvalidImage(ValueError):
+    """Загрузка не является целым PNG допустимого размера"""
+
+
+# Чанки PNG, которые Pillow кладет в info и которые не нужны для показа
+METADATA_KEYS = ('exif', 'icc_profile', 'xmp', 'XML:com.adobe.xmp', 'dpi')
+
+
+def check_header(source, verify=False):
+    """Проверить заголовок PNG: формат и размер холста. Возвращает (ширина, высота)
+
+    Пиксели не читаются, поэтому проверка дешевая и годится для запроса;
+    verify=True дополнительно проверяет весь файл (фоновая обработка).
+    """
+    try:
+        with Image.open(source) as image:
+            if image.format != 'PNG':
+                raise InvalidImage('Ожидается изображение PNG')
+            width, height = image.size
+            if width > MAX_DIMENSION or height > MAX_DIMENSION or width * height > MAX_PIXELS:
+                raise InvalidImage(f'Изображение больше {MAX_DIMENSION}x{MAX_DIMENSION}')
+            if verify:
+                image.verify()
+    except InvalidImage:
+        raise
+    except (OSError, SyntaxError, ValueError, Image.DecompressionBombError) as e:
+        raise InvalidImage('Файл поврежден или не является изображением') from e
+    return width, height
+
+
+def check_image(source):
+    """Убедиться, что файл - целый PNG допустимого размера. Возвращает (ширина, высота)"""
+    return check_header(source, verify=True)
+
+
+def has_metadata(image):
+    """Есть ли в PNG текстовые чанки, EXIF, ICC и прочее, что можно выбросить"""
+    return bool(getattr(image, 'text', None)) or any(key in image.info for key in METADATA_KEYS)
+
+
+def encode_png(image, **options):
+    buffer = io.BytesIO()
+    image.save(buffer, format='PNG', optimize=True, **options)
+    return buffer.getvalue()
+
+
+def palette_candidate(image):
+    """PNG с палитрой, если он без потерь передает картинку; иначе None"""
+    colors = image.getcolors(PALETTE_COLORS)
+    if colors is None:
+        return None
+    quantized = image.quantize(colors=len(colors), method=Image.Quantize.FASTOCTREE, dither=Image.Dither.NONE)
+    # Квантизация обязана быть точной: рисунок не должен меняться ни на пиксель
+    if ImageChops.difference(quantized.convert(image.mode), image).getbbox() is not None:
+        return None
+    return encode_png(quantized)
+
+
+def optimize_image(original):
+    """Перекодировать загруженный PNG (байты): без метаданных, палитра, если цветов мало
+
+    Возвращает байты самого маленького варианта или None, если меньше
+    исходного файла без метаданных ничего не получилось (файл остается как есть).
+    """
+    with Image.open(io.BytesIO(original)) as image:
+        image.load()
+        keep_original = not has_metadata(image)
+        if image.mode not in ('RGB', 'RGBA', 'L', 'LA', 'P'):
+            image = image.convert('RGBA')
+        options = {}
+        if 'transparency' in image.info:
+            options['transparency'] = image.info['transparency']
+        candidates = [encode_png(image, **options)]
+        if image.mode in ('RGB', 'RGBA'):
+            palette = palette_candidate(image)
+            if palette is not None:
+                candidates.append(palette)
+
+    best = min(candidates, key=len)
+    if keep_original and len(original) <= len(best):
+        return None
+    return best
@@ -0,0 +1,132 @@
+import json
+import random
+import time
+
+from database.connection import get_pool
+
+# Статусы задач
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+MAX_ATTEMPTS = 5
+# Повтор после ошибки: RETRY_BASE * 2^(попытка - 1) секунд, не больше RETRY_MAX
+RETRY_BASE = 5
+RETRY_MAX = 15 * 60
+# Задача в работе дольше этого считается брошенной (воркер упал) и выдается снова
+LEASE = 10 * 60
+
+
+def retry_delay(attempts, base=RETRY_BASE, cap=RETRY_MAX):
+    """Пауза перед следующей попыткой (экспоненциально, с разбросом ±20%)"""
+    return min(cap, base * 2 ** (attempts - 1)) * random.uniform(0.8, 1.2)
+
+
+class JobQueue:
+    """Очередь фоновых задач в таблице SQLite
+
+    Веб-воркер только добавляет задачу; процесс jobs_worker.py забирает
+    задачи по одной транзакцией BEGIN IMMEDIATE, так что одну задачу не
+    получат два исполнителя. Очередь лежит рядом с файлами рисунков
+    (на том же сервере), поэтому это отдельная база, а не хранилище приложения.
+    """
+
+    def __init__(self, db_path):
+        self.pool = get_pool(db_path)
+        with self.pool.connection() as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    kind TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'queued',
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    max_attempts INTEGER NOT NULL DEFAULT 5,
+                    run_at REAL NOT NULL,
+                    locked_at REAL,
+                    last_error TEXT,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    finished_at TIMESTAMP
+                )
+            ''')
+            # Выборка следующей задачи: только ожидающие, по времени запуска
+            conn.execute('''
+                CREATE INDEX IF NOT EXISTS idx_jobs_ready ON jobs (run_at, id)
+                WHERE status = 'queued'
+            ''')
+            conn.execute('''
+                CREATE INDEX IF NOT EXISTS idx_jobs_running ON jobs (locked_at)
+                WHERE status = 'running'
+            ''')
+
+    def enqueue(self, kind, payload, delay=0, max_attempts=MAX_ATTEMPTS):
+        """Добавить задачу. Возвращает ее id"""
+        with self.pool.connection() as conn:
+            cursor = conn.execute(
+                'INSERT INTO jobs (kind, payload, run_at, max_attempts) VALUES (?, ?, ?, ?)',
+                (kind, json.dumps(payload), time.time() + delay, max_attempts)
+            )
+            return cursor.lastrowid
+
+    def claim(self, lease=LEASE):
+        """Забрать следующую готовую задачу: dict (id, kind, payload, attempts, ...) или None"""
+        now = time.time()
+        with self.pool.connection(immediate=True) as conn:
+            # Задачи упавших исполнителей возвращаются в очередь
+            conn.execute('''
+                UPDATE jobs SET status = 'queued', locked_at = NULL
+                WHERE status = 'running' AND locked_at < ?
+            ''', (now - lease,))
+            row = conn.execute('''
+                SELECT * FROM jobs
+                WHERE status = 'queued' AND run_at <= ?
+                ORDER BY run_at, id
+                LIMIT 1
+            ''', (now,)).fetchone()
+            if row is None:
+                return None
+            conn.execute('''
+                UPDATE jobs SET status = 'running', locked_at = ?, attempts = attempts + 1
+                WHERE id = ?
+            ''', (now, row['id']))
+
+        job = dict(row)
+        job['payload'] = json.loads(job['payload'])
+        job['attempts'] += 1
+        job['status'] = RUNNING
+        return job
+
+    def complete(self, job_id):
+        """Задача выполнена"""
+        with self.pool.connection() as conn:
+            conn.execute('''
+                UPDATE jobs SET status = 'done', locked_at = NULL, last_error = NULL,
+                                finished_at = CURRENT_TIMESTAMP
+                WHERE id = ?
+            ''', (job_id,))
+
+    def fail(self, job, error, permanent=False):
+        """Попытка не удалась: повтор с паузой или окончательная ошибка. True - будет повтор
+
+        permanent=True - повторять бесполезно (например, файл не является PNG).
+        """
+        retry = not permanent and job['attempts'] < job['max_attempts']
+        with self.pool.connection() as conn:
+            if retry:
+                conn.execute('''
+                    UPDATE jobs SET status = 'queued', locked_at = NULL, last_error = ?, run_at = ?
+                    WHERE id = ?
+                ''', (error, time.time() + retry_delay(job['attempts']), job['id']))
+            else:
+                conn.execute('''
+                    UPDATE jobs SET status = 'failed', locked_at = NULL, last_error = ?,
+                                    finished_at = CURRENT_TIMESTAMP
+                    WHERE id = ?
+                ''', (error, job['id']))
+        return retry
+
+    def counts(self):
+        """Число задач по статусам"""
+        with self.pool.connection() as conn:
+            return dict(conn.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall())
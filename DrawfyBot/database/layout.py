@@ -0,0 +1,101 @@
+import hashlib
+import os
+import re
+import time
+
+# Файлы рисунков раскладываются по двум уровням подпапок: ab/cd/<имя>.
+# 256 * 256 папок - даже миллионы файлов дают десятки файлов на папку.
+# Путь вычисляется по имени, поэтому поиск файла - не больше трех stat.
+SHARD_LEVELS = 2
+SHARD_WIDTH = 2
+
+# Файлов за одну пачку миграции
+SHARD_BATCH = 1000
+
+HEX_STEM = re.compile(r'^[0-9a-f]{64}$')
+
+
+def shard_key(filename):
+    """Шестнадцатеричный ключ для раскладки: sha256 из имени или хэш самого имени"""
+    stem = os.path.splitext(filename)[0]
+    if HEX_STEM.match(stem):
+        return stem
+    # Старые имена (drawing_<user>_<время>.png) распределяются хэшем имени
+    return hashlib.sha256(filename.encode()).hexdigest()
+
+
+def sharded_path(folder, filename):
+    """Путь файла в раскладке по подпапкам"""
+    key = shard_key(filename)
+    parts = [key[i * SHARD_WIDTH:(i + 1) * SHARD_WIDTH] for i in range(SHARD_LEVELS)]
+    return os.path.join(folder, *parts, filename)
+
+
+def drawing_path(folder, filename):
+    """Путь существующего файла рисунка в любой раскладке или None
+
+    Пока идет миграция, файл может лежать и в подпапке, и в общей папке.
+    Подпапка проверяется еще раз: файл мог переехать между двумя проверками.
+    """
+    sharded = sharded_path(folder, filename)
+    if os.path.isfile(sharded):
+        return sharded
+    flat = os.path.join(folder, filename)
+    if os.path.isfile(flat):
+        return flat
+    if os.path.isfile(sharded):
+        return sharded
+    return None
+
+
+def is_drawing_file(name):
+    return name.endswith('.png') and not name.startswith('.')
+
+
+def iter_drawing_files(folder):
+    """(имя, путь) всех файлов рисунков в обеих раскладках"""
+    subfolders = []
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                subfolders.append(entry.path)
+            elif is_drawing_file(entry.name):
+                yield entry.name, entry.path
+    for subfolder in sorted(subfolders):
+        for root, dirs, files in os.walk(subfolder):
+            dirs.sort()
+            for name in sorted(files):
+                if is_drawing_file(name):
+                    yield name, os.path.join(root, name)
+
+
+def shard_drawings(folder, batch=SHARD_BATCH, pause=0.0):
+    """Переложить файлы из общей папки по подпапкам. Возвращает число файлов
+
+    Работает пачками: список очередной пачки читается заново, так что
+    очередью служит сама общая папка - прерванную миграцию можно просто
+    запустить еще раз. Каждый файл переносится атомарным os.replace.
+    """
+    moved = 0
+    while True:
+        names = []
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                if entry.is_file(follow_symlinks=False) and is_drawing_file(entry.name):
+                    names.append(entry.name)
+                    if len(names) >= batch:
+                        break
+        if not names:
+            return moved
+        for name in names:
+            target = sharded_path(folder, name)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            try:
+                os.replace(os.path.join(folder, name), target)
+            except FileNotFoundError:
+                # Файл удалили или перенесли параллельно
+                continue
+            moved += 1
+        print(f"  перенесено {moved}")
+        if pause:
+            time.sleep(pause)
@@ -0,0 +1,133 @@
+import threading
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+
+from database.background import PeriodicFlusher
+from database.ranking import RankedSet
+from database.schema import table_exists
+
+# Доски рейтинга: опыт, все полученные лайки, лайки за последние WEEK_DAYS дней
+BOARDS = ('experience', 'likes', 'weekly')
+WEEK_DAYS = 7
+
+# Лайки авторов по дням - окно для недельной доски. Устаревшие дни удаляет сам триггер
+LIKE_BUCKETS_TRIGGER = f'''
+    CREATE TRIGGER IF NOT EXISTS trg_like_buckets_insert AFTER INSERT ON likes
+    BEGIN
+        INSERT INTO like_buckets (day, user_id, likes)
+        SELECT date(NEW.created_at), user_id, 1 FROM drawings WHERE id = NEW.drawing_id
+        ON CONFLICT (day, user_id) DO UPDATE SET likes = likes + 1;
+        DELETE FROM like_buckets WHERE day < date(NEW.created_at, '-{WEEK_DAYS} days');
+    END
+'''
+
+
+def _today():
+    """Текущий день по UTC - как CURRENT_TIMESTAMP в SQLite"""
+    return datetime.now(timezone.utc).date()
+
+
+def create_leaderboard(cursor):
+    """Таблица дневных корзин лайков и триггер; для существующей базы - заполнить"""
+    created = not table_exists(cursor, 'like_buckets')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS like_buckets (
+            day TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            likes INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, user_id)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute(LIKE_BUCKETS_TRIGGER)
+    if created:
+        cursor.execute(f'''
+            INSERT INTO like_buckets (day, user_id, likes)
+            SELECT date(l.created_at), d.user_id, COUNT(*)
+            FROM likes l JOIN drawings d ON d.id = l.drawing_id
+            WHERE l.created_at >= date('now', '-{WEEK_DAYS - 1} days')
+            GROUP BY date(l.created_at), d.user_id
+        ''')
+
+
+class Leaderboard(PeriodicFlusher):
+    """Рейтинги художников в памяти воркера
+
+    Доски загружаются из базы при первом запросе, затем обновляются
+    инкрементально теми же путями записи, что и загрузка рисунков и лайки.
+    Изменения из других воркеров подтягивает фоновый поток: он пересобирает
+    доски раз в refresh_interval секунд, а при смене дня (недельное окно
+    сдвигается) его будит первый же запрос. Запросы перезагрузки не ждут и
+    отвечают по текущим доскам.
+    """
+
+    name = 'leaderboard'
+    flush_at_exit = False
+
+    def __init__(self, storage, refresh_interval=60):
+        super().__init__(refresh_interval)
+        self.storage = storage
+        self._lock = threading.Lock()
+        self._boards = None
+        self._loaded_day = None
+
+    def after_fork(self):
+        # Доски родителя годятся как есть, заменяется только блокировка
+        self._lock = threading.Lock()
+
+    def reload(self):
+        """Собрать доски заново из базы"""
+        today = _today()
+        since = (today - timedelta(days=WEEK_DAYS - 1)).isoformat()
+        boards = {name: RankedSet() for name in BOARDS}
+
+        for name, scores in self.storage.leaderboard_snapshot(since).items():
+            for user_id, score in scores:
+                boards[name].set(user_id, score)
+
+        with self._lock:
+            self._boards = boards
+            self._loaded_day = today
+
+    def flush(self):
+        self.reload()
+
+    def _fresh(self):
+        """Текущие доски; в запросе загружаются только в первый раз"""
+        self.start()
+        if self._boards is None:
+            self.reload()
+        elif self._loaded_day != _today():
+            self.wake()
+        return self._boards
+
+    def add_experience(self, user_id, experience):
+        """Начислен опыт (загрузка рисунка)"""
+        if self._boards is None:
+            return
+        with self._lock:
+            self._boards['experience'].incr(user_id, experience)
+
+    def add_likes(self, added, experience_per_like):
+        """Записаны лайки [(user_id, drawing_id, author_id), ...]"""
+        if self._boards is None:
+            return
+        per_author = Counter(author_id for _, _, author_id in added if author_id is not None)
+        with self._lock:
+            for author_id, count in per_author.items():
+                self._boards['experience'].incr(author_id, count * experience_per_like)
+                self._boards['likes'].incr(author_id, count)
+                self._boards['weekly'].incr(author_id, count)
+
+    def top(self, board, limit=10, offset=0):
+        """Top-N доски: [{'rank', 'user_id', 'score'}, ...]"""
+        boards = self._fresh()
+        with self._lock:
+            entries = boards[board].top(limit, offset)
+        return [{'rank': offset + i + 1, 'user_id': user_id, 'score': score}
+                for i, (user_id, score) in enumerate(entries)]
+
+    def rank(self, board, user_id):
+        """Место и очки пользователя: {'rank', 'score'} (rank None - пока вне рейтинга)"""
+        boards = self._fresh()
+        with self._lock:
+            return {'rank': boards[board].rank(user_id), 'score': boards[board].score(user_id) or 0}
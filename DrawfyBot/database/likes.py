@@ -0,0 +1,51 @@
+from collections import Counter
+
+from database.generations import bump_generation
+
+# Награда автору за каждый полученный лайк
+LIKE_REWARD = {'experience': 1, 'coins': 1}
+
+
+def has_liked(cursor, user_id, drawing_id):
+    """Ставил ли пользователь лайк рисунку (поиск по уникальному индексу)"""
+    cursor.execute('SELECT 1 FROM likes WHERE user_id = ? AND drawing_id = ?', (user_id, drawing_id))
+    return cursor.fetchone() is not None
+
+
+def record_likes(cursor, likes):
+    """Записать пачку лайков [(user_id, drawing_id), ...] в текущей транзакции
+
+    Повторные лайки пропускаются. Счетчики рисунков и награды авторам
+    сворачиваются: одно UPDATE на рисунок и одно на автора, сколько бы
+    лайков ни пришло. Возвращает список добавленных (user_id, drawing_id, author_id).
+    """
+    added = []
+    for user_id, drawing_id in likes:
+        cursor.execute('INSERT OR IGNORE INTO likes (user_id, drawing_id) VALUES (?, ?)',
+                       (user_id, drawing_id))
+        if cursor.rowcount:
+            added.append((user_id, drawing_id))
+    if not added:
+        return []
+    bump_generation(cursor, 'feed')
+
+    per_drawing = Counter(drawing_id for _, drawing_id in added)
+    cursor.executemany('UPDATE drawings SET likes = likes + ? WHERE id = ?',
+                       [(count, drawing_id) for drawing_id, count in sorted(per_drawing.items())])
+
+    # Авторы рисунков
+    ids = list(per_drawing)
+    cursor.execute(f'SELECT id, user_id FROM drawings WHERE id IN ({",".join("?" * len(ids))})', ids)
+    authors = {row[0]: row[1] for row in cursor.fetchall()}
+
+    per_author = Counter()
+    for drawing_id, count in per_drawing.items():
+        if drawing_id in authors:
+            per_author[authors[drawing_id]] += count
+    cursor.executemany(
+        'UPDATE users SET experience = experience + ?, balance = balance + ? WHERE id = ?',
+        [(count * LIKE_REWARD['experience'], count * LIKE_REWARD['coins'], author_id)
+         for author_id, count in sorted(per_author.items())]
+    )
+
+    return [(user_id, drawing_id, authors.get(drawing_id)) for user_id, drawing_id in added]
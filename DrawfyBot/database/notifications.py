@@ -0,0 +1,319 @@
+import time
+
+from database.background import PeriodicFlusher
+from database.connection import get_pool
+from database.jobs import MAX_ATTEMPTS, retry_delay
+from database.likes import LIKE_REWARD
+from database.schema import add_column
+
+# Виды событий и сколько секунд копить их в одну сводку с первого события:
+# лайки сворачиваются в «ваши рисунки получили 37 лайков», загрузки - почти сразу
+LIKE = 'like'
+UPLOAD = 'upload'
+DIGEST_WINDOWS = {LIKE: 5 * 60, UPLOAD: 5}
+
+# Ограничения Telegram: около 30 сообщений в секунду на бота и не чаще
+# одного в секунду в один чат; берем с запасом. В любую секунду уходит
+# не больше GLOBAL_RATE + GLOBAL_BURST сообщений
+GLOBAL_RATE = 25
+GLOBAL_BURST = 5
+CHAT_RATE = 1
+CHAT_BURST = 1
+
+# Сколько сообщений забирать за раз и на сколько (секунды)
+SEND_BATCH = 100
+LEASE = 5 * 60
+
+
+class RetryLater(Exception):
+    """Telegram просит подождать (429): сообщение отправляется повторно через retry_after секунд"""
+
+    def __init__(self, retry_after):
+        super().__init__(f'retry after {retry_after}s')
+        self.retry_after = retry_after
+
+
+class Undeliverable(Exception):
+    """Сообщение не доставить никогда (бот заблокирован, чат удален) - без повторов"""
+
+
+def plural(n, forms):
+    """plural(5, ('лайк', 'лайка', 'лайков')) -> 'лайков'"""
+    if n % 10 == 1 and n % 100 != 11:
+        return forms[0]
+    if 2 <= n % 10 <= 4 and not 12 <= n % 100 <= 14:
+        return forms[1]
+    return forms[2]
+
+
+def digest_text(kind, events):
+    """Текст сводки по событиям [(drawing_id, title, count), ...] одного вида"""
+    total = sum(count for _, _, count in events)
+    drawings = {drawing_id for drawing_id, _, _ in events}
+    if kind == LIKE:
+        coins = total * LIKE_REWARD['coins']
+        target = 'Ваш рисунок получил' if len(drawings) == 1 else f'Ваши рисунки ({len(drawings)}) получили'
+        return (f"❤️ {target} {total} {plural(total, ('новый лайк', 'новых лайка', 'новых лайков'))}!\n"
+                f"💰 +{coins} {plural(coins, ('монета', 'монеты', 'монет'))}")
+    if kind == UPLOAD:
+        if len(events) == 1:
+            return f"🎨 Рисунок «{events[0][1]}» опубликован в галерее!"
+        return f"🎨 Опубликовано {len(events)} {plural(len(events), ('рисунок', 'рисунка', 'рисунков'))}!"
+    raise ValueError(f'Неизвестный вид уведомления: {kind}')
+
+
+class NotificationQueue:
+    """Исходящие сообщения бота в таблицах SQLite
+
+    Веб-приложение только дописывает события (notify_events). Отправитель
+    (Notifier в процессе бота) сворачивает события одного чата и вида в
+    сводку, когда окно DIGEST_WINDOWS с первого события прошло, кладет ее
+    в outbox и удаляет события - одной транзакцией. Как и очередь задач,
+    это отдельная база на сервере, а не хранилище приложения.
+    """
+
+    def __init__(self, db_path, windows=None):
+        self.pool = get_pool(db_path)
+        self.windows = dict(DIGEST_WINDOWS if windows is None else windows)
+        with self.pool.connection() as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS notify_events (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    chat_id INTEGER NOT NULL,
+                    kind TEXT NOT NULL,
+                    drawing_id INTEGER,
+                    title TEXT,
+                    count INTEGER NOT NULL DEFAULT 1,
+                    filename TEXT,
+                    created_at REAL NOT NULL
+                )
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_notify_events_chat ON notify_events (kind, chat_id, created_at)')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS outbox (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    chat_id INTEGER NOT NULL,
+                    text TEXT NOT NULL,
+                    photo TEXT,
+                    status TEXT NOT NULL DEFAULT 'queued',
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    run_at REAL NOT NULL,
+                    locked_at REAL,
+                    last_error TEXT,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    sent_at TIMESTAMP
+                )
+            ''')
+            conn.execute('''
+                CREATE INDEX IF NOT EXISTS idx_outbox_ready ON outbox (run_at, id)
+                WHERE status = 'queued'
+            ''')
+            # Базы до отправки рисунков фотографиями
+            add_column(conn.cursor(), 'notify_events', 'filename', 'TEXT')
+            add_column(conn.cursor(), 'outbox', 'photo', 'TEXT')
+
+    # ---------- события (веб-приложение) ----------
+
+    def add_events(self, events):
+        """Дописать события [(chat_id, kind, drawing_id, title, count, filename), ...]"""
+        if not events:
+            return
+        now = time.time()
+        with self.pool.connection() as conn:
+            conn.executemany('''
+                INSERT INTO notify_events (chat_id, kind, drawing_id, title, count, filename, created_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', [(*event, now) for event in events])
+
+    # ---------- сводки и отправка (процесс бота) ----------
+
+    def collect_digests(self, now=None):
+        """Свернуть события с истекшим окном в сообщения outbox. Возвращает число сообщений"""
+        now = time.time() if now is None else now
+        created = 0
+        with self.pool.connection(immediate=True) as conn:
+            for kind, window in self.windows.items():
+                chats = [row[0] for row in conn.execute('''
+                    SELECT chat_id FROM notify_events WHERE kind = ?
+                    GROUP BY chat_id HAVING MIN(created_at) <= ?
+                ''', (kind, now - window))]
+                for chat_id in chats:
+                    rows = conn.execute('''
+                        SELECT id, drawing_id, title, count, filename FROM notify_events
+                        WHERE kind = ? AND chat_id = ? ORDER BY id
+                    ''', (kind, chat_id)).fetchall()
+                    text = digest_text(kind, [(row['drawing_id'], row['title'], row['count']) for row in rows])
+                    # Сводка об одном рисунке уходит фотографией с подписью
+                    photo = rows[0]['filename'] if len(rows) == 1 else None
+                    conn.execute('INSERT INTO outbox (chat_id, text, photo, run_at) VALUES (?, ?, ?, ?)',
+                                 (chat_id, text, photo, now))
+                    conn.execute('DELETE FROM notify_events WHERE kind = ? AND chat_id = ? AND id <= ?',
+                                 (kind, chat_id, rows[-1]['id']))
+                    created += 1
+        return created
+
+    def claim(self, limit=SEND_BATCH, lease=LEASE):
+        """Забрать готовые к отправке сообщения [dict(id, chat_id, text, attempts, ...)]"""
+        now = time.time()
+        with self.pool.connection(immediate=True) as conn:
+            # Сообщения упавшего отправителя возвращаются в очередь
+            conn.execute('''
+                UPDATE outbox SET status = 'queued', locked_at = NULL
+                WHERE status = 'sending' AND locked_at < ?
+            ''', (now - lease,))
+            rows = conn.execute('''
+                SELECT * FROM outbox WHERE status = 'queued' AND run_at <= ?
+                ORDER BY run_at, id LIMIT ?
+            ''', (now, limit)).fetchall()
+            conn.executemany("UPDATE outbox SET status = 'sending', locked_at = ? WHERE id = ?",
+                             [(now, row['id']) for row in rows])
+        return [dict(row) for row in rows]
+
+    def sent(self, message_id):
+        with self.pool.connection() as conn:
+            conn.execute('''
+                UPDATE outbox SET status = 'sent', locked_at = NULL, last_error = NULL, sent_at = CURRENT_TIMESTAMP
+                WHERE id = ?
+            ''', (message_id,))
+
+    def defer(self, message, delay, error=None):
+        """Отложить без траты попытки (ограничение частоты, а не ошибка)"""
+        with self.pool.connection() as conn:
+            conn.execute('''
+                UPDATE outbox SET status = 'queued', locked_at = NULL, run_at = ?, last_error = COALESCE(?, last_error)
+                WHERE id = ?
+            ''', (time.time() + delay, error, message['id']))
+
+    def fail(self, message, error, permanent=False):
+        """Попытка не удалась: повтор с паузой или окончательная ошибка. True - будет повтор"""
+        attempts = message['attempts'] + 1
+        retry = not permanent and attempts < MAX_ATTEMPTS
+        with self.pool.connection() as conn:
+            if retry:
+                conn.execute('''
+                    UPDATE outbox SET status = 'queued', locked_at = NULL, attempts = ?, last_error = ?, run_at = ?
+                    WHERE id = ?
+                ''', (attempts, error, time.time() + retry_delay(attempts), message['id']))
+            else:
+                conn.execute('''
+                    UPDATE outbox SET status = 'failed', locked_at = NULL, attempts = ?, last_error = ?,
+                                      sent_at = CURRENT_TIMESTAMP
+                    WHERE id = ?
+                ''', (attempts, error, message['id']))
+        return retry
+
+    def counts(self):
+        """Число сообщений по статусам и ожидающих событий"""
+        with self.pool.connection() as conn:
+            counts = dict(conn.execute('SELECT status, COUNT(*) FROM outbox GROUP BY status').fetchall())
+            counts['events'] = conn.execute('SELECT COUNT(*) FROM notify_events').fetchone()[0]
+        return counts
+
+
+class TokenBucket:
+    """rate жетонов в секунду, не больше burst про запас"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now):
+        """Через сколько секунд будет жетон (0 - есть сейчас)"""
+        self._refill(now)
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def full(self, now):
+        self._refill(now)
+        return self.tokens >= self.burst
+
+
+class RateLimiter:
+    """Общий лимит бота и лимит на каждый чат"""
+
+    # Корзины полных (давно молчавших) чатов выбрасываются, когда их становится больше
+    MAX_CHAT_BUCKETS = 10000
+
+    def __init__(self, global_rate=GLOBAL_RATE, global_burst=GLOBAL_BURST, chat_rate=CHAT_RATE, chat_burst=CHAT_BURST):
+        self.bucket = TokenBucket(global_rate, global_burst)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self._chats = {}
+
+    def chat_delay(self, chat_id, now):
+        bucket = self._chats.get(chat_id)
+        return bucket.delay(now) if bucket is not None else 0
+
+    def take(self, chat_id, now):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= self.MAX_CHAT_BUCKETS:
+                self._chats = {key: value for key, value in self._chats.items() if not value.full(now)}
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        bucket.take(now)
+        self.bucket.take(now)
+
+
+class Notifier(PeriodicFlusher):
+    """Отправитель outbox: раз в interval сворачивает сводки и отправляет готовое
+
+    send(chat_id, text, photo) отправляет сообщение (photo - файл рисунка
+    или None); RetryLater - Telegram просит
+    подождать, Undeliverable - повторять бесполезно, прочие ошибки -
+    повтор с экспоненциальной паузой. Общий лимит выдерживается ожиданием,
+    а сообщение в чат, которому писать пока рано, откладывается.
+    """
+
+    name = 'notifier'
+
+    def __init__(self, queue, send, interval=1.0, limiter=None):
+        super().__init__(interval)
+        self.queue = queue
+        self.send = send
+        self.limiter = limiter or RateLimiter()
+
+    def flush(self):
+        """Отправить все готовые сообщения. Возвращает число отправленных"""
+        self.queue.collect_digests()
+        sent = 0
+        while True:
+            messages = self.queue.claim()
+            if not messages:
+                return sent
+            for message in messages:
+                sent += self._deliver(message)
+
+    def _deliver(self, message):
+        now = time.monotonic()
+        wait = self.limiter.chat_delay(message['chat_id'], now)
+        if wait:
+            self.queue.defer(message, wait)
+            return 0
+        wait = self.limiter.bucket.delay(now)
+        if wait:
+            time.sleep(wait)
+        self.limiter.take(message['chat_id'], time.monotonic())
+        try:
+            self.send(message['chat_id'], message['text'], message['photo'])
+        except RetryLater as e:
+            # Telegram сам сказал, когда можно - ждем это время всем ботом
+            self.limiter.bucket.tokens = -e.retry_after * self.limiter.bucket.rate
+            self.queue.defer(message, e.retry_after, str(e))
+            return 0
+        except Undeliverable as e:
+            self.queue.fail(message, str(e), permanent=True)
+            return 0
+        except Exception as e:
+            self.queue.fail(message, str(e))
+            return 0
+        self.queue.sent(message['id'])
+        return 1
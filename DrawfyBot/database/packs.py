@@ -0,0 +1,272 @@
+import mmap
+import os
+import threading
+import time
+
+from database.connection import get_pool
+from database.layout import drawing_path, iter_drawing_files, sharded_path
+
+# Рисунки дописываются подряд в большие файлы-сегменты; где лежит каждый
+# рисунок (сегмент, смещение, длина) - в индексе SQLite рядом с сегментами.
+# Новый сегмент начинается, когда текущий дорос до SEGMENT_SIZE.
+SEGMENT_SIZE = 256 * 1024 * 1024
+# Сегмент сжимается, когда удаленные записи занимают не меньше этой доли
+COMPACT_RATIO = 0.3
+CHUNK_SIZE = 64 * 1024
+
+INDEX_NAME = 'index.db'
+
+
+class PackStore:
+    """Рисунки в сегментах packs/segment-<N>.pack с индексом в packs/index.db
+
+    Запись идет под блокировкой записи SQLite (BEGIN IMMEDIATE), поэтому
+    писать могут несколько процессов: байты пишутся по смещению, которое
+    записано в индексе, и становятся видны только после коммита. Чтение -
+    срез mmap сегмента без копирования; отображения сегментов живут в
+    процессе и переоткрываются, когда сегмент вырос.
+    """
+
+    def __init__(self, folder, segment_size=SEGMENT_SIZE):
+        self.folder = folder
+        self.segment_size = segment_size
+        os.makedirs(folder, exist_ok=True)
+        self.pool = get_pool(os.path.join(folder, INDEX_NAME))
+        self._maps = {}
+        self._maps_lock = threading.Lock()
+        self._pid = os.getpid()
+        with self.pool.connection(immediate=True) as conn:
+            # AUTOINCREMENT: номер удаленного при сжатии сегмента не выдается снова,
+            # иначе воркер со старым mmap под тем же номером отдал бы байты старого файла
+            row = conn.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'pack_segments'").fetchone()
+            # Индекс, созданный без AUTOINCREMENT, переписывается в новую таблицу
+            migrate = row is not None and 'AUTOINCREMENT' not in row[0].upper()
+            if migrate:
+                conn.execute('ALTER TABLE pack_segments RENAME TO pack_segments_old')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS pack_segments (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    size INTEGER NOT NULL DEFAULT 0,
+                    dead INTEGER NOT NULL DEFAULT 0
+                )
+            ''')
+            if migrate:
+                conn.execute('INSERT INTO pack_segments (id, size, dead) SELECT id, size, dead FROM pack_segments_old')
+                conn.execute('DROP TABLE pack_segments_old')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS pack_entries (
+                    filename TEXT PRIMARY KEY,
+                    segment INTEGER NOT NULL,
+                    offset INTEGER NOT NULL,
+                    length INTEGER NOT NULL,
+                    stored_at REAL NOT NULL
+                ) WITHOUT ROWID
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_pack_entries_segment ON pack_entries (segment, offset)')
+
+    def segment_path(self, segment):
+        return os.path.join(self.folder, f"segment-{segment:06d}.pack")
+
+    # ---------- чтение ----------
+
+    def get(self, filename):
+        """Содержимое рисунка (memoryview на mmap сегмента) или None"""
+        # Вторая попытка - если сегмент только что сжат и запись уже переехала
+        for attempt in range(2):
+            with self.pool.connection() as conn:
+                row = conn.execute('SELECT segment, offset, length FROM pack_entries WHERE filename = ?',
+                                   (filename,)).fetchone()
+            if row is None:
+                return None
+            segment, offset, length = row
+            try:
+                mapped = self._map(segment, offset + length)
+            except FileNotFoundError:
+                continue
+            return memoryview(mapped)[offset:offset + length]
+        # Файла сегмента нет совсем - рисунок считается отсутствующим
+        print(f"❌ Нет файла сегмента {self.segment_path(segment)} для {filename}")
+        return None
+
+    def stored_at(self, filename):
+        """Время записи (или повторной загрузки) рисунка, None - рисунка нет"""
+        with self.pool.connection() as conn:
+            row = conn.execute('SELECT stored_at FROM pack_entries WHERE filename = ?', (filename,)).fetchone()
+        return row[0] if row else None
+
+    def _map(self, segment, end):
+        """mmap сегмента, покрывающий байты до end"""
+        with self._maps_lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._maps = {}
+            mapped = self._maps.get(segment)
+            if mapped is None or len(mapped) < end:
+                # Старое отображение не закрывается: на него могут ссылаться
+                # отдаваемые сейчас ответы, оно освободится вместе с ними
+                with open(self.segment_path(segment), 'rb') as f:
+                    mapped = self._maps[segment] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            return mapped
+
+    # ---------- запись ----------
+
+    def put_file(self, filename, path):
+        """Дописать файл в сегмент. False - рисунок уже был (отмечается как новый для gc-blobs)"""
+        size = os.path.getsize(path)
+        with open(path, 'rb') as source:
+            return self._put(filename, size, lambda: iter(lambda: source.read(CHUNK_SIZE), b''))
+
+    def touch(self, filename):
+        """Отметить рисунок как только что загруженный. False - рисунка нет"""
+        with self.pool.connection() as conn:
+            return conn.execute('UPDATE pack_entries SET stored_at = ? WHERE filename = ?',
+                                (time.time(), filename)).rowcount > 0
+
+    def _put(self, filename, length, chunks):
+        with self.pool.connection(immediate=True) as conn:
+            if conn.execute('UPDATE pack_entries SET stored_at = ? WHERE filename = ?',
+                            (time.time(), filename)).rowcount:
+                return False
+            segment, offset = self._reserve(conn, length)
+            self._write(segment, offset, chunks())
+            conn.execute('INSERT INTO pack_entries (filename, segment, offset, length, stored_at) VALUES (?, ?, ?, ?, ?)',
+                         (filename, segment, offset, length, time.time()))
+            conn.execute('UPDATE pack_segments SET size = ? WHERE id = ?', (offset + length, segment))
+        return True
+
+    def _reserve(self, conn, length, exclude=()):
+        """(сегмент, смещение) для новой записи: конец последнего сегмента или новый сегмент"""
+        row = conn.execute('SELECT id, size FROM pack_segments ORDER BY id DESC LIMIT 1').fetchone()
+        if row is not None and row['id'] not in exclude and (row['size'] == 0 or row['size'] + length <= self.segment_size):
+            return row['id'], row['size']
+        segment = conn.execute('INSERT INTO pack_segments (size) VALUES (0)').lastrowid
+        return segment, 0
+
+    def _write(self, segment, offset, chunks):
+        """Записать куски по смещению и сбросить на диск до коммита индекса
+
+        Пишется всегда по смещению из индекса: хвост от прерванной записи
+        (байты без строки в индексе) просто перезаписывается.
+        """
+        fd = os.open(self.segment_path(segment), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            for chunk in chunks:
+                os.pwrite(fd, chunk, offset)
+                offset += len(chunk)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def delete(self, filename):
+        """Убрать рисунок из индекса; место освободит compact(). True - рисунок был"""
+        with self.pool.connection(immediate=True) as conn:
+            row = conn.execute('SELECT segment, length FROM pack_entries WHERE filename = ?', (filename,)).fetchone()
+            if row is None:
+                return False
+            conn.execute('DELETE FROM pack_entries WHERE filename = ?', (filename,))
+            conn.execute('UPDATE pack_segments SET dead = dead + ? WHERE id = ?', (row['length'], row['segment']))
+        return True
+
+    def filenames(self):
+        with self.pool.connection() as conn:
+            return [row[0] for row in conn.execute('SELECT filename FROM pack_entries ORDER BY segment, offset')]
+
+    # ---------- обслуживание ----------
+
+    def compact(self, ratio=COMPACT_RATIO):
+        """Переписать живые записи из сегментов, где удалено не меньше ratio
+
+        Каждый сегмент переносится одной транзакцией: живые записи дописываются
+        в конец новых сегментов, индекс переключается, старый файл удаляется.
+        Читатели со старым mmap дочитают удаленный файл. Возвращает
+        (сегментов, освобождено байт).
+        """
+        with self.pool.connection() as conn:
+            candidates = [row['id'] for row in conn.execute(
+                'SELECT id FROM pack_segments WHERE dead > 0 AND dead >= size * ? ORDER BY id', (ratio,))]
+
+        segments = freed = 0
+        for segment in candidates:
+            with self.pool.connection(immediate=True) as conn:
+                row = conn.execute('SELECT size, dead FROM pack_segments WHERE id = ?', (segment,)).fetchone()
+                if row is None:
+                    continue
+                entries = conn.execute('SELECT filename, offset, length FROM pack_entries WHERE segment = ? ORDER BY offset',
+                                       (segment,)).fetchall()
+                old = self._map(segment, row['size']) if entries else None
+                for entry in entries:
+                    target, offset = self._reserve(conn, entry['length'], exclude=(segment,))
+                    view = memoryview(old)[entry['offset']:entry['offset'] + entry['length']]
+                    self._write(target, offset, (view[i:i + CHUNK_SIZE] for i in range(0, len(view), CHUNK_SIZE)))
+                    conn.execute('UPDATE pack_entries SET segment = ?, offset = ? WHERE filename = ?',
+                                 (target, offset, entry['filename']))
+                    conn.execute('UPDATE pack_segments SET size = ? WHERE id = ?', (offset + entry['length'], target))
+                    view.release()
+                conn.execute('DELETE FROM pack_segments WHERE id = ?', (segment,))
+            with self._maps_lock:
+                self._maps.pop(segment, None)
+            if os.path.exists(self.segment_path(segment)):
+                os.remove(self.segment_path(segment))
+            segments += 1
+            freed += row['dead']
+        return segments, freed
+
+    def stats(self):
+        """{'segments', 'entries', 'bytes', 'dead'}"""
+        with self.pool.connection() as conn:
+            row = conn.execute('''
+                SELECT
+                    (SELECT COUNT(*) FROM pack_segments) AS segments,
+                    (SELECT COUNT(*) FROM pack_entries) AS entries,
+                    (SELECT COALESCE(SUM(size), 0) FROM pack_segments) AS bytes,
+                    (SELECT COALESCE(SUM(dead), 0) FROM pack_segments) AS dead
+            ''').fetchone()
+        return dict(row)
+
+
+def absorb_upload(store, upload_folder, filename):
+    """Перенести только что сохраненный файл загрузки в сегмент
+
+    Одинаковую загрузку мог уже перенести параллельный запрос - тогда
+    файла нет, а запись в индексе просто отмечается как новая.
+    """
+    path = drawing_path(upload_folder, filename)
+    try:
+        if path is not None:
+            store.put_file(filename, path)
+            os.remove(path)
+            return
+    except FileNotFoundError:
+        pass
+    if not store.touch(filename):
+        raise FileNotFoundError(filename)
+
+
+def pack_drawings(store, upload_folder):
+    """Перенести файлы рисунков в сегменты (файл удаляется после записи индекса). Возвращает число"""
+    packed = 0
+    for filename, path in list(iter_drawing_files(upload_folder)):
+        store.put_file(filename, path)
+        os.remove(path)
+        packed += 1
+    return packed
+
+
+def unpack_drawings(store, upload_folder):
+    """Вернуть рисунки из сегментов в файлы (раскладка по подпапкам). Возвращает число"""
+    unpacked = 0
+    for filename in store.filenames():
+        view = store.get(filename)
+        if view is None:
+            continue
+        if drawing_path(upload_folder, filename) is None:
+            path = sharded_path(upload_folder, filename)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temp_path = f"{path}.part"
+            with open(temp_path, 'wb') as f:
+                f.write(view)
+            os.replace(temp_path, path)
+        view.release()
+        store.delete(filename)
+        unpacked += 1
+    return unpacked
@@ -0,0 +1,43 @@
+import base64
+import json
+
+# Размер страницы ленты по умолчанию и максимальный
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+
+def encode_cursor(created_at, drawing_id):
+    """Непрозрачный курсор из ключа последней строки страницы"""
+    raw = json.dumps([created_at, drawing_id], separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Ключ (created_at, id) из курсора; ValueError если курсор испорчен"""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        created_at, drawing_id = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+    except Exception:
+        raise ValueError('Неверный курсор')
+    if not isinstance(created_at, str) or not isinstance(drawing_id, int):
+        raise ValueError('Неверный курсор')
+    return created_at, drawing_id
+
+
+def page_size(value, default=DEFAULT_PAGE_SIZE):
+    """Размер страницы из параметра запроса, в пределах 1..MAX_PAGE_SIZE"""
+    try:
+        size = int(value) if value is not None else default
+    except (TypeError, ValueError):
+        size = default
+    return max(1, min(size, MAX_PAGE_SIZE))
+
+
+def keyset_page(rows, limit):
+    """Обрезать выборку из limit + 1 строк и вычислить следующий курсор"""
+    rows = list(rows)
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    last = rows[-1]
+    return rows, encode_cursor(last['created_at'], last['id'])
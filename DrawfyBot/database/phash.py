@@ -0,0 +1,153 @@
+import io
+
+from PIL import Image
+
+from database.layout import drawing_path
+
+# Перцептивный хэш рисунка (dHash, 64 бита): похожие картинки дают хэши
+# с малым расстоянием Хэмминга. Поиск - мультииндекс: хэш режется на 4
+# куска по 16 бит, у каждого свой индекс. Если расстояние не больше 3,
+# хотя бы один кусок совпадает точно (принцип Дирихле) - кандидаты находятся
+# по индексу, а точное расстояние считается только для них.
+HASH_SIZE = 8
+SEGMENTS = 4
+SEGMENT_BITS = 64 // SEGMENTS
+
+# Почти тот же рисунок того же автора: награда за загрузку не начисляется.
+# Чужие рисунки не учитываются - у почти пустых холстов хэши близки к нулю,
+# и честный автор терял бы награду за первую загрузку
+DUPLICATE_DISTANCE = 3
+# Похожие рисунки для галереи: порог не выше того, что гарантирует мультииндекс.
+# При большем расстоянии рисунок без точно совпавшего куска был бы потерян
+SIMILAR_DISTANCE = SEGMENTS - 1
+# Потолок кандидатов для галереи: у почти пустых холстов много общих кусков,
+# берутся самые новые (порядок по id, чтобы выборка не зависела от плана запроса)
+CANDIDATE_LIMIT = 10000
+
+
+def dhash(source):
+    """64-битный разностный хэш изображения (путь или файловый объект)"""
+    with Image.open(source) as image:
+        image.draft('L', (HASH_SIZE * 4, HASH_SIZE * 4))
+        return image_dhash(image)
+
+
+def image_dhash(image):
+    """То же для уже открытого или нарисованного изображения"""
+    if image.mode in ('RGBA', 'LA', 'P'):
+        # Прозрачный холст считается белым, как на странице
+        image = image.convert('RGBA')
+        background = Image.new('RGBA', image.size, (255, 255, 255, 255))
+        image = Image.alpha_composite(background, image)
+    small = image.convert('L').resize((HASH_SIZE + 1, HASH_SIZE), Image.LANCZOS)
+    pixels = small.load()
+    value = 0
+    for y in range(HASH_SIZE):
+        for x in range(HASH_SIZE):
+            value = (value << 1) | (pixels[x, y] > pixels[x + 1, y])
+    return value
+
+
+def index_phashes(storage, upload_folder, packs=None, batch=500):
+    """Посчитать хэши рисунков, загруженных до появления индекса. Возвращает (посчитано, без файла)"""
+    indexed = missing = 0
+    last_id = 0
+    while True:
+        rows = storage.drawings_without_phash(last_id, batch)
+        if not rows:
+            return indexed, missing
+        for drawing_id, filename in rows:
+            last_id = drawing_id
+            source = drawing_path(upload_folder, filename)
+            if source is None and packs is not None:
+                view = packs.get(filename)
+                source = io.BytesIO(view) if view is not None else None
+            if source is None:
+                missing += 1
+                continue
+            storage.set_drawing_phash(drawing_id, dhash(source))
+            indexed += 1
+
+
+def to_signed(value):
+    """64-битный хэш в диапазоне INTEGER SQLite / BIGINT PostgreSQL"""
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def to_unsigned(value):
+    return value + (1 << 64) if value < 0 else value
+
+
+def segments(value):
+    """Куски хэша по 16 бит, от старших к младшим"""
+    value = to_unsigned(value)
+    mask = (1 << SEGMENT_BITS) - 1
+    return [(value >> (SEGMENT_BITS * (SEGMENTS - 1 - i))) & mask for i in range(SEGMENTS)]
+
+
+def distance(a, b):
+    """Расстояние Хэмминга между хэшами"""
+    return bin(to_unsigned(a) ^ to_unsigned(b)).count('1')
+
+
+def closest(value, candidates, max_distance, limit=None):
+    """[(id, расстояние)] кандидатов [(id, хэш)] не дальше max_distance, ближние первыми"""
+    found = []
+    for candidate_id, candidate in candidates:
+        d = distance(value, candidate)
+        if d <= max_distance:
+            found.append((candidate_id, d))
+    found.sort(key=lambda item: (item[1], -item[0]))
+    return found[:limit] if limit else found
+
+
+# ---------- SQLite ----------
+
+def create_phashes(cursor):
+    """Таблица хэшей рисунков и индексы по кускам"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS drawing_phashes (
+            drawing_id INTEGER PRIMARY KEY,
+            hash INTEGER NOT NULL,
+            s0 INTEGER NOT NULL,
+            s1 INTEGER NOT NULL,
+            s2 INTEGER NOT NULL,
+            s3 INTEGER NOT NULL
+        )
+    ''')
+    for i in range(SEGMENTS):
+        cursor.execute(f'CREATE INDEX IF NOT EXISTS idx_drawing_phashes_s{i} ON drawing_phashes (s{i})')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_drawing_phashes_delete AFTER DELETE ON drawings
+        BEGIN
+            DELETE FROM drawing_phashes WHERE drawing_id = OLD.id;
+        END
+    ''')
+
+
+def record_phash(cursor, drawing_id, value):
+    cursor.execute('''
+        INSERT OR REPLACE INTO drawing_phashes (drawing_id, hash, s0, s1, s2, s3)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', (drawing_id, to_signed(value), *segments(value)))
+
+
+def phash_candidates(cursor, value):
+    """[(drawing_id, хэш)] рисунков, у которых совпал хотя бы один кусок"""
+    cursor.execute('''
+        SELECT drawing_id, hash FROM drawing_phashes
+        WHERE s0 = ? OR s1 = ? OR s2 = ? OR s3 = ?
+        ORDER BY drawing_id DESC
+        LIMIT ?
+    ''', (*segments(value), CANDIDATE_LIMIT))
+    return cursor.fetchall()
+
+
+def own_phash_candidates(cursor, value, user_id, exclude_id):
+    """То же среди других рисунков автора, без потолка (проверка повтора при загрузке)"""
+    cursor.execute('''
+        SELECT p.drawing_id, p.hash FROM drawing_phashes p
+        JOIN drawings d ON d.id = p.drawing_id
+        WHERE d.user_id = ? AND p.drawing_id != ? AND (p.s0 = ? OR p.s1 = ? OR p.s2 = ? OR p.s3 = ?)
+    ''', (user_id, exclude_id, *segments(value)))
+    return cursor.fetchall()
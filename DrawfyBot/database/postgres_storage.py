@@ -0,0 +1,893 @@
+import os
+import threading
+from collections import Counter
+from contextlib import contextmanager
+
+import psycopg2
+import psycopg2.extensions
+import psycopg2.extras
+import psycopg2.pool
+
+from database.generations import GENERATIONS
+from database.leaderboard import WEEK_DAYS
+from database.likes import LIKE_REWARD
+from database.pagination import keyset_page
+from database.phash import CANDIDATE_LIMIT, DUPLICATE_DISTANCE, SEGMENTS, closest, segments, to_signed
+from database.schema import COLUMNS, DEDUPLICATE, DROPPED_INDEXES, INDEXES, index_name
+from database.search import AUTHOR_TEXT, search_page, ts_query
+from database.storage import (ALREADY_OWNED, DRAWING_READY, NOT_ENOUGH_COINS, PURCHASED, SHOP_ITEMS,
+                              TEST_USER_BALANCE, TEST_USERS, Storage)
+
+# Время хранится в UTC без долей секунды, как CURRENT_TIMESTAMP в SQLite
+NOW = "(timezone('utc', now())::timestamp(0))"
+
+TABLES = [
+    f'''
+    CREATE TABLE IF NOT EXISTS users (
+        id SERIAL PRIMARY KEY,
+        telegram_id BIGINT UNIQUE NOT NULL,
+        username TEXT,
+        first_name TEXT,
+        last_name TEXT,
+        balance INTEGER DEFAULT 100,
+        experience INTEGER DEFAULT 0,
+        level INTEGER DEFAULT 1,
+        created_at TIMESTAMP(0) DEFAULT {NOW}
+    )
+    ''',
+    f'''
+    CREATE TABLE IF NOT EXISTS drawings (
+        id SERIAL PRIMARY KEY,
+        user_id INTEGER NOT NULL REFERENCES users (id),
+        title TEXT NOT NULL,
+        description TEXT,
+        filename TEXT NOT NULL,
+        likes INTEGER DEFAULT 0,
+        views INTEGER DEFAULT 0,
+        like_count INTEGER NOT NULL DEFAULT 0,
+        comment_count INTEGER NOT NULL DEFAULT 0,
+        created_at TIMESTAMP(0) DEFAULT {NOW}
+    )
+    ''',
+    f'''
+    CREATE TABLE IF NOT EXISTS likes (
+        id SERIAL PRIMARY KEY,
+        user_id INTEGER NOT NULL REFERENCES users (id),
+        drawing_id INTEGER NOT NULL REFERENCES drawings (id),
+        created_at TIMESTAMP(0) DEFAULT {NOW},
+        UNIQUE (user_id, drawing_id)
+    )
+    ''',
+    f'''
+    CREATE TABLE IF NOT EXISTS comments (
+        id SERIAL PRIMARY KEY,
+        user_id INTEGER NOT NULL REFERENCES users (id),
+        drawing_id INTEGER NOT NULL REFERENCES drawings (id),
+        text TEXT NOT NULL,
+        created_at TIMESTAMP(0) DEFAULT {NOW}
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS shop_items (
+        id SERIAL PRIMARY KEY,
+        name TEXT NOT NULL,
+        description TEXT,
+        price INTEGER NOT NULL,
+        type TEXT,
+        image_url TEXT
+    )
+    ''',
+    f'''
+    CREATE TABLE IF NOT EXISTS purchases (
+        id SERIAL PRIMARY KEY,
+        user_id INTEGER NOT NULL REFERENCES users (id),
+        item_id INTEGER NOT NULL REFERENCES shop_items (id),
+        purchased_at TIMESTAMP(0) DEFAULT {NOW}
+    )
+    ''',
+    # Готовая статистика профиля (см. database/user_stats.py)
+    '''
+    CREATE TABLE IF NOT EXISTS user_stats (
+        user_id INTEGER PRIMARY KEY,
+        drawings_count INTEGER NOT NULL DEFAULT 0,
+        total_likes INTEGER NOT NULL DEFAULT 0,
+        unique_likers INTEGER NOT NULL DEFAULT 0,
+        last_upload_at TIMESTAMP(0)
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS author_likers (
+        author_id INTEGER NOT NULL,
+        liker_id INTEGER NOT NULL,
+        PRIMARY KEY (author_id, liker_id)
+    )
+    ''',
+    # Лайки авторов по дням для недельного рейтинга (см. database/leaderboard.py)
+    '''
+    CREATE TABLE IF NOT EXISTS like_buckets (
+        day DATE NOT NULL,
+        user_id INTEGER NOT NULL,
+        likes INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (day, user_id)
+    )
+    ''',
+    # Файлы рисунков и число ссылок на них (см. database/blobs.py)
+    f'''
+    CREATE TABLE IF NOT EXISTS blobs (
+        filename TEXT PRIMARY KEY,
+        size BIGINT NOT NULL,
+        refcount INTEGER NOT NULL DEFAULT 0,
+        created_at TIMESTAMP(0) DEFAULT {NOW}
+    )
+    ''',
+    # Перцептивные хэши и куски для мультииндекса (см. database/phash.py)
+    '''
+    CREATE TABLE IF NOT EXISTS drawing_phashes (
+        drawing_id INTEGER PRIMARY KEY REFERENCES drawings (id) ON DELETE CASCADE,
+        hash BIGINT NOT NULL,
+        s0 INTEGER NOT NULL,
+        s1 INTEGER NOT NULL,
+        s2 INTEGER NOT NULL,
+        s3 INTEGER NOT NULL
+    )
+    ''',
+    *[f'CREATE INDEX IF NOT EXISTS idx_drawing_phashes_s{i} ON drawing_phashes (s{i})' for i in range(SEGMENTS)],
+    # Поисковый документ рисунка: название, автор, описание (см. database/search.py)
+    '''
+    CREATE TABLE IF NOT EXISTS drawing_search (
+        drawing_id INTEGER PRIMARY KEY REFERENCES drawings (id) ON DELETE CASCADE,
+        document TSVECTOR NOT NULL
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_drawing_search ON drawing_search USING GIN (document)',
+    '''
+    CREATE TABLE IF NOT EXISTS cache_generations (
+        name TEXT PRIMARY KEY,
+        value INTEGER NOT NULL DEFAULT 0
+    )
+    ''',
+]
+
+# Те же денормализованные данные, что поддерживают триггеры SQLite
+# (database/schema.py, database/user_stats.py, database/leaderboard.py),
+# но одной функцией на событие таблицы.
+TRIGGERS = {
+    'drawings': (
+        '''
+        CREATE OR REPLACE FUNCTION drawfy_drawings_changed() RETURNS trigger AS $$
+        BEGIN
+            -- drawings_count - только готовые рисунки (processing_status = 'ready')
+            IF TG_OP <> 'DELETE' AND NEW.processing_status = 'ready'
+                    AND (TG_OP = 'INSERT' OR OLD.processing_status <> 'ready') THEN
+                INSERT INTO user_stats (user_id, drawings_count, last_upload_at)
+                VALUES (NEW.user_id, 1, NEW.created_at)
+                ON CONFLICT (user_id) DO UPDATE SET
+                    drawings_count = user_stats.drawings_count + 1,
+                    last_upload_at = GREATEST(user_stats.last_upload_at, excluded.last_upload_at);
+            ELSIF TG_OP <> 'INSERT' AND OLD.processing_status = 'ready'
+                    AND (TG_OP = 'DELETE' OR NEW.processing_status <> 'ready') THEN
+                UPDATE user_stats SET drawings_count = drawings_count - 1 WHERE user_id = OLD.user_id;
+            END IF;
+            IF TG_OP = 'INSERT' THEN
+                UPDATE blobs SET refcount = refcount + 1 WHERE filename = NEW.filename;
+            ELSIF TG_OP = 'DELETE' THEN
+                UPDATE blobs SET refcount = refcount - 1 WHERE filename = OLD.filename;
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+        '''
+    ),
+    'likes': (
+        f'''
+        CREATE OR REPLACE FUNCTION drawfy_likes_changed() RETURNS trigger AS $$
+        DECLARE
+            author INTEGER;
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                UPDATE drawings SET like_count = like_count + 1 WHERE id = NEW.drawing_id
+                RETURNING user_id INTO author;
+                IF author IS NULL THEN
+                    RETURN NULL;
+                END IF;
+                INSERT INTO user_stats (user_id, total_likes) VALUES (author, 1)
+                ON CONFLICT (user_id) DO UPDATE SET total_likes = user_stats.total_likes + 1;
+                INSERT INTO author_likers (author_id, liker_id) VALUES (author, NEW.user_id)
+                ON CONFLICT DO NOTHING;
+                IF FOUND THEN
+                    UPDATE user_stats SET unique_likers = unique_likers + 1 WHERE user_id = author;
+                END IF;
+                INSERT INTO like_buckets (day, user_id, likes) VALUES (NEW.created_at::date, author, 1)
+                ON CONFLICT (day, user_id) DO UPDATE SET likes = like_buckets.likes + 1;
+                DELETE FROM like_buckets WHERE day < NEW.created_at::date - {WEEK_DAYS};
+            ELSE
+                UPDATE drawings SET like_count = like_count - 1 WHERE id = OLD.drawing_id
+                RETURNING user_id INTO author;
+                IF author IS NULL THEN
+                    RETURN NULL;
+                END IF;
+                UPDATE user_stats SET total_likes = total_likes - 1 WHERE user_id = author;
+                DELETE FROM author_likers
+                WHERE author_id = author AND liker_id = OLD.user_id
+                  AND NOT EXISTS (
+                      SELECT 1 FROM likes l JOIN drawings d ON d.id = l.drawing_id
+                      WHERE l.user_id = OLD.user_id AND d.user_id = author
+                  );
+                IF FOUND THEN
+                    UPDATE user_stats SET unique_likers = unique_likers - 1 WHERE user_id = author;
+                END IF;
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+        '''
+    ),
+    'comments': (
+        '''
+        CREATE OR REPLACE FUNCTION drawfy_comments_changed() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                UPDATE drawings SET comment_count = comment_count + 1 WHERE id = NEW.drawing_id;
+            ELSE
+                UPDATE drawings SET comment_count = comment_count - 1 WHERE id = OLD.drawing_id;
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+        '''
+    ),
+}
+
+# События триггеров, кроме INSERT OR DELETE: рисунок попадает в профиль, когда готов
+TRIGGER_EVENTS = {
+    'drawings': 'INSERT OR DELETE OR UPDATE OF processing_status',
+}
+
+# Пересчет drawings_count после перехода на счет только готовых рисунков
+RECOUNT_DRAWINGS = '''
+    UPDATE user_stats s SET
+        drawings_count = (SELECT COUNT(*) FROM drawings d WHERE d.user_id = s.user_id AND d.processing_status = 'ready'),
+        last_upload_at = (SELECT MAX(created_at) FROM drawings d
+                          WHERE d.user_id = s.user_id AND d.processing_status = 'ready')
+'''
+
+# Поисковый индекс меняется и при правке рисунка, и при смене имени автора,
+# поэтому у него свои триггеры (AFTER UPDATE OF ...), а не trg_{table}_changed
+SEARCH_SCHEMA = [
+    # Вес: A - название, B - автор, C - описание
+    '''
+    CREATE OR REPLACE FUNCTION drawfy_search_document(title TEXT, description TEXT, author TEXT)
+    RETURNS tsvector AS $$
+        SELECT setweight(to_tsvector('simple', COALESCE(title, '')), 'A')
+            || setweight(to_tsvector('simple', COALESCE(author, '')), 'B')
+            || setweight(to_tsvector('simple', COALESCE(description, '')), 'C')
+    $$ LANGUAGE sql IMMUTABLE
+    ''',
+    f'''
+    CREATE OR REPLACE FUNCTION drawfy_drawing_search() RETURNS trigger AS $$
+    BEGIN
+        INSERT INTO drawing_search (drawing_id, document)
+        SELECT NEW.id, drawfy_search_document(NEW.title, NEW.description, {AUTHOR_TEXT})
+        FROM users WHERE id = NEW.user_id
+        ON CONFLICT (drawing_id) DO UPDATE SET document = excluded.document;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql
+    ''',
+    'DROP TRIGGER IF EXISTS trg_drawings_search ON drawings',
+    '''
+    CREATE TRIGGER trg_drawings_search AFTER INSERT OR UPDATE OF title, description, user_id ON drawings
+    FOR EACH ROW EXECUTE FUNCTION drawfy_drawing_search()
+    ''',
+    f'''
+    CREATE OR REPLACE FUNCTION drawfy_author_search() RETURNS trigger AS $$
+    BEGIN
+        UPDATE drawing_search s
+        SET document = drawfy_search_document(d.title, d.description,
+                                              (SELECT {AUTHOR_TEXT} FROM users WHERE id = NEW.id))
+        FROM drawings d
+        WHERE d.id = s.drawing_id AND d.user_id = NEW.id;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql
+    ''',
+    'DROP TRIGGER IF EXISTS trg_users_search ON users',
+    '''
+    CREATE TRIGGER trg_users_search AFTER UPDATE OF first_name, last_name, username ON users
+    FOR EACH ROW EXECUTE FUNCTION drawfy_author_search()
+    ''',
+    # Рисунки, загруженные до появления индекса
+    f'''
+    INSERT INTO drawing_search (drawing_id, document)
+    SELECT d.id, drawfy_search_document(d.title, d.description,
+                                        (SELECT {AUTHOR_TEXT} FROM users WHERE id = d.user_id))
+    FROM drawings d
+    LEFT JOIN drawing_search s ON s.drawing_id = d.id
+    WHERE s.drawing_id IS NULL
+    ''',
+]
+
+# Запросы, которые готовятся на сервере (PREPARE) один раз на соединение.
+# Пачки передаются массивами и разворачиваются через unnest - одно
+# выполнение на пачку вместо запроса на каждую строку.
+STATEMENTS = {
+    'user_by_telegram': 'SELECT * FROM users WHERE telegram_id = $1',
+    'user_insert': '''
+        INSERT INTO users (telegram_id, username, first_name, last_name)
+        VALUES ($1, $2, $3, $4)
+        ON CONFLICT (telegram_id) DO NOTHING
+        RETURNING *
+    ''',
+    'user_names': 'SELECT id, telegram_id, username, first_name, last_name FROM users WHERE id = ANY($1::int[])',
+    'profile': '''
+        SELECT
+            u.*,
+            COALESCE(s.drawings_count, 0) AS drawings_count,
+            COALESCE(s.total_likes, 0) AS total_likes,
+            COALESCE(s.unique_likers, 0) AS unique_likers,
+            s.last_upload_at
+        FROM users u
+        LEFT JOIN user_stats s ON s.user_id = u.id
+        WHERE u.id = $1
+    ''',
+    'drawing_insert': '''
+        INSERT INTO drawings (user_id, title, description, filename, processing_status,
+                              original_size, stored_size)
+        VALUES ($1, $2, $3, $4, $5, $6, $7)
+        RETURNING id
+    ''',
+    'drawing_status': 'UPDATE drawings SET processing_status = $2, processing_error = $3 WHERE id = $1',
+    'drawing_file': 'SELECT user_id, filename FROM drawings WHERE id = $1 FOR UPDATE',
+    'user_lock': 'SELECT id FROM users WHERE id = $1 FOR UPDATE',
+    'drawing_set_file': 'UPDATE drawings SET filename = $2, stored_size = $3 WHERE id = $1',
+    'reward': 'UPDATE users SET experience = experience + $2, balance = balance + $3 WHERE id = $1',
+    # Только готовые рисунки - по частичному индексу idx_drawings_ready_feed
+    'feed_first': f'''
+        SELECT d.*, u.username, u.first_name, u.last_name
+        FROM drawings d
+        JOIN users u ON d.user_id = u.id
+        WHERE d.processing_status = '{DRAWING_READY}'
+        ORDER BY d.created_at DESC, d.id DESC
+        LIMIT $1
+    ''',
+    'feed_after': f'''
+        SELECT d.*, u.username, u.first_name, u.last_name
+        FROM drawings d
+        JOIN users u ON d.user_id = u.id
+        WHERE d.processing_status = '{DRAWING_READY}' AND (d.created_at, d.id) < ($2::timestamp, $3::integer)
+        ORDER BY d.created_at DESC, d.id DESC
+        LIMIT $1
+    ''',
+    # Префиксный поиск; ts_rank по умолчанию ставит название выше автора, а автора выше описания
+    'search': f'''
+        SELECT d.*, u.username, u.first_name, u.last_name
+        FROM drawing_search s
+        JOIN drawings d ON d.id = s.drawing_id
+        JOIN users u ON u.id = d.user_id
+        WHERE s.document @@ to_tsquery('simple', $1) AND d.processing_status = '{DRAWING_READY}'
+        ORDER BY ts_rank(s.document, to_tsquery('simple', $1)) DESC, d.id DESC
+        LIMIT $2 OFFSET $3
+    ''',
+    'user_drawings': f'''
+        SELECT * FROM drawings
+        WHERE user_id = $1 AND processing_status = '{DRAWING_READY}'
+        ORDER BY created_at DESC, id DESC
+        LIMIT $2
+    ''',
+    # Строки блокируются по возрастанию id до обновления: пачки просмотров и
+    # лайков из разных воркеров берут блокировки в одном порядке и не встают в дедлок
+    'drawings_lock': 'SELECT id FROM drawings WHERE id = ANY($1::int[]) ORDER BY id FOR NO KEY UPDATE',
+    'users_lock': 'SELECT id FROM users WHERE id = ANY($1::int[]) ORDER BY id FOR NO KEY UPDATE',
+    'views_add': '''
+        UPDATE drawings d SET views = d.views + v.count
+        FROM unnest($1::int[], $2::int[]) AS v(id, count)
+        WHERE d.id = v.id
+    ''',
+    # DO UPDATE, а не DO NOTHING: берет блокировку строки и ждет gc-blobs,
+    # а если тот удалил запись, вставляет ее заново
+    'blob_register': '''
+        INSERT INTO blobs (filename, size) VALUES ($1, $2)
+        ON CONFLICT (filename) DO UPDATE SET size = excluded.size
+    ''',
+    'drawing_rename': 'UPDATE drawings SET filename = $2 WHERE filename = $1',
+    'blob_refs_adjust': 'UPDATE blobs SET refcount = refcount + $2 WHERE filename = $1',
+    'blobs_unreferenced': 'SELECT filename FROM blobs WHERE refcount <= 0 FOR UPDATE',
+    'blob_delete': 'DELETE FROM blobs WHERE filename = $1 AND refcount <= 0',
+    'size_report': '''
+        SELECT
+            (SELECT COUNT(*) FROM drawings WHERE original_size IS NOT NULL) AS drawings,
+            (SELECT COALESCE(SUM(original_size), 0) FROM drawings) AS original_bytes,
+            (SELECT COALESCE(SUM(stored_size), 0) FROM drawings WHERE original_size IS NOT NULL) AS stored_bytes,
+            (SELECT COUNT(*) FROM blobs WHERE refcount > 0) AS blobs,
+            (SELECT COALESCE(SUM(size), 0)::bigint FROM blobs WHERE refcount > 0) AS blob_bytes
+    ''',
+    'phash_insert': '''
+        INSERT INTO drawing_phashes (drawing_id, hash, s0, s1, s2, s3) VALUES ($1, $2, $3, $4, $5, $6)
+        ON CONFLICT (drawing_id) DO UPDATE SET
+            hash = excluded.hash, s0 = excluded.s0, s1 = excluded.s1, s2 = excluded.s2, s3 = excluded.s3
+    ''',
+    'phash_get': 'SELECT hash FROM drawing_phashes WHERE drawing_id = $1',
+    'phash_candidates': '''
+        SELECT drawing_id, hash FROM drawing_phashes
+        WHERE s0 = $1 OR s1 = $2 OR s2 = $3 OR s3 = $4
+        ORDER BY drawing_id DESC
+        LIMIT $5
+    ''',
+    'phash_own_candidates': '''
+        SELECT p.drawing_id, p.hash FROM drawing_phashes p
+        JOIN drawings d ON d.id = p.drawing_id
+        WHERE d.user_id = $1 AND p.drawing_id <> $2 AND (p.s0 = $3 OR p.s1 = $4 OR p.s2 = $5 OR p.s3 = $6)
+    ''',
+    'phash_missing': '''
+        SELECT d.id, d.filename FROM drawings d
+        LEFT JOIN drawing_phashes p ON p.drawing_id = d.id
+        WHERE d.id > $1 AND p.drawing_id IS NULL
+        ORDER BY d.id
+        LIMIT $2
+    ''',
+    'drawings_by_ids': '''
+        SELECT d.*, u.username, u.first_name, u.last_name
+        FROM drawings d
+        JOIN users u ON d.user_id = u.id
+        WHERE d.id = ANY($1::int[])
+    ''',
+    'has_liked': 'SELECT 1 FROM likes WHERE user_id = $1 AND drawing_id = $2',
+    # Лайки на несуществующие рисунки отбрасываются, повторы пропускаются
+    'likes_insert': '''
+        WITH added AS (
+            INSERT INTO likes (user_id, drawing_id)
+            SELECT v.user_id, v.drawing_id
+            FROM unnest($1::int[], $2::int[]) WITH ORDINALITY AS v(user_id, drawing_id, n)
+            WHERE EXISTS (SELECT 1 FROM drawings d WHERE d.id = v.drawing_id)
+            ORDER BY v.n
+            ON CONFLICT (user_id, drawing_id) DO NOTHING
+            RETURNING user_id, drawing_id
+        )
+        SELECT a.user_id, a.drawing_id, d.user_id AS author_id
+        FROM added a JOIN drawings d ON d.id = a.drawing_id
+    ''',
+    'drawing_likes_add': '''
+        UPDATE drawings d SET likes = d.likes + v.count
+        FROM unnest($1::int[], $2::int[]) AS v(id, count)
+        WHERE d.id = v.id
+    ''',
+    'authors_reward': '''
+        UPDATE users u SET experience = u.experience + v.count * $3, balance = u.balance + v.count * $4
+        FROM unnest($1::int[], $2::int[]) AS v(id, count)
+        WHERE u.id = v.id
+    ''',
+    'shop_items': 'SELECT * FROM shop_items ORDER BY price',
+    'purchase_exists': 'SELECT 1 FROM purchases WHERE user_id = $1 AND item_id = $2',
+    'balance_charge': '''
+        UPDATE users SET balance = balance - $2
+        WHERE id = $1 AND balance >= $2
+        RETURNING balance
+    ''',
+    'purchase_insert': 'INSERT INTO purchases (user_id, item_id) VALUES ($1, $2)',
+    'stats': '''
+        SELECT
+            (SELECT COUNT(*) FROM users) AS total_users,
+            (SELECT COUNT(*) FROM drawings) AS total_drawings,
+            (SELECT COALESCE(SUM(likes), 0) FROM drawings) AS total_likes
+    ''',
+    'board_experience': 'SELECT id, COALESCE(experience, 0) AS score FROM users',
+    'board_likes': 'SELECT user_id, total_likes AS score FROM user_stats WHERE total_likes > 0',
+    'board_weekly': '''
+        SELECT user_id, SUM(likes) AS score FROM like_buckets
+        WHERE day >= $1::date GROUP BY user_id
+    ''',
+    'generations_read': 'SELECT name, value FROM cache_generations',
+    'generations_bump': '''
+        INSERT INTO cache_generations (name, value)
+        SELECT unnest($1::text[]), 1
+        ON CONFLICT (name) DO UPDATE SET value = cache_generations.value + 1
+    ''',
+}
+
+# TIMESTAMP отдается строкой как есть ('YYYY-MM-DD HH:MM:SS'), как в SQLite:
+# так ответы API и курсоры ленты одинаковы на обоих бэкендах
+TIMESTAMP_AS_TEXT = psycopg2.extensions.new_type(
+    psycopg2.extensions.PYDATETIME.values, 'TIMESTAMP_AS_TEXT', lambda value, cursor: value)
+
+# Ключ блокировки, под которой один процесс создает схему
+SCHEMA_LOCK = 0x64726177
+
+
+class _Connection(psycopg2.extensions.connection):
+    """Соединение, помнящее свои подготовленные запросы"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+        psycopg2.extensions.register_type(TIMESTAMP_AS_TEXT, self)
+
+
+class PostgresStorage(Storage):
+    """Хранилище в PostgreSQL: пул соединений psycopg2 и подготовленные на сервере запросы
+
+    Каждый воркер (и каждый веб-сервер) держит pool_size постоянных соединений;
+    потоки сверх этого ждут свободное соединение. Запрос из STATEMENTS
+    готовится командой PREPARE при первом выполнении на соединении, дальше
+    выполняется через EXECUTE без повторного разбора и планирования.
+    """
+
+    name = 'postgresql'
+
+    def __init__(self, dsn, pool_size=4):
+        self.dsn = dsn
+        self.pool_size = pool_size
+        self._lock = threading.Lock()
+        self._pool = None
+        self._slots = None
+        self._pid = None
+        # Пулы, унаследованные через fork. Их соединения принадлежат родителю:
+        # закрытие в дочернем процессе оборвало бы сессии родителя
+        self._inherited = []
+
+    def _get_pool(self):
+        """Пул текущего процесса (после fork открывается новый)"""
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    if self._pool is not None:
+                        self._inherited.append(self._pool)
+                    # minconn = maxconn: соединения сверх minconn psycopg2 закрывает
+                    # при возврате, а вместе с ними пропали бы подготовленные запросы
+                    self._pool = psycopg2.pool.ThreadedConnectionPool(
+                        self.pool_size, self.pool_size, self.dsn,
+                        connection_factory=_Connection)
+                    # Пустой пул psycopg2 не ждет, а бросает PoolError
+                    self._slots = threading.BoundedSemaphore(self.pool_size)
+                    self._pid = os.getpid()
+        return self._pool
+
+    @contextmanager
+    def _transaction(self):
+        """Курсор в транзакции: коммит при успехе, откат при ошибке"""
+        pool = self._get_pool()
+        slots = self._slots
+        slots.acquire()
+        conn = pool.getconn()
+        try:
+            with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
+                cursor.bumps = set()
+                yield cursor
+            conn.commit()
+            if cursor.bumps:
+                self._bump_committed(conn, cursor.bumps)
+        except BaseException:
+            if not conn.closed:
+                conn.rollback()
+                # Не полагаемся на то, какие PREPARE пережили откат
+                with conn.cursor() as cursor:
+                    cursor.execute('DEALLOCATE ALL')
+                conn.commit()
+                conn.prepared.clear()
+            raise
+        finally:
+            pool.putconn(conn, close=bool(conn.closed))
+            slots.release()
+
+    @staticmethod
+    def _execute(cursor, name, *params):
+        """Выполнить подготовленный запрос STATEMENTS[name]"""
+        prepared = cursor.connection.prepared
+        if name not in prepared:
+            cursor.execute(f'PREPARE {name} AS {STATEMENTS[name]}')
+            prepared.add(name)
+        if params:
+            cursor.execute(f'EXECUTE {name} ({", ".join(["%s"] * len(params))})', params)
+        else:
+            cursor.execute(f'EXECUTE {name}')
+        return cursor
+
+    def _bump(self, cursor, *names):
+        """Поколения увеличатся после коммита транзакции (см. _bump_committed)"""
+        cursor.bumps.update(names)
+
+    def _bump_committed(self, conn, names):
+        """Увеличить поколения отдельной короткой транзакцией после коммита записи
+
+        Строка поколения одна на всех писателей: в транзакции записи ее блокировка
+        держалась бы до коммита и выстраивала все записи в очередь. После коммита
+        кэш по-прежнему корректен: читатель берет поколения до данных, поэтому
+        тело, прочитанное между коммитом и увеличением, не старее записи, а
+        следующее поколение его все равно заменит. Ошибка здесь не отменяет
+        уже записанное - кэш догонит при следующем увеличении.
+        """
+        try:
+            with conn.cursor() as cursor:
+                self._execute(cursor, 'generations_bump', sorted(names))
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            print(f"❌ Не удалось увеличить поколения {sorted(names)}: {e}")
+
+    def init_schema(self):
+        with self._transaction() as cursor:
+            # Несколько серверов могут стартовать одновременно
+            cursor.execute('SELECT pg_advisory_xact_lock(%s)', (SCHEMA_LOCK,))
+            for statement in TABLES:
+                cursor.execute(statement)
+            for table, column, definition in COLUMNS:
+                cursor.execute(f'ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {column} {definition}')
+            cursor.execute("SELECT prosrc FROM pg_proc WHERE proname = 'drawfy_drawings_changed'")
+            row = cursor.fetchone()
+            recount = row is not None and 'processing_status' not in row['prosrc']
+            for table, function in TRIGGERS.items():
+                cursor.execute(function)
+                cursor.execute(f'DROP TRIGGER IF EXISTS trg_{table}_changed ON {table}')
+                cursor.execute(f'''
+                    CREATE TRIGGER trg_{table}_changed AFTER {TRIGGER_EVENTS.get(table, 'INSERT OR DELETE')} ON {table}
+                    FOR EACH ROW EXECUTE FUNCTION drawfy_{table}_changed()
+                ''')
+            if recount:
+                cursor.execute(RECOUNT_DRAWINGS)
+            for statement in SEARCH_SCHEMA:
+                cursor.execute(statement)
+            for name in DROPPED_INDEXES:
+                cursor.execute(f'DROP INDEX IF EXISTS {name}')
+            for statement in INDEXES:
+                name = index_name(statement)
+                if name in DEDUPLICATE:
+                    cursor.execute('SELECT to_regclass(%s) AS found', (name,))
+                    if cursor.fetchone()['found'] is None:
+                        cursor.execute(DEDUPLICATE[name])
+                cursor.execute(statement)
+
+            cursor.execute('''
+                INSERT INTO cache_generations (name, value)
+                SELECT unnest(%s::text[]), 0
+                ON CONFLICT (name) DO NOTHING
+            ''', (list(GENERATIONS),))
+
+            cursor.execute('SELECT COUNT(*) AS count FROM shop_items')
+            if cursor.fetchone()['count'] == 0:
+                cursor.executemany(
+                    'INSERT INTO shop_items (name, description, price, type, image_url) VALUES (%s, %s, %s, %s, %s)',
+                    SHOP_ITEMS
+                )
+                self._bump(cursor, 'shop')
+
+            cursor.execute('SELECT COUNT(*) AS count FROM users')
+            if cursor.fetchone()['count'] == 0:
+                cursor.executemany(
+                    'INSERT INTO users (telegram_id, username, first_name, last_name, balance) VALUES (%s, %s, %s, %s, %s)',
+                    [(id, user, first, last, TEST_USER_BALANCE) for id, user, first, last in TEST_USERS]
+                )
+
+    # ---------- пользователи ----------
+
+    def get_user(self, telegram_id):
+        with self._transaction() as cursor:
+            row = self._execute(cursor, 'user_by_telegram', telegram_id).fetchone()
+        return dict(row) if row else None
+
+    def get_or_create_user(self, telegram_id, username=None, first_name=None, last_name=None):
+        with self._transaction() as cursor:
+            user = self._execute(cursor, 'user_by_telegram', telegram_id).fetchone()
+            if not user:
+                user = self._execute(cursor, 'user_insert', telegram_id, username, first_name, last_name).fetchone()
+            if not user:
+                # Пользователя только что создал другой запрос
+                user = self._execute(cursor, 'user_by_telegram', telegram_id).fetchone()
+        return dict(user) if user else None
+
+    def user_names(self, user_ids):
+        with self._transaction() as cursor:
+            rows = self._execute(cursor, 'user_names', list(user_ids)).fetchall()
+        return {row['id']: dict(row) for row in rows}
+
+    def get_profile(self, user_id):
+        with self._transaction() as cursor:
+            row = self._execute(cursor, 'profile', user_id).fetchone()
+        return dict(row) if row else None
+
+    # ---------- рисунки ----------
+
+    def add_drawing(self, user_id, title, description, filename, reward=None, status=DRAWING_READY, size=None,
+                    original_size=None, phash=None):
+        with self._transaction() as cursor:
+            if size is not None:
+                self._execute(cursor, 'blob_register', filename, size)
+            drawing_id = self._execute(cursor, 'drawing_insert',
+                                       user_id, title, description, filename, status,
+                                       original_size, size).fetchone()['id']
+            if phash is not None:
+                self._execute(cursor, 'phash_insert', drawing_id, to_signed(phash), *segments(phash))
+            if reward:
+                self._execute(cursor, 'reward', user_id, reward['experience'], reward['coins'])
+            self._bump(cursor, 'feed')
+        return drawing_id
+
+    def complete_upload(self, drawing_id, filename, size, phash, reward=None):
+        with self._transaction() as cursor:
+            row = self._execute(cursor, 'drawing_file', drawing_id).fetchone()
+            if row is None:
+                return None
+            # Загрузки одного автора проверяются по очереди: хэш параллельной
+            # загрузки виден до решения о награде
+            self._execute(cursor, 'user_lock', row['user_id'])
+            if row['filename'] != filename:
+                self._execute(cursor, 'blob_register', filename, size)
+                self._execute(cursor, 'drawing_set_file', drawing_id, filename, size)
+                self._execute(cursor, 'blob_refs_adjust', filename, 1)
+                self._execute(cursor, 'blob_refs_adjust', row['filename'], -1)
+            candidates = [(candidate['drawing_id'], candidate['hash'])
+                          for candidate in self._execute(cursor, 'phash_own_candidates', row['user_id'],
+                                                         drawing_id, *segments(phash))]
+            duplicates = closest(phash, candidates, DUPLICATE_DISTANCE, 1)
+            self._execute(cursor, 'phash_insert', drawing_id, to_signed(phash), *segments(phash))
+            if reward and not duplicates:
+                self._execute(cursor, 'reward', row['user_id'], reward['experience'], reward['coins'])
+            self._bump(cursor, 'feed')
+        return duplicates[0][0] if duplicates else None
+
+    def set_drawing_status(self, drawing_id, status, error=None):
+        with self._transaction() as cursor:
+            self._execute(cursor, 'drawing_status', drawing_id, status, error)
+            self._bump(cursor, 'feed')
+
+    def feed_page(self, limit, before=None):
+        with self._transaction() as cursor:
+            if before:
+                self._execute(cursor, 'feed_after', limit + 1, *before)
+            else:
+                self._execute(cursor, 'feed_first', limit + 1)
+            rows, next_cursor = keyset_page(cursor.fetchall(), limit)
+        return [dict(row) for row in rows], next_cursor
+
+    def drawing_phash(self, drawing_id):
+        with self._transaction() as cursor:
+            row = self._execute(cursor, 'phash_get', drawing_id).fetchone()
+        return row['hash'] if row else None
+
+    def set_drawing_phash(self, drawing_id, phash):
+        with self._transaction() as cursor:
+            self._execute(cursor, 'phash_insert', drawing_id, to_signed(phash), *segments(phash))
+
+    def drawings_without_phash(self, after_id, limit):
+        with self._transaction() as cursor:
+            rows = self._execute(cursor, 'phash_missing', after_id, limit).fetchall()
+        return [(row['id'], row['filename']) for row in rows]
+
+    def similar_drawings(self, phash, max_distance, limit, exclude_id=None):
+        with self._transaction() as cursor:
+            candidates = [(row['drawing_id'], row['hash'])
+                          for row in self._execute(cursor, 'phash_candidates', *segments(phash), CANDIDATE_LIMIT)
+                          if row['drawing_id'] != exclude_id]
+            found = closest(phash, candidates, max_distance, limit)
+            if not found:
+                return []
+            rows = self._execute(cursor, 'drawings_by_ids', [drawing_id for drawing_id, _ in found]).fetchall()
+        drawings = {row['id']: dict(row) for row in rows}
+        return [{**drawings[drawing_id], 'distance': d} for drawing_id, d in found if drawing_id in drawings]
+
+    def search_drawings(self, query, limit, offset=0):
+        tsquery = ts_query(query)
+        if tsquery is None:
+            return [], None
+        with self._transaction() as cursor:
+            rows = self._execute(cursor, 'search', tsquery, limit + 1, offset).fetchall()
+        rows, next_offset = search_page(rows, limit, offset)
+        return [dict(row) for row in rows], next_offset
+
+    def user_drawings(self, user_id, limit=None):
+        with self._transaction() as cursor:
+            rows = self._execute(cursor, 'user_drawings', user_id, limit).fetchall()
+        return [dict(row) for row in rows]
+
+    def add_views(self, counts):
+        with self._transaction() as cursor:
+            ids = sorted(counts)
+            self._execute(cursor, 'drawings_lock', ids)
+            self._execute(cursor, 'views_add', ids, [counts[drawing_id] for drawing_id in ids])
+            self._bump(cursor, 'views')
+
+    # ---------- файлы рисунков ----------
+
+    def rename_drawing_file(self, old, new, size):
+        with self._transaction() as cursor:
+            self._execute(cursor, 'blob_register', new, size)
+            moved = self._execute(cursor, 'drawing_rename', old, new).rowcount
+            if moved:
+                self._execute(cursor, 'blob_refs_adjust', new, moved)
+                self._execute(cursor, 'blob_refs_adjust', old, -moved)
+                self._bump(cursor, 'feed')
+        return moved
+
+    def delete_unreferenced_blobs(self, remove):
+        deleted = 0
+        # Строки блокируются до конца транзакции: add_drawing того же файла
+        # дождется удаления и создаст запись заново
+        with self._transaction() as cursor:
+            for row in self._execute(cursor, 'blobs_unreferenced').fetchall():
+                if remove(row['filename']):
+                    self._execute(cursor, 'blob_delete', row['filename'])
+                    deleted += 1
+        return deleted
+
+    def size_report(self):
+        with self._transaction() as cursor:
+            return dict(self._execute(cursor, 'size_report').fetchone())
+
+    # ---------- лайки ----------
+
+    def has_liked(self, user_id, drawing_id):
+        with self._transaction() as cursor:
+            return self._execute(cursor, 'has_liked', user_id, drawing_id).fetchone() is not None
+
+    def add_likes(self, likes):
+        if not likes:
+            return []
+        # Вставка по порядку ключей: параллельные пачки с общими лайками ждут друг друга, а не дедлок
+        likes = sorted(likes)
+        with self._transaction() as cursor:
+            rows = self._execute(cursor, 'likes_insert',
+                                 [user_id for user_id, _ in likes],
+                                 [drawing_id for _, drawing_id in likes]).fetchall()
+            added = [(row['user_id'], row['drawing_id'], row['author_id']) for row in rows]
+            if not added:
+                return []
+            self._bump(cursor, 'feed')
+
+            # Одно обновление на пачку: счетчики рисунков и награды авторам
+            per_drawing = Counter(drawing_id for _, drawing_id, _ in added)
+            ids = sorted(per_drawing)
+            self._execute(cursor, 'drawings_lock', ids)
+            self._execute(cursor, 'drawing_likes_add', ids, [per_drawing[drawing_id] for drawing_id in ids])
+            per_author = Counter(author_id for _, _, author_id in added)
+            ids = sorted(per_author)
+            self._execute(cursor, 'users_lock', ids)
+            self._execute(cursor, 'authors_reward', ids, [per_author[author_id] for author_id in ids],
+                          LIKE_REWARD['experience'], LIKE_REWARD['coins'])
+        return added
+
+    # ---------- магазин ----------
+
+    def shop_items(self):
+        with self._transaction() as cursor:
+            return [dict(row) for row in self._execute(cursor, 'shop_items').fetchall()]
+
+    def buy_item(self, user_id, item_id, price):
+        with self._transaction() as cursor:
+            # Покупки одного пользователя идут по очереди (в SQLite - BEGIN IMMEDIATE):
+            # иначе две параллельные покупки обе пройдут проверку и спишут деньги дважды.
+            # Уникальный индекс idx_purchases_user_item - последняя защита
+            if not self._execute(cursor, 'user_lock', user_id).fetchone():
+                return NOT_ENOUGH_COINS, None
+            if self._execute(cursor, 'purchase_exists', user_id, item_id).fetchone():
+                return ALREADY_OWNED, None
+
+            # Списываем деньги, только если их хватает
+            row = self._execute(cursor, 'balance_charge', user_id, price).fetchone()
+            if not row:
+                return NOT_ENOUGH_COINS, None
+
+            self._execute(cursor, 'purchase_insert', user_id, item_id)
+            self._bump(cursor, 'users')
+            return PURCHASED, row['balance']
+
+    # ---------- статистика и рейтинг ----------
+
+    def get_stats(self):
+        with self._transaction() as cursor:
+            return dict(self._execute(cursor, 'stats').fetchone())
+
+    def leaderboard_snapshot(self, since):
+        with self._transaction() as cursor:
+            return {
+                'experience': [(row['id'], row['score'])
+                               for row in self._execute(cursor, 'board_experience').fetchall()],
+                'likes': [(row['user_id'], row['score'])
+                          for row in self._execute(cursor, 'board_likes').fetchall()],
+                'weekly': [(row['user_id'], row['score'])
+                           for row in self._execute(cursor, 'board_weekly', since).fetchall()],
+            }
+
+    # ---------- поколения кэша ----------
+
+    def read_generations(self, names):
+        with self._transaction() as cursor:
+            values = {row['name']: row['value'] for row in self._execute(cursor, 'generations_read').fetchall()}
+        return tuple(values.get(name, 0) for name in names)
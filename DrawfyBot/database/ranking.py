@@ -0,0 +1,151 @@
+import random
+
+MAX_LEVEL = 32
+P = 0.25
+
+
+class _Node:
+    __slots__ = ('key', 'next', 'width')
+
+    def __init__(self, key, level):
+        self.key = key
+        self.next = [None] * level
+        # width[i] - сколько узлов нижнего уровня перепрыгивает ссылка next[i]
+        self.width = [0] * level
+
+
+class RankedSet:
+    """Упорядоченное множество участников по очкам (индексируемый skip list)
+
+    Обновление очков, место участника и выборка top-N стоят O(log n).
+    Порядок: больше очков - выше; при равенстве выше меньший member.
+    """
+
+    def __init__(self):
+        self._head = _Node(None, MAX_LEVEL)
+        self._level = 1
+        self._size = 0
+        self._scores = {}
+
+    def __len__(self):
+        return self._size
+
+    def __contains__(self, member):
+        return member in self._scores
+
+    def score(self, member):
+        return self._scores.get(member)
+
+    def set(self, member, score):
+        """Установить очки участника"""
+        old = self._scores.get(member)
+        if old == score:
+            return
+        if old is not None:
+            self._delete((-old, member))
+        self._scores[member] = score
+        self._insert((-score, member))
+
+    def incr(self, member, delta):
+        """Добавить очки участнику. Возвращает новое значение"""
+        score = self._scores.get(member, 0) + delta
+        self.set(member, score)
+        return score
+
+    def remove(self, member):
+        old = self._scores.pop(member, None)
+        if old is not None:
+            self._delete((-old, member))
+
+    def rank(self, member):
+        """Место участника, начиная с 1 (None если его нет)"""
+        score = self._scores.get(member)
+        if score is None:
+            return None
+        key = (-score, member)
+        node, traversed = self._head, 0
+        for i in reversed(range(self._level)):
+            while node.next[i] is not None and node.next[i].key <= key:
+                traversed += node.width[i]
+                node = node.next[i]
+            if node.key == key:
+                return traversed
+        return None
+
+    def top(self, limit, offset=0):
+        """Участники на местах offset+1 .. offset+limit: [(member, score), ...]"""
+        if offset >= self._size or limit <= 0:
+            return []
+        node = self._by_rank(offset + 1)
+        result = []
+        while node is not None and len(result) < limit:
+            result.append((node.key[1], -node.key[0]))
+            node = node.next[0]
+        return result
+
+    def _by_rank(self, rank):
+        node, traversed = self._head, 0
+        for i in reversed(range(self._level)):
+            while node.next[i] is not None and traversed + node.width[i] <= rank:
+                traversed += node.width[i]
+                node = node.next[i]
+            if traversed == rank:
+                return node
+        return None
+
+    @staticmethod
+    def _random_level():
+        level = 1
+        while level < MAX_LEVEL and random.random() < P:
+            level += 1
+        return level
+
+    def _insert(self, key):
+        update = [None] * MAX_LEVEL
+        rank = [0] * MAX_LEVEL
+        node = self._head
+        for i in reversed(range(self._level)):
+            rank[i] = 0 if i == self._level - 1 else rank[i + 1]
+            while node.next[i] is not None and node.next[i].key < key:
+                rank[i] += node.width[i]
+                node = node.next[i]
+            update[i] = node
+
+        level = self._random_level()
+        if level > self._level:
+            for i in range(self._level, level):
+                rank[i] = 0
+                update[i] = self._head
+                self._head.width[i] = self._size
+            self._level = level
+
+        new = _Node(key, level)
+        for i in range(level):
+            new.next[i] = update[i].next[i]
+            update[i].next[i] = new
+            new.width[i] = update[i].width[i] - (rank[0] - rank[i])
+            update[i].width[i] = rank[0] - rank[i] + 1
+        for i in range(level, self._level):
+            update[i].width[i] += 1
+        self._size += 1
+
+    def _delete(self, key):
+        update = [None] * MAX_LEVEL
+        node = self._head
+        for i in reversed(range(self._level)):
+            while node.next[i] is not None and node.next[i].key < key:
+                node = node.next[i]
+            update[i] = node
+
+        target = node.next[0]
+        if target is None or target.key != key:
+            return
+        for i in range(self._level):
+            if update[i].next[i] is target:
+                update[i].width[i] += target.width[i] - 1
+                update[i].next[i] = target.next[i]
+            else:
+                update[i].width[i] -= 1
+        while self._level > 1 and self._head.next[self._level - 1] is None:
+            self._level -= 1
+        self._size -= 1
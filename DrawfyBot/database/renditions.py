@@ -0,0 +1,137 @@
+import io
+import os
+import tempfile
+
+from PIL import Image
+
+from database.layout import iter_drawing_files
+from database.strokes import raster_path
+from database.uploads import is_content_addressed
+
+# Ширины превью (px) и форматы. Оригинал не увеличивается: превью шире
+# рисунка сохраняется в исходном размере.
+RENDITION_WIDTHS = (160, 320, 640)
+RENDITION_FORMATS = ('webp', 'png')
+# Превью для плитки ленты по умолчанию
+THUMBNAIL = (320, 'webp')
+# Фото для Telegram (инлайн-режим принимает по ссылке только JPEG): само фото и его миниатюра.
+# В srcset не попадают и заранее не строятся
+TELEGRAM_PHOTO = (640, 'jpg')
+TELEGRAM_THUMBNAIL = (160, 'jpg')
+
+SAVE_OPTIONS = {
+    'webp': {'format': 'WEBP', 'quality': 80, 'method': 4},
+    'png': {'format': 'PNG', 'optimize': True},
+    'jpg': {'format': 'JPEG', 'quality': 85, 'optimize': True},
+}
+
+
+def rendition_url(filename, width, fmt):
+    """URL превью рисунка"""
+    stem = os.path.splitext(filename)[0]
+    return f"/static/renditions/{width}/{stem}.{fmt}"
+
+
+def rendition_urls(filename):
+    """Поля превью для ответа API: thumbnail_url и srcset по форматам"""
+    return {
+        'thumbnail_url': rendition_url(filename, *THUMBNAIL),
+        'srcset': {
+            fmt: ', '.join(f"{rendition_url(filename, width, fmt)} {width}w" for width in RENDITION_WIDTHS)
+            for fmt in RENDITION_FORMATS
+        },
+    }
+
+
+def telegram_photo_urls(filename):
+    """Ссылки на JPEG-фото рисунка и его миниатюру для результатов инлайн-режима"""
+    return {
+        'photo_url': rendition_url(filename, *TELEGRAM_PHOTO),
+        'photo_thumbnail_url': rendition_url(filename, *TELEGRAM_THUMBNAIL),
+    }
+
+
+def parse_rendition(width, name):
+    """(исходный файл, формат) для запрошенного превью или None, если такого превью не бывает"""
+    stem, ext = os.path.splitext(name)
+    fmt = ext.lstrip('.').lower()
+    if width not in RENDITION_WIDTHS or fmt not in SAVE_OPTIONS or not stem:
+        return None
+    return f"{stem}.png", fmt
+
+
+def render(source, target_path, width, fmt):
+    """Уменьшить рисунок (путь или файловый объект) до ширины width и сохранить в формате fmt
+
+    Файл пишется во временный и атомарно переименовывается, поэтому
+    параллельные запросы одного превью не увидят недописанный файл.
+    """
+    with Image.open(source) as image:
+        image.load()
+        if image.width > width:
+            height = max(1, round(image.height * width / image.width))
+            image = image.resize((width, height), Image.LANCZOS)
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA')
+        if fmt == 'jpg' and image.mode == 'RGBA':
+            # В JPEG нет прозрачности: холст белый, как на странице
+            background = Image.new('RGBA', image.size, (255, 255, 255, 255))
+            image = Image.alpha_composite(background, image).convert('RGB')
+
+        folder = os.path.dirname(target_path)
+        os.makedirs(folder, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=folder, prefix='.render-', suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                image.save(f, **SAVE_OPTIONS[fmt])
+            os.replace(temp_path, target_path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+
+def ensure_rendition(upload_folder, renditions_folder, filename, width, fmt, packs=None):
+    """Путь к превью; создается при первом запросе
+
+    Файл, названный по содержимому, не меняется, поэтому готового превью
+    достаточно; для старых имен превью пересоздается после замены оригинала.
+    Исходник ищется в файлах (рисунок из штрихов растрируется, database/strokes.py),
+    затем в сегментах packs (database/packs.py). None - если исходного рисунка нет.
+    """
+    source = raster_path(upload_folder, filename)
+    if source is None and packs is not None:
+        view = packs.get(filename)
+        if view is not None:
+            source = io.BytesIO(view)
+    if source is None:
+        return None
+    target_path = os.path.join(renditions_folder, str(width), f"{os.path.splitext(filename)[0]}.{fmt}")
+    try:
+        target_mtime = os.stat(target_path).st_mtime
+        # Записи в сегментах не перезаписываются
+        if is_content_addressed(filename) or not isinstance(source, str) or target_mtime >= os.stat(source).st_mtime:
+            return target_path
+    except FileNotFoundError:
+        pass
+    render(source, target_path, width, fmt)
+    return target_path
+
+
+def warm_renditions(upload_folder, renditions_folder, widths=RENDITION_WIDTHS, formats=RENDITION_FORMATS,
+                    packs=None):
+    """Создать недостающие превью для всех рисунков (и в файлах, и в сегментах). Возвращает (рисунков, ошибок)"""
+    drawings = errors = 0
+    filenames = [filename for filename, _ in iter_drawing_files(upload_folder)]
+    if packs is not None:
+        filenames += packs.filenames()
+    for filename in filenames:
+        drawings += 1
+        try:
+            for width in widths:
+                for fmt in formats:
+                    ensure_rendition(upload_folder, renditions_folder, filename, width, fmt, packs)
+        except Exception as e:
+            errors += 1
+            print(f"❌ {filename}: {e}")
+    return drawings, errors
@@ -0,0 +1,79 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+CachedResponse = namedtuple('CachedResponse', 'generations body etag mimetype')
+
+
+class ResponseCache:
+    """LRU-кэш готовых тел ответов, привязанных к поколениям данных
+
+    Запись действительна, пока поколения, от которых зависит маршрут,
+    совпадают с сохраненными. ETag - хэш тела, поэтому он строгий и
+    одинаковый во всех воркерах для одинакового ответа.
+    """
+
+    def __init__(self, max_entries=512):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, generations):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry.generations != generations:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, generations, body, mimetype):
+        entry = CachedResponse(generations, body, hashlib.sha256(body).hexdigest()[:32], mimetype)
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return entry
+
+
+class TTLCache:
+    """LRU-кэш значений, каждое из которых живет не дольше ttl секунд
+
+    Для ответов, которые нельзя привязать к поколениям (например, результаты
+    поиска, полученные ботом по HTTP): немного устаревший ответ допустим.
+    """
+
+    def __init__(self, max_entries=1000, ttl=60, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Значение или None, если его нет или оно устарело"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= self.clock():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (self.clock() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return value
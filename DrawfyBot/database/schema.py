@@ -0,0 +1,113 @@
+# Общие индексы и триггеры для обеих схем (app.py и database/db.py работают с одной базой)
+
+INDEXES = [
+    # Лента: только готовые рисунки, ORDER BY created_at DESC, id DESC и курсор (created_at, id)
+    "CREATE INDEX IF NOT EXISTS idx_drawings_ready_feed ON drawings (created_at DESC, id DESC) "
+    "WHERE processing_status = 'ready'",
+    # Работы пользователя в профиле
+    'CREATE INDEX IF NOT EXISTS idx_drawings_user_feed ON drawings (user_id, created_at DESC, id DESC)',
+    # Пересчет счетчиков и выборки по рисунку
+    'CREATE INDEX IF NOT EXISTS idx_likes_drawing ON likes (drawing_id)',
+    'CREATE INDEX IF NOT EXISTS idx_comments_drawing ON comments (drawing_id)',
+    # Товар покупается один раз: параллельные покупки не спишут деньги дважды
+    'CREATE UNIQUE INDEX IF NOT EXISTS idx_purchases_user_item ON purchases (user_id, item_id)',
+]
+
+# Уникальные индексы: имя -> удаление дублей, которые могли появиться до индекса
+DEDUPLICATE = {
+    'idx_purchases_user_item': '''
+        DELETE FROM purchases WHERE id NOT IN (SELECT MIN(id) FROM purchases GROUP BY user_id, item_id)
+    ''',
+}
+
+# Индексы, которые заменены другими из INDEXES
+DROPPED_INDEXES = [
+    'idx_drawings_feed',
+]
+
+# Колонки, добавленные после первой версии схемы: (таблица, колонка, определение).
+# SQLite добавляет их через add_column, PostgreSQL - ALTER TABLE ... ADD COLUMN IF NOT EXISTS
+COLUMNS = [
+    # Фоновая обработка загрузки: pending -> processing -> ready | failed
+    ('drawings', 'processing_status', "TEXT NOT NULL DEFAULT 'ready'"),
+    ('drawings', 'processing_error', 'TEXT'),
+    # Размер загрузки и размер после перекодирования (database/ingest.py), байт
+    ('drawings', 'original_size', 'INTEGER'),
+    ('drawings', 'stored_size', 'INTEGER'),
+]
+
+# Денормализованные счетчики в drawings: таблица -> колонка
+COUNTERS = {
+    'likes': 'like_count',
+    'comments': 'comment_count',
+}
+
+
+def table_exists(cursor, table):
+    """Есть ли таблица в базе"""
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,))
+    return cursor.fetchone() is not None
+
+
+def add_column(cursor, table, column, definition):
+    """Добавить колонку, если ее нет. True - если колонка добавлена сейчас"""
+    cursor.execute(f'PRAGMA table_info({table})')
+    if column in [row[1] for row in cursor.fetchall()]:
+        return False
+    cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+    return True
+
+
+def add_columns(cursor):
+    """Добавить недостающие колонки из COLUMNS"""
+    for table, column, definition in COLUMNS:
+        if table_exists(cursor, table):
+            add_column(cursor, table, column, definition)
+
+
+def create_indexes(cursor):
+    """Создать индексы, если их еще нет, и удалить замененные"""
+    for name in DROPPED_INDEXES:
+        cursor.execute(f'DROP INDEX IF EXISTS {name}')
+    for statement in INDEXES:
+        table = statement.split(' ON ')[1].split()[0]
+        if not table_exists(cursor, table):
+            continue
+        name = index_name(statement)
+        if name in DEDUPLICATE:
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = ?", (name,))
+            if cursor.fetchone() is None:
+                cursor.execute(DEDUPLICATE[name])
+        cursor.execute(statement)
+
+
+def index_name(statement):
+    """Имя индекса из CREATE [UNIQUE] INDEX IF NOT EXISTS <имя> ON ..."""
+    return statement.split(' ON ')[0].split()[-1]
+
+
+def create_counters(cursor):
+    """Колонки like_count/comment_count и триггеры, которые держат их в актуальном состоянии"""
+    from database.counters import reconcile_counters
+
+    added = False
+    for table, column in COUNTERS.items():
+        added |= add_column(cursor, 'drawings', column, 'INTEGER NOT NULL DEFAULT 0')
+        if not table_exists(cursor, table):
+            continue
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_{table}_count_insert AFTER INSERT ON {table}
+            BEGIN
+                UPDATE drawings SET {column} = {column} + 1 WHERE id = NEW.drawing_id;
+            END
+        ''')
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_{table}_count_delete AFTER DELETE ON {table}
+            BEGIN
+                UPDATE drawings SET {column} = {column} - 1 WHERE id = OLD.drawing_id;
+            END
+        ''')
+
+    # Колонки только что появились в существующей базе - заполняем их
+    if added:
+        reconcile_counters(cursor)
@@ -0,0 +1,111 @@
+import re
+
+# Поиск рисунков по названию, описанию и автору (инлайн-режим бота).
+# SQLite - полнотекстовый индекс FTS5, PostgreSQL - tsvector с GIN-индексом;
+# оба поддерживаются триггерами, поэтому индекс не расходится с таблицами.
+# Каждое слово запроса ищется как префикс: "кот ры" находит "Рыжий кот".
+SEARCH_LIMIT = 20
+# Слов запроса, которые учитываются (остальные отбрасываются)
+MAX_TERMS = 8
+# Без подчеркивания: токенизаторы обеих баз считают его разделителем
+TERM = re.compile(r'[^\W_]+')
+
+# Вес совпадения в названии, описании и имени автора
+TITLE_WEIGHT = 10.0
+DESCRIPTION_WEIGHT = 3.0
+AUTHOR_WEIGHT = 5.0
+
+AUTHOR_TEXT = "COALESCE(first_name, '') || ' ' || COALESCE(last_name, '') || ' ' || COALESCE(username, '')"
+
+
+def search_terms(text):
+    """Слова запроса в нижнем регистре"""
+    return TERM.findall((text or '').lower())[:MAX_TERMS]
+
+
+def search_page(rows, limit, offset):
+    """Обрезать выборку из limit + 1 строк; следующее смещение или None"""
+    rows = list(rows)
+    if len(rows) <= limit:
+        return rows, None
+    return rows[:limit], offset + limit
+
+
+# ---------- SQLite ----------
+
+def fts_query(text):
+    """Запрос FTS5: все слова как префиксы; None - искать нечего"""
+    terms = search_terms(text)
+    return ' '.join(f'"{term}"*' for term in terms) if terms else None
+
+
+def create_search(cursor):
+    """Индекс FTS5 (rowid = id рисунка) и триггеры, которые держат его в актуальном состоянии"""
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'drawings_fts'")
+    exists = cursor.fetchone() is not None
+    cursor.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS drawings_fts USING fts5(
+            title, description, author,
+            tokenize = 'unicode61 remove_diacritics 2'
+        )
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_drawings_fts_insert AFTER INSERT ON drawings
+        BEGIN
+            INSERT INTO drawings_fts (rowid, title, description, author)
+            SELECT NEW.id, NEW.title, COALESCE(NEW.description, ''), {AUTHOR_TEXT}
+            FROM users WHERE id = NEW.user_id;
+        END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_drawings_fts_update AFTER UPDATE OF title, description, user_id ON drawings
+        BEGIN
+            DELETE FROM drawings_fts WHERE rowid = OLD.id;
+            INSERT INTO drawings_fts (rowid, title, description, author)
+            SELECT NEW.id, NEW.title, COALESCE(NEW.description, ''), {AUTHOR_TEXT}
+            FROM users WHERE id = NEW.user_id;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_drawings_fts_delete AFTER DELETE ON drawings
+        BEGIN
+            DELETE FROM drawings_fts WHERE rowid = OLD.id;
+        END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_users_fts_update AFTER UPDATE OF first_name, last_name, username ON users
+        BEGIN
+            UPDATE drawings_fts SET author = (SELECT {AUTHOR_TEXT} FROM users WHERE id = NEW.id)
+            WHERE rowid IN (SELECT id FROM drawings WHERE user_id = NEW.id);
+        END
+    ''')
+    if not exists:
+        # Рисунки, загруженные до появления индекса
+        cursor.execute(f'''
+            INSERT INTO drawings_fts (rowid, title, description, author)
+            SELECT d.id, d.title, COALESCE(d.description, ''),
+                   (SELECT {AUTHOR_TEXT} FROM users WHERE id = d.user_id)
+            FROM drawings d
+        ''')
+
+
+def search_drawings(cursor, query, limit, offset):
+    """Строки ленты по запросу FTS5, самые подходящие первыми (limit + 1 строк)"""
+    cursor.execute(f'''
+        SELECT d.*, u.username, u.first_name, u.last_name
+        FROM drawings_fts f
+        JOIN drawings d ON d.id = f.rowid
+        JOIN users u ON u.id = d.user_id
+        WHERE drawings_fts MATCH ? AND d.processing_status = 'ready'
+        ORDER BY bm25(drawings_fts, {TITLE_WEIGHT}, {DESCRIPTION_WEIGHT}, {AUTHOR_WEIGHT}), d.id DESC
+        LIMIT ? OFFSET ?
+    ''', (query, limit + 1, offset))
+    return cursor.fetchall()
+
+
+# ---------- PostgreSQL ----------
+
+def ts_query(text):
+    """Запрос to_tsquery('simple', ...): все слова как префиксы; None - искать нечего"""
+    terms = search_terms(text)
+    return ' & '.join(f'{term}:*' for term in terms) if terms else None
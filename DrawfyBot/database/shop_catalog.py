@@ -0,0 +1,73 @@
+import hashlib
+import json
+import threading
+import time
+from collections import namedtuple
+
+Catalog = namedtuple('Catalog', 'version items by_id by_type bodies')
+
+
+class ShopCatalog:
+    """Каталог магазина, загруженный в память воркера
+
+    Каталог меняется только при заполнении базы, поэтому он читается один
+    раз и перечитывается, только когда меняется поколение 'shop'. Версию
+    проверяем не чаще раза в check_interval секунд. Готовые JSON-тела
+    списка (весь каталог и по типам) собираются при загрузке.
+    """
+
+    def __init__(self, storage, check_interval=30):
+        self.storage = storage
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._catalog = None
+        self._checked_at = 0
+
+    def _load(self, version):
+        items = tuple(self.storage.shop_items())
+        by_type = {}
+        for item in items:
+            by_type.setdefault(item.get('type'), []).append(item)
+
+        bodies = {None: self._body(items)}
+        for item_type, typed in by_type.items():
+            bodies[item_type] = self._body(typed)
+        return Catalog(version, items, {item['id']: item for item in items},
+                       {key: tuple(value) for key, value in by_type.items()}, bodies)
+
+    @staticmethod
+    def _body(items):
+        """(тело, etag) ответа со списком товаров"""
+        body = json.dumps({'success': True, 'items': list(items)},
+                          ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        return body, hashlib.sha256(body).hexdigest()[:32]
+
+    def current(self):
+        """Актуальный каталог (перечитывается при смене версии)"""
+        catalog = self._catalog
+        if catalog is not None and time.monotonic() - self._checked_at < self.check_interval:
+            return catalog
+
+        with self._lock:
+            version = self.storage.read_generations(('shop',))[0]
+            if self._catalog is None or self._catalog.version != version:
+                self._catalog = self._load(version)
+            self._checked_at = time.monotonic()
+            return self._catalog
+
+    def get(self, item_id):
+        """Товар по id или None"""
+        try:
+            return self.current().by_id.get(int(item_id))
+        except (TypeError, ValueError):
+            return None
+
+    def items(self, item_type=None):
+        """Товары (по возрастанию цены), при необходимости только одного типа"""
+        catalog = self.current()
+        return catalog.items if item_type is None else catalog.by_type.get(item_type, ())
+
+    def body(self, item_type=None):
+        """Готовое JSON-тело списка и его ETag"""
+        catalog = self.current()
+        return catalog.bodies.get(item_type) or self._body(())
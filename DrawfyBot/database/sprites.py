@@ -0,0 +1,212 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+from PIL import Image
+
+from database.renditions import RENDITION_WIDTHS, ensure_rendition
+
+# Лист превью для страницы ленты: плитки TILE x TILE по SHEET_COLUMNS в ряд.
+# Имя листа - хэш списка рисунков, поэтому лист под именем не меняется;
+# новая первая страница дает новый лист.
+TILE = RENDITION_WIDTHS[0]
+SHEET_COLUMNS = 5
+# Без потерь: плитки вырезаются из прежнего листа и не должны портиться
+# от пересжатия; рисунки из плоских цветов так сжимаются даже лучше
+SHEET_OPTIONS = {'format': 'WEBP', 'lossless': True, 'quality': 80, 'method': 4}
+# Сколько последних листов помнить для повторного использования плиток
+RECENT_SHEETS = 16
+# Лист старше этого (с) удаляет manage.py gc-sprites: каждая новая страница
+# ленты дает новый лист, и без сборки папка растет без предела
+SHEET_MAX_AGE = 7 * 24 * 60 * 60
+
+
+class SpriteSheets:
+    """Листы превью (WebP) для страниц ленты, с координатами каждой плитки
+
+    Рядом с листом лежит <имя>.json с координатами. Когда первая страница
+    сдвигается на новый рисунок, почти все плитки уже есть в предыдущем
+    листе: они вырезаются оттуда, и с нуля строятся только новые.
+    """
+
+    def __init__(self, upload_folder, renditions_folder, sprites_folder, packs=None):
+        self.upload_folder = upload_folder
+        self.renditions_folder = renditions_folder
+        self.sprites_folder = sprites_folder
+        self.packs = packs
+        os.makedirs(sprites_folder, exist_ok=True)
+        # имя листа -> координаты плиток {filename: [x, y, w, h]}, последние используемые в конце
+        self._recent = OrderedDict()
+        self._lock = threading.Lock()
+        self._building = {}
+
+    def sheet_name(self, filenames):
+        key = hashlib.sha256(f"{TILE}:{SHEET_COLUMNS}:{','.join(filenames)}".encode()).hexdigest()
+        return f"{key}.webp"
+
+    def sheet_for(self, filenames):
+        """Лист для рисунков в порядке ленты: {'url', 'width', 'height', 'tiles': {filename: [x, y, w, h]}}
+
+        Лист строится при первом запросе; None - если ни одной плитки не нашлось.
+        """
+        if not filenames:
+            return None
+        name = self.sheet_name(filenames)
+        manifest = self._load(name)
+        if manifest is None:
+            # Один поток строит, остальные запросы того же листа ждут его
+            with self._lock:
+                event = self._building.get(name)
+                owner = event is None
+                if owner:
+                    event = self._building[name] = threading.Event()
+            if owner:
+                try:
+                    manifest = self._build(name, filenames)
+                finally:
+                    with self._lock:
+                        self._building.pop(name, None)
+                    event.set()
+            else:
+                event.wait()
+                manifest = self._load(name)
+        if not manifest or not manifest['tiles']:
+            return None
+        return {'url': f"/static/sprites/{name}", **manifest}
+
+    def _path(self, name):
+        return os.path.join(self.sprites_folder, name)
+
+    def _remember(self, name, manifest):
+        with self._lock:
+            self._recent[name] = manifest
+            self._recent.move_to_end(name)
+            while len(self._recent) > RECENT_SHEETS:
+                self._recent.popitem(last=False)
+
+    def _load(self, name):
+        """Координаты готового листа (из памяти или с диска) или None"""
+        with self._lock:
+            manifest = self._recent.get(name)
+        if manifest is not None:
+            if os.path.exists(self._path(name)):
+                return manifest
+            # Лист удалил gc-sprites - строится заново
+            with self._lock:
+                self._recent.pop(name, None)
+            return None
+        try:
+            with open(f"{self._path(name)}.json") as f:
+                manifest = json.load(f)
+        except FileNotFoundError:
+            return None
+        if not os.path.exists(self._path(name)):
+            return None
+        self._remember(name, manifest)
+        return manifest
+
+    def _reusable(self, filenames):
+        """{filename: (лист, [x, y, w, h])} для плиток, которые уже есть в недавних листах"""
+        wanted = set(filenames)
+        found = {}
+        with self._lock:
+            recent = list(self._recent.items())
+        for name, manifest in reversed(recent):
+            for filename, rect in manifest['tiles'].items():
+                if filename in wanted and filename not in found:
+                    found[filename] = (name, rect)
+        return found
+
+    def _tile(self, filename):
+        """Превью рисунка, вписанное в TILE x TILE, или None"""
+        path = ensure_rendition(self.upload_folder, self.renditions_folder, filename, TILE, 'webp', self.packs)
+        if path is None:
+            return None
+        with Image.open(path) as image:
+            image = image.convert('RGBA')
+        image.thumbnail((TILE, TILE))
+        return image
+
+    def _build(self, name, filenames):
+        rows = (len(filenames) + SHEET_COLUMNS - 1) // SHEET_COLUMNS
+        width, height = min(len(filenames), SHEET_COLUMNS) * TILE, rows * TILE
+        sheet = Image.new('RGBA', (width, height), (0, 0, 0, 0))
+        reusable = self._reusable(filenames)
+        opened = {}
+        tiles = {}
+        try:
+            for index, filename in enumerate(filenames):
+                x, y = index % SHEET_COLUMNS * TILE, index // SHEET_COLUMNS * TILE
+                tile = None
+                if filename in reusable:
+                    source, (sx, sy, sw, sh) = reusable[filename]
+                    try:
+                        if source not in opened:
+                            opened[source] = Image.open(self._path(source))
+                        tile = opened[source].crop((sx, sy, sx + sw, sy + sh))
+                    except FileNotFoundError:
+                        tile = None
+                if tile is None:
+                    try:
+                        tile = self._tile(filename)
+                    except (OSError, ValueError) as e:
+                        print(f"❌ Плитка {filename}: {e}")
+                if tile is None:
+                    continue
+                sheet.paste(tile, (x, y))
+                tiles[filename] = [x, y, tile.width, tile.height]
+        finally:
+            for image in opened.values():
+                image.close()
+
+        manifest = {'width': width, 'height': height, 'tiles': tiles}
+        if tiles:
+            self._write(name, sheet, manifest)
+        self._remember(name, manifest)
+        return manifest
+
+    def _write(self, name, sheet, manifest):
+        """Лист и координаты пишутся во временные файлы и атомарно переименовываются"""
+        path = self._path(name)
+        self._replace(path, lambda f: sheet.save(f, **SHEET_OPTIONS))
+        self._replace(f"{path}.json", lambda f: f.write(json.dumps(manifest).encode()))
+
+    def _replace(self, path, write):
+        """Записать файл через свой временный файл: параллельные воркеры не мешают друг другу"""
+        fd, temp_path = tempfile.mkstemp(dir=self.sprites_folder, prefix='.sprite-', suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                write(f)
+            os.replace(temp_path, path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+
+def collect_sprites(sprites_folder, max_age=SHEET_MAX_AGE):
+    """Удалить листы старше max_age вместе с координатами и брошенные временные файлы
+
+    Листы называются по списку рисунков и не привязаны к поколению кэша,
+    поэтому старые листы находятся по времени записи. Лист страницы, которую
+    еще запрашивают, воркер построит заново. Возвращает (файлов, байт).
+    """
+    deadline = time.time() - max_age
+    removed = freed = 0
+    for entry in os.scandir(sprites_folder):
+        if not entry.is_file() or not entry.name.endswith(('.webp', '.webp.json', '.part')):
+            continue
+        try:
+            stat = entry.stat()
+            if stat.st_mtime >= deadline:
+                continue
+            os.remove(entry.path)
+        except FileNotFoundError:
+            continue
+        removed += 1
+        freed += stat.st_size
+    return removed, freed
@@ -0,0 +1,431 @@
+from database.blobs import create_blobs, register_blob, rename_blob_references
+from database.connection import get_pool
+from database.generations import bump_generation, create_generations, read_generations
+from database.leaderboard import create_leaderboard
+from database.likes import has_liked, record_likes
+from database.pagination import keyset_page
+from database.phash import (DUPLICATE_DISTANCE, closest, create_phashes, own_phash_candidates, phash_candidates,
+                            record_phash)
+from database.schema import add_column, add_columns, create_counters, create_indexes
+from database.search import create_search, fts_query, search_drawings, search_page
+from database.storage import (ALREADY_OWNED, DRAWING_READY, NOT_ENOUGH_COINS, PURCHASED, SHOP_ITEMS,
+                              TEST_USER_BALANCE, TEST_USERS, Storage)
+from database.user_stats import create_user_stats
+
+TABLES = [
+    # Таблица пользователей (из Telegram)
+    '''
+    CREATE TABLE IF NOT EXISTS users (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        telegram_id INTEGER UNIQUE NOT NULL,
+        username TEXT,
+        first_name TEXT,
+        last_name TEXT,
+        balance INTEGER DEFAULT 100,
+        experience INTEGER DEFAULT 0,
+        level INTEGER DEFAULT 1,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    ''',
+    # Таблица рисунков
+    '''
+    CREATE TABLE IF NOT EXISTS drawings (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        title TEXT NOT NULL,
+        description TEXT,
+        filename TEXT NOT NULL,
+        likes INTEGER DEFAULT 0,
+        views INTEGER DEFAULT 0,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (user_id) REFERENCES users (id)
+    )
+    ''',
+    # Таблица лайков
+    '''
+    CREATE TABLE IF NOT EXISTS likes (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        drawing_id INTEGER NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        UNIQUE(user_id, drawing_id),
+        FOREIGN KEY (user_id) REFERENCES users (id),
+        FOREIGN KEY (drawing_id) REFERENCES drawings (id)
+    )
+    ''',
+    # Таблица комментариев
+    '''
+    CREATE TABLE IF NOT EXISTS comments (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        drawing_id INTEGER NOT NULL,
+        text TEXT NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (user_id) REFERENCES users (id),
+        FOREIGN KEY (drawing_id) REFERENCES drawings (id)
+    )
+    ''',
+    # Таблица товаров магазина
+    '''
+    CREATE TABLE IF NOT EXISTS shop_items (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL,
+        description TEXT,
+        price INTEGER NOT NULL,
+        type TEXT,
+        image_url TEXT
+    )
+    ''',
+    # Таблица покупок
+    '''
+    CREATE TABLE IF NOT EXISTS purchases (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        item_id INTEGER NOT NULL,
+        purchased_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (user_id) REFERENCES users (id),
+        FOREIGN KEY (item_id) REFERENCES shop_items (id)
+    )
+    ''',
+]
+
+
+class SQLiteStorage(Storage):
+    """Хранилище в одном файле SQLite (пул соединений database/connection.py)"""
+
+    name = 'sqlite'
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.pool = get_pool(db_path)
+
+    def init_schema(self):
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            for statement in TABLES:
+                cursor.execute(statement)
+            # Базы, созданные старой схемой database/db.py (одна колонка full_name)
+            add_column(cursor, 'users', 'first_name', 'TEXT')
+            add_column(cursor, 'users', 'last_name', 'TEXT')
+            add_column(cursor, 'shop_items', 'image_url', 'TEXT')
+            add_columns(cursor)
+
+            # Добавляем тестовые товары если таблица пуста
+            cursor.execute('SELECT COUNT(*) FROM shop_items')
+            catalog_changed = cursor.fetchone()[0] == 0
+            if catalog_changed:
+                cursor.executemany(
+                    'INSERT INTO shop_items (name, description, price, type, image_url) VALUES (?, ?, ?, ?, ?)',
+                    SHOP_ITEMS
+                )
+
+            # Добавляем тестовых пользователей если нужно
+            cursor.execute('SELECT COUNT(*) FROM users')
+            if cursor.fetchone()[0] == 0:
+                cursor.executemany(
+                    'INSERT INTO users (telegram_id, username, first_name, last_name, balance) VALUES (?, ?, ?, ?, ?)',
+                    [(id, user, first, last, TEST_USER_BALANCE) for id, user, first, last in TEST_USERS]
+                )
+
+            create_blobs(cursor)
+            create_phashes(cursor)
+            create_counters(cursor)
+            create_user_stats(cursor)
+            create_leaderboard(cursor)
+            create_generations(cursor)
+            create_search(cursor)
+            create_indexes(cursor)
+
+            # Каталог изменился - воркеры перечитают его из базы
+            if catalog_changed:
+                bump_generation(cursor, 'shop')
+
+    # ---------- пользователи ----------
+
+    def get_user(self, telegram_id):
+        with self.pool.connection() as conn:
+            row = conn.execute('SELECT * FROM users WHERE telegram_id = ?', (telegram_id,)).fetchone()
+        return dict(row) if row else None
+
+    def get_or_create_user(self, telegram_id, username=None, first_name=None, last_name=None):
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+
+            cursor.execute('SELECT * FROM users WHERE telegram_id = ?', (telegram_id,))
+            user = cursor.fetchone()
+
+            if not user:
+                cursor.execute('''
+                    INSERT OR IGNORE INTO users (telegram_id, username, first_name, last_name)
+                    VALUES (?, ?, ?, ?)
+                ''', (telegram_id, username, first_name, last_name))
+                cursor.execute('SELECT * FROM users WHERE telegram_id = ?', (telegram_id,))
+                user = cursor.fetchone()
+
+        return dict(user) if user else None
+
+    def user_names(self, user_ids):
+        ids = list(user_ids)
+        with self.pool.connection() as conn:
+            rows = conn.execute(f'''
+                SELECT id, telegram_id, username, first_name, last_name FROM users
+                WHERE id IN ({','.join('?' * len(ids))})
+            ''', ids).fetchall()
+        return {row['id']: dict(row) for row in rows}
+
+    def get_profile(self, user_id):
+        with self.pool.connection() as conn:
+            # Пользователь и готовая статистика - один поиск по первичному ключу
+            row = conn.execute('''
+                SELECT
+                    u.*,
+                    COALESCE(s.drawings_count, 0) AS drawings_count,
+                    COALESCE(s.total_likes, 0) AS total_likes,
+                    COALESCE(s.unique_likers, 0) AS unique_likers,
+                    s.last_upload_at
+                FROM users u
+                LEFT JOIN user_stats s ON s.user_id = u.id
+                WHERE u.id = ?
+            ''', (user_id,)).fetchone()
+        return dict(row) if row else None
+
+    # ---------- рисунки ----------
+
+    def add_drawing(self, user_id, title, description, filename, reward=None, status=DRAWING_READY, size=None,
+                    original_size=None, phash=None):
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            if size is not None:
+                register_blob(cursor, filename, size)
+            cursor.execute('''
+                INSERT INTO drawings (user_id, title, description, filename, processing_status,
+                                      original_size, stored_size)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', (user_id, title, description, filename, status, original_size, size))
+            drawing_id = cursor.lastrowid
+            if phash is not None:
+                record_phash(cursor, drawing_id, phash)
+
+            if reward:
+                cursor.execute('UPDATE users SET experience = experience + ?, balance = balance + ? WHERE id = ?',
+                               (reward['experience'], reward['coins'], user_id))
+            bump_generation(cursor, 'feed')
+        return drawing_id
+
+    def complete_upload(self, drawing_id, filename, size, phash, reward=None):
+        with self.pool.connection(immediate=True) as conn:
+            cursor = conn.cursor()
+            # BEGIN IMMEDIATE: другая загрузка не запишет хэш между проверкой и наградой
+            row = cursor.execute('SELECT user_id, filename FROM drawings WHERE id = ?', (drawing_id,)).fetchone()
+            if row is None:
+                return None
+            if row['filename'] != filename:
+                register_blob(cursor, filename, size)
+                cursor.execute('UPDATE drawings SET filename = ?, stored_size = ? WHERE id = ?',
+                               (filename, size, drawing_id))
+                cursor.execute('UPDATE blobs SET refcount = refcount + 1 WHERE filename = ?', (filename,))
+                cursor.execute('UPDATE blobs SET refcount = refcount - 1 WHERE filename = ?', (row['filename'],))
+            duplicates = closest(phash, own_phash_candidates(cursor, phash, row['user_id'], drawing_id),
+                                 DUPLICATE_DISTANCE, 1)
+            record_phash(cursor, drawing_id, phash)
+            if reward and not duplicates:
+                cursor.execute('UPDATE users SET experience = experience + ?, balance = balance + ? WHERE id = ?',
+                               (reward['experience'], reward['coins'], row['user_id']))
+            bump_generation(cursor, 'feed')
+        return duplicates[0][0] if duplicates else None
+
+    def set_drawing_status(self, drawing_id, status, error=None):
+        with self.pool.connection() as conn:
+            conn.execute('UPDATE drawings SET processing_status = ?, processing_error = ? WHERE id = ?',
+                         (status, error, drawing_id))
+            bump_generation(conn.cursor(), 'feed')
+
+    def feed_page(self, limit, before=None):
+        where, params = '', []
+        if before:
+            where, params = 'AND (d.created_at, d.id) < (?, ?)', list(before)
+
+        with self.pool.connection() as conn:
+            # Курсор по (created_at, id) идет по частичному индексу idx_drawings_ready_feed,
+            # поэтому любая страница стоит столько же, сколько первая.
+            # Необработанные и отклоненные загрузки в ленту не попадают.
+            # like_count и comment_count поддерживаются триггерами (database/schema.py)
+            cursor = conn.execute(f'''
+                SELECT
+                    d.*,
+                    u.username,
+                    u.first_name,
+                    u.last_name
+                FROM drawings d
+                JOIN users u ON d.user_id = u.id
+                WHERE d.processing_status = '{DRAWING_READY}' {where}
+                ORDER BY d.created_at DESC, d.id DESC
+                LIMIT ?
+            ''', params + [limit + 1])
+            rows, next_cursor = keyset_page(cursor.fetchall(), limit)
+        return [dict(row) for row in rows], next_cursor
+
+    def drawing_phash(self, drawing_id):
+        with self.pool.connection() as conn:
+            row = conn.execute('SELECT hash FROM drawing_phashes WHERE drawing_id = ?', (drawing_id,)).fetchone()
+        return row[0] if row else None
+
+    def set_drawing_phash(self, drawing_id, phash):
+        with self.pool.connection() as conn:
+            record_phash(conn.cursor(), drawing_id, phash)
+
+    def drawings_without_phash(self, after_id, limit):
+        with self.pool.connection() as conn:
+            rows = conn.execute('''
+                SELECT d.id, d.filename FROM drawings d
+                LEFT JOIN drawing_phashes p ON p.drawing_id = d.id
+                WHERE d.id > ? AND p.drawing_id IS NULL
+                ORDER BY d.id
+                LIMIT ?
+            ''', (after_id, limit)).fetchall()
+        return [tuple(row) for row in rows]
+
+    def similar_drawings(self, phash, max_distance, limit, exclude_id=None):
+        with self.pool.connection() as conn:
+            candidates = [(drawing_id, value) for drawing_id, value in phash_candidates(conn.cursor(), phash)
+                          if drawing_id != exclude_id]
+            found = closest(phash, candidates, max_distance, limit)
+            if not found:
+                return []
+            ids = [drawing_id for drawing_id, _ in found]
+            rows = conn.execute(f'''
+                SELECT d.*, u.username, u.first_name, u.last_name
+                FROM drawings d
+                JOIN users u ON d.user_id = u.id
+                WHERE d.id IN ({','.join('?' * len(ids))})
+            ''', ids).fetchall()
+        drawings = {row['id']: dict(row) for row in rows}
+        return [{**drawings[drawing_id], 'distance': d} for drawing_id, d in found if drawing_id in drawings]
+
+    def search_drawings(self, query, limit, offset=0):
+        match = fts_query(query)
+        if match is None:
+            return [], None
+        with self.pool.connection() as conn:
+            rows = search_drawings(conn.cursor(), match, limit, offset)
+        rows, next_offset = search_page(rows, limit, offset)
+        return [dict(row) for row in rows], next_offset
+
+    def user_drawings(self, user_id, limit=None):
+        with self.pool.connection() as conn:
+            rows = conn.execute('''
+                SELECT * FROM drawings
+                WHERE user_id = ? AND processing_status = ?
+                ORDER BY created_at DESC, id DESC
+                LIMIT ?
+            ''', (user_id, DRAWING_READY, -1 if limit is None else limit)).fetchall()
+        return [dict(row) for row in rows]
+
+    def add_views(self, counts):
+        with self.pool.connection(immediate=True) as conn:
+            conn.executemany('UPDATE drawings SET views = views + ? WHERE id = ?',
+                             [(count, drawing_id) for drawing_id, count in sorted(counts.items())])
+            bump_generation(conn.cursor(), 'views')
+
+    # ---------- файлы рисунков ----------
+
+    def rename_drawing_file(self, old, new, size):
+        with self.pool.connection(immediate=True) as conn:
+            cursor = conn.cursor()
+            moved = rename_blob_references(cursor, old, new, size)
+            if moved:
+                bump_generation(cursor, 'feed')
+        return moved
+
+    def delete_unreferenced_blobs(self, remove):
+        deleted = 0
+        # Блокировка записи: новая ссылка на файл не появится, пока он удаляется
+        with self.pool.connection(immediate=True) as conn:
+            rows = conn.execute('SELECT filename FROM blobs WHERE refcount <= 0').fetchall()
+            for row in rows:
+                if remove(row['filename']):
+                    conn.execute('DELETE FROM blobs WHERE filename = ? AND refcount <= 0', (row['filename'],))
+                    deleted += 1
+        return deleted
+
+    def size_report(self):
+        with self.pool.connection() as conn:
+            row = conn.execute('''
+                SELECT
+                    (SELECT COUNT(*) FROM drawings WHERE original_size IS NOT NULL) AS drawings,
+                    (SELECT COALESCE(SUM(original_size), 0) FROM drawings) AS original_bytes,
+                    (SELECT COALESCE(SUM(stored_size), 0) FROM drawings WHERE original_size IS NOT NULL) AS stored_bytes,
+                    (SELECT COUNT(*) FROM blobs WHERE refcount > 0) AS blobs,
+                    (SELECT COALESCE(SUM(size), 0) FROM blobs WHERE refcount > 0) AS blob_bytes
+            ''').fetchone()
+        return dict(row)
+
+    # ---------- лайки ----------
+
+    def has_liked(self, user_id, drawing_id):
+        with self.pool.connection() as conn:
+            return has_liked(conn.cursor(), user_id, drawing_id)
+
+    def add_likes(self, likes):
+        with self.pool.connection(immediate=True) as conn:
+            return record_likes(conn.cursor(), likes)
+
+    # ---------- магазин ----------
+
+    def shop_items(self):
+        with self.pool.connection() as conn:
+            return [dict(row) for row in conn.execute('SELECT * FROM shop_items ORDER BY price')]
+
+    def buy_item(self, user_id, item_id, price):
+        with self.pool.connection(immediate=True) as conn:
+            cursor = conn.cursor()
+
+            # Проверяем, не куплен ли уже
+            cursor.execute('SELECT id FROM purchases WHERE user_id = ? AND item_id = ?', (user_id, item_id))
+            if cursor.fetchone():
+                return ALREADY_OWNED, None
+
+            # Списываем деньги, только если их хватает
+            cursor.execute('UPDATE users SET balance = balance - ? WHERE id = ? AND balance >= ?',
+                           (price, user_id, price))
+            if not cursor.rowcount:
+                return NOT_ENOUGH_COINS, None
+
+            cursor.execute('INSERT INTO purchases (user_id, item_id) VALUES (?, ?)', (user_id, item_id))
+            bump_generation(cursor, 'users')
+            cursor.execute('SELECT balance FROM users WHERE id = ?', (user_id,))
+            return PURCHASED, cursor.fetchone()[0]
+
+    # ---------- статистика и рейтинг ----------
+
+    def get_stats(self):
+        with self.pool.connection() as conn:
+            total_users, total_drawings, total_likes = conn.execute('''
+                SELECT
+                    (SELECT COUNT(*) FROM users),
+                    (SELECT COUNT(*) FROM drawings),
+                    (SELECT COALESCE(SUM(likes), 0) FROM drawings)
+            ''').fetchone()
+        return {
+            'total_users': total_users,
+            'total_drawings': total_drawings,
+            'total_likes': total_likes
+        }
+
+    def leaderboard_snapshot(self, since):
+        with self.pool.connection() as conn:
+            return {
+                'experience': [tuple(row) for row in conn.execute(
+                    'SELECT id, COALESCE(experience, 0) FROM users')],
+                'likes': [tuple(row) for row in conn.execute(
+                    'SELECT user_id, total_likes FROM user_stats WHERE total_likes > 0')],
+                'weekly': [tuple(row) for row in conn.execute(
+                    'SELECT user_id, SUM(likes) FROM like_buckets WHERE day >= ? GROUP BY user_id',
+                    (since,))],
+            }
+
+    # ---------- поколения кэша ----------
+
+    def read_generations(self, names):
+        with self.pool.connection() as conn:
+            return read_generations(conn.cursor(), names)
@@ -0,0 +1,237 @@
+import hashlib
+import os
+import tempfile
+
+from PIL import Image, ImageDraw
+
+from database.ingest import MAX_DIMENSION, MAX_PIXELS
+from database.layout import drawing_path
+from database.phash import image_dhash
+from database.uploads import UploadError, publish
+
+# Журнал штрихов - компактная замена PNG для набросков из draw.html:
+#
+#   'DRWS' версия:u8 ширина:varint высота:varint фон:RGB штрихов:varint
+#   штрих: цвет:RGB толщина*4:varint точек:varint x0:zz y0:zz (dx:zz dy:zz)...
+#
+# varint - LEB128, zz - zigzag-varint. Точки идут разностями от предыдущей,
+# поэтому соседние точки линии занимают 1-2 байта вместо пикселей растра.
+# PNG строится из журнала при первом запросе и кэшируется рядом с ним.
+MAGIC = b'DRWS'
+VERSION = 1
+EXTENSION = '.strokes'
+# Content-Type загрузки журнала
+STROKES_MIMETYPE = 'application/x-drawfy-strokes'
+
+MAX_STROKES = 5000
+MAX_POINTS = 200000
+MAX_BRUSH = 200
+# Сглаживание: штрихи рисуются в увеличенном масштабе и уменьшаются.
+# Только пока увеличенный холст не больше MAX_PIXELS - большие холсты
+# рисуются 1:1, и растр никогда не занимает больше, чем холст 4096x4096
+SUPERSAMPLE = 2
+# Потолок пикселей растра, по которому считается перцептивный хэш:
+# холсты меньше рисуются 1:1, большие - уменьшенными (3 МБ вместо 48)
+HASH_RASTER_PIXELS = 1024 * 1024
+
+
+class InvalidStrokes(UploadError):
+    """Журнал штрихов поврежден или выходит за ограничения"""
+
+
+# ---------- кодирование ----------
+
+def _varint(value, out):
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return
+
+
+def _zigzag(value, out):
+    _varint((value << 1) ^ (value >> 63), out)
+
+
+def encode_strokes(log):
+    """Журнал {'width', 'height', 'background', 'strokes': [{'color', 'width', 'points'}]} в байты"""
+    out = bytearray(MAGIC)
+    out.append(VERSION)
+    _varint(log['width'], out)
+    _varint(log['height'], out)
+    out += bytes(log.get('background', (255, 255, 255)))
+    _varint(len(log['strokes']), out)
+    for stroke in log['strokes']:
+        out += bytes(stroke['color'])
+        _varint(round(stroke['width'] * 4), out)
+        _varint(len(stroke['points']), out)
+        last_x = last_y = 0
+        for x, y in stroke['points']:
+            _zigzag(x - last_x, out)
+            _zigzag(y - last_y, out)
+            last_x, last_y = x, y
+    return bytes(out)
+
+
+class _Reader:
+    def __init__(self, data):
+        self.data = memoryview(data)
+        self.pos = 0
+
+    def bytes(self, count):
+        if self.pos + count > len(self.data):
+            raise InvalidStrokes('Журнал штрихов обрезан')
+        chunk = self.data[self.pos:self.pos + count]
+        self.pos += count
+        return bytes(chunk)
+
+    def varint(self):
+        value = shift = 0
+        while True:
+            if self.pos >= len(self.data) or shift > 63:
+                raise InvalidStrokes('Журнал штрихов обрезан')
+            byte = self.data[self.pos]
+            self.pos += 1
+            value |= (byte & 0x7f) << shift
+            if not byte & 0x80:
+                return value
+            shift += 7
+
+    def zigzag(self):
+        value = self.varint()
+        return (value >> 1) ^ -(value & 1)
+
+
+def decode_strokes(data):
+    """Разобрать и проверить журнал. Возвращает тот же dict, что принимает encode_strokes"""
+    reader = _Reader(data)
+    if reader.bytes(len(MAGIC)) != MAGIC:
+        raise InvalidStrokes('Ожидается журнал штрихов')
+    if reader.bytes(1)[0] != VERSION:
+        raise InvalidStrokes('Неизвестная версия журнала штрихов')
+    width, height = reader.varint(), reader.varint()
+    if not (0 < width <= MAX_DIMENSION and 0 < height <= MAX_DIMENSION):
+        raise InvalidStrokes(f'Холст больше {MAX_DIMENSION}x{MAX_DIMENSION}')
+    background = tuple(reader.bytes(3))
+    count = reader.varint()
+    if count > MAX_STROKES:
+        raise InvalidStrokes(f'Больше {MAX_STROKES} штрихов')
+
+    strokes = []
+    total_points = 0
+    for _ in range(count):
+        color = tuple(reader.bytes(3))
+        brush = reader.varint() / 4
+        if not 0 < brush <= MAX_BRUSH:
+            raise InvalidStrokes('Недопустимая толщина кисти')
+        point_count = reader.varint()
+        total_points += point_count
+        if point_count == 0 or total_points > MAX_POINTS:
+            raise InvalidStrokes(f'Пустой штрих или больше {MAX_POINTS} точек')
+        points = []
+        x = y = 0
+        for _ in range(point_count):
+            x += reader.zigzag()
+            y += reader.zigzag()
+            if not (-MAX_BRUSH <= x <= width + MAX_BRUSH and -MAX_BRUSH <= y <= height + MAX_BRUSH):
+                raise InvalidStrokes('Точка за пределами холста')
+            points.append((x, y))
+        strokes.append({'color': color, 'width': brush, 'points': points})
+    if reader.pos != len(reader.data):
+        raise InvalidStrokes('Лишние данные после журнала штрихов')
+    return {'width': width, 'height': height, 'background': background, 'strokes': strokes}
+
+
+# ---------- растр ----------
+
+def rasterize(log, supersample=None):
+    """Нарисовать журнал: круглые концы и стыки, как lineCap/lineJoin = 'round' на холсте
+
+    supersample по умолчанию - SUPERSAMPLE, если увеличенный холст не больше MAX_PIXELS, иначе 1.
+    """
+    if supersample is None:
+        fits = log['width'] * log['height'] * SUPERSAMPLE ** 2 <= MAX_PIXELS
+        supersample = SUPERSAMPLE if fits else 1
+    image = _draw(log, supersample)
+    if supersample != 1:
+        image = image.resize((log['width'], log['height']), Image.LANCZOS)
+    return image
+
+
+def hash_raster(log):
+    """Растр журнала без сглаживания, не больше HASH_RASTER_PIXELS, для перцептивного хэша"""
+    return _draw(log, min(1, (HASH_RASTER_PIXELS / (log['width'] * log['height'])) ** 0.5))
+
+
+def _draw(log, scale):
+    size = (max(1, round(log['width'] * scale)), max(1, round(log['height'] * scale)))
+    image = Image.new('RGB', size, log['background'])
+    draw = ImageDraw.Draw(image)
+    for stroke in log['strokes']:
+        width = max(1, round(stroke['width'] * scale))
+        radius = width / 2
+        points = [(x * scale, y * scale) for x, y in stroke['points']]
+        if len(points) > 1:
+            draw.line(points, fill=stroke['color'], width=width)
+        for x, y in points:
+            draw.ellipse((x - radius, y - radius, x + radius, y + radius), fill=stroke['color'])
+    return image
+
+
+def strokes_filename(filename):
+    """Имя журнала для имени рисунка <хэш>.png"""
+    return f"{os.path.splitext(filename)[0]}{EXTENSION}"
+
+
+def source_path(upload_folder, filename):
+    """Путь к PNG рисунка или к его журналу штрихов, без растрирования; None - нет ни того, ни другого"""
+    return drawing_path(upload_folder, filename) or drawing_path(upload_folder, strokes_filename(filename))
+
+
+def raster_path(upload_folder, filename):
+    """Путь к PNG рисунка; для рисунка из штрихов PNG строится при первом обращении
+
+    None - если нет ни PNG, ни журнала.
+    """
+    path = drawing_path(upload_folder, filename)
+    if path is not None:
+        return path
+    log_path = drawing_path(upload_folder, strokes_filename(filename))
+    if log_path is None:
+        return None
+    with open(log_path, 'rb') as f:
+        image = rasterize(decode_strokes(f.read()))
+    # PNG - кэш журнала: параллельная сборка даст тот же файл, publish оставит один
+    _publish_bytes(upload_folder, filename, lambda f: image.save(f, format='PNG', optimize=True))
+    return drawing_path(upload_folder, filename)
+
+
+def _publish_bytes(folder, filename, write):
+    fd, temp_path = tempfile.mkstemp(dir=folder, prefix='.upload-', suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        publish(temp_path, folder, filename)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def save_strokes(data, folder):
+    """Проверить журнал и сохранить его под именем по содержимому
+
+    Журнал перекодируется в каноничный вид, имя рисунка - <sha256 журнала>.png;
+    сам PNG появится при первом запросе (raster_path). Возвращает то же, что
+    uploads.ingest: (имя рисунка, размер загрузки, размер журнала,
+    перцептивный хэш). Хэш считается по маленькому растру в памяти (hash_raster).
+    """
+    log = decode_strokes(data)
+    canonical = encode_strokes(log)
+    filename = f"{hashlib.sha256(canonical).hexdigest()}.png"
+    phash = image_dhash(hash_raster(log))
+    _publish_bytes(folder, strokes_filename(filename), lambda f: f.write(canonical))
+    return filename, len(data), len(canonical), phash
@@ -0,0 +1,161 @@
+import hashlib
+import io
+import os
+import re
+import tempfile
+
+from database.ingest import InvalidImage, check_header, check_image, optimize_image
+from database.layout import drawing_path, sharded_path
+from database.phash import dhash
+
+# Размер куска при потоковой записи загрузки
+CHUNK_SIZE = 64 * 1024
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+# Имя файла рисунка - sha256 его байтов: одинаковые рисунки хранятся одним
+# файлом, а содержимое под именем никогда не меняется
+CONTENT_NAME = re.compile(r'^[0-9a-f]{64}\.png$')
+
+
+class UploadError(ValueError):
+    """Загрузка отклонена (сообщение можно показать пользователю)"""
+
+
+class UploadTooLarge(UploadError):
+    """Тело загрузки больше допустимого"""
+
+
+def content_filename(digest):
+    """Имя файла по sha256 содержимого"""
+    return f"{digest}.png"
+
+
+def is_content_addressed(filename):
+    """Файл назван по содержимому (а не старым drawing_<user>_<время>.png)"""
+    return CONTENT_NAME.match(filename) is not None
+
+
+def file_digest(path, chunk_size=CHUNK_SIZE):
+    """sha256 файла и его размер"""
+    digest, size = hashlib.sha256(), 0
+    with open(path, 'rb') as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+            size += len(chunk)
+    return digest.hexdigest(), size
+
+
+def publish(temp_path, folder, filename):
+    """Поместить готовый временный файл под именем по содержимому
+
+    Если такой файл уже есть, новая копия не нужна: временный файл удаляется,
+    а у существующего обновляется время изменения - gc-blobs не тронет
+    недавно загруженный файл, даже если ссылка на него еще не записана.
+    Новые файлы ложатся в подпапки (database/layout.py).
+    """
+    existing = drawing_path(folder, filename)
+    if existing is not None:
+        os.remove(temp_path)
+        os.utime(existing)
+    else:
+        path = sharded_path(folder, filename)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(temp_path, path)
+
+
+def ingest(temp_path, folder, original_size):
+    """Проверить заголовок загрузки и опубликовать ее под именем по содержимому
+
+    В запросе проверяются только формат и размер холста; полная проверка,
+    перекодирование и хэш - в process_upload (фоновая задача). Возвращает
+    (имя файла, исходный размер, размер файла, None - хэш еще не посчитан).
+    """
+    try:
+        check_header(temp_path)
+    except InvalidImage as e:
+        raise UploadError(str(e)) from e
+    digest, stored_size = file_digest(temp_path)
+    filename = content_filename(digest)
+    publish(temp_path, folder, filename)
+    return filename, original_size, stored_size, None
+
+
+def process_upload(folder, filename, packs=None):
+    """Проверить и перекодировать опубликованную загрузку, посчитать перцептивный хэш
+
+    Выполняется в фоновой задаче (jobs_worker.py), без очереди - в запросе.
+    Перекодированный файл публикуется под своим именем по содержимому;
+    исходный остается, пока на него ссылается запись, потом его удалит
+    gc-blobs. Возвращает (имя файла, его размер, хэш).
+    """
+    path = drawing_path(folder, filename)
+    if path is not None:
+        with open(path, 'rb') as f:
+            original = f.read()
+    else:
+        original = packs.get(filename) if packs is not None else None
+        if original is None:
+            raise FileNotFoundError(filename)
+        original = bytes(original)
+    check_image(io.BytesIO(original))
+    optimized = optimize_image(original)
+    if optimized is None:
+        return filename, len(original), dhash(io.BytesIO(original))
+
+    fd, temp_path = tempfile.mkstemp(dir=folder, prefix='.upload-', suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(optimized)
+        optimized_name = content_filename(hashlib.sha256(optimized).hexdigest())
+        publish(temp_path, folder, optimized_name)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return optimized_name, len(optimized), dhash(io.BytesIO(optimized))
+
+
+def save_stream(stream, folder, max_size, chunk_size=CHUNK_SIZE):
+    """Записать поток в folder кусками. Возвращает то же, что ingest
+
+    Данные пишутся во временный файл в той же папке, размер проверяется
+    на лету, а у готового файла проверяется заголовок (ingest), и он атомарно
+    переименовывается - недописанный или отклоненный файл никогда не
+    появится под своим именем. При приеме в памяти лежит не больше одного куска.
+    """
+    fd, temp_path = tempfile.mkstemp(dir=folder, prefix='.upload-', suffix='.part')
+    try:
+        size = 0
+        with os.fdopen(fd, 'wb') as f:
+            while True:
+                chunk = stream.read(chunk_size)
+                if not chunk:
+                    break
+                # Сигнатура PNG может прийти в нескольких кусках
+                if size < len(PNG_SIGNATURE) and not PNG_SIGNATURE[size:].startswith(
+                        chunk[:len(PNG_SIGNATURE) - size]):
+                    raise UploadError('Ожидается изображение PNG')
+                size += len(chunk)
+                if max_size is not None and size > max_size:
+                    raise UploadTooLarge(f'Файл больше {max_size // (1024 * 1024)} МБ')
+                f.write(chunk)
+        if size == 0:
+            raise UploadError('Нет изображения')
+        return ingest(temp_path, folder, size)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def save_bytes(data, folder):
+    """Записать готовые байты (старый путь с base64). Возвращает то же, что save_stream"""
+    fd, temp_path = tempfile.mkstemp(dir=folder, prefix='.upload-', suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        return ingest(temp_path, folder, len(data))
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
@@ -0,0 +1,145 @@
+from database.schema import table_exists
+
+# Статистика профиля хранится готовой и обновляется триггерами на каждой
+# загрузке и каждом лайке, поэтому профиль читает одну строку по ключу.
+# drawings_count считает только готовые рисунки (processing_status = 'ready'):
+# загрузка попадает в профиль, когда ее обработка закончилась.
+# unique_likers - число разных пользователей, лайкнувших работы автора;
+# пары (автор, лайкнувший) лежат в author_likers.
+
+TRIGGERS = [
+    # Новый готовый рисунок или обработка загрузки закончилась
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_user_stats_drawing_insert AFTER INSERT ON drawings
+    WHEN NEW.processing_status = 'ready'
+    BEGIN
+        INSERT INTO user_stats (user_id, drawings_count, last_upload_at)
+        VALUES (NEW.user_id, 1, NEW.created_at)
+        ON CONFLICT (user_id) DO UPDATE SET
+            drawings_count = drawings_count + 1,
+            last_upload_at = MAX(COALESCE(last_upload_at, ''), excluded.last_upload_at);
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_user_stats_drawing_ready AFTER UPDATE OF processing_status ON drawings
+    WHEN NEW.processing_status = 'ready' AND OLD.processing_status != 'ready'
+    BEGIN
+        INSERT INTO user_stats (user_id, drawings_count, last_upload_at)
+        VALUES (NEW.user_id, 1, NEW.created_at)
+        ON CONFLICT (user_id) DO UPDATE SET
+            drawings_count = drawings_count + 1,
+            last_upload_at = MAX(COALESCE(last_upload_at, ''), excluded.last_upload_at);
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_user_stats_drawing_unready AFTER UPDATE OF processing_status ON drawings
+    WHEN OLD.processing_status = 'ready' AND NEW.processing_status != 'ready'
+    BEGIN
+        UPDATE user_stats SET drawings_count = drawings_count - 1 WHERE user_id = OLD.user_id;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_user_stats_drawing_delete AFTER DELETE ON drawings
+    WHEN OLD.processing_status = 'ready'
+    BEGIN
+        UPDATE user_stats SET drawings_count = drawings_count - 1 WHERE user_id = OLD.user_id;
+    END
+    ''',
+    # Новый лайк: лайки автора и пара (автор, лайкнувший)
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_user_stats_like_insert AFTER INSERT ON likes
+    BEGIN
+        INSERT INTO user_stats (user_id, total_likes)
+        SELECT user_id, 1 FROM drawings WHERE id = NEW.drawing_id
+        ON CONFLICT (user_id) DO UPDATE SET total_likes = total_likes + 1;
+        INSERT OR IGNORE INTO author_likers (author_id, liker_id)
+        SELECT user_id, NEW.user_id FROM drawings WHERE id = NEW.drawing_id;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_user_stats_like_delete AFTER DELETE ON likes
+    BEGIN
+        UPDATE user_stats SET total_likes = total_likes - 1
+        WHERE user_id = (SELECT user_id FROM drawings WHERE id = OLD.drawing_id);
+        DELETE FROM author_likers
+        WHERE author_id = (SELECT user_id FROM drawings WHERE id = OLD.drawing_id)
+          AND liker_id = OLD.user_id
+          AND NOT EXISTS (
+              SELECT 1 FROM likes l JOIN drawings d ON d.id = l.drawing_id
+              WHERE l.user_id = OLD.user_id AND d.user_id = author_likers.author_id
+          );
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_user_stats_liker_insert AFTER INSERT ON author_likers
+    BEGIN
+        UPDATE user_stats SET unique_likers = unique_likers + 1 WHERE user_id = NEW.author_id;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_user_stats_liker_delete AFTER DELETE ON author_likers
+    BEGIN
+        UPDATE user_stats SET unique_likers = unique_likers - 1 WHERE user_id = OLD.author_id;
+    END
+    ''',
+]
+
+
+def create_user_stats(cursor):
+    """Таблицы user_stats/author_likers и триггеры; для существующей базы - заполнить"""
+    created = not table_exists(cursor, 'user_stats')
+    # Триггеры рисунков старой версии считали и необработанные загрузки - пересоздаем и пересчитываем
+    cursor.execute("SELECT sql FROM sqlite_master WHERE type = 'trigger' AND name = 'trg_user_stats_drawing_insert'")
+    row = cursor.fetchone()
+    outdated = row is not None and 'processing_status' not in row[0]
+    if outdated:
+        cursor.execute('DROP TRIGGER trg_user_stats_drawing_insert')
+        cursor.execute('DROP TRIGGER IF EXISTS trg_user_stats_drawing_delete')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_stats (
+            user_id INTEGER PRIMARY KEY,
+            drawings_count INTEGER NOT NULL DEFAULT 0,
+            total_likes INTEGER NOT NULL DEFAULT 0,
+            unique_likers INTEGER NOT NULL DEFAULT 0,
+            last_upload_at TIMESTAMP
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS author_likers (
+            author_id INTEGER NOT NULL,
+            liker_id INTEGER NOT NULL,
+            PRIMARY KEY (author_id, liker_id)
+        ) WITHOUT ROWID
+    ''')
+    for statement in TRIGGERS:
+        cursor.execute(statement)
+
+    if created or outdated:
+        rebuild_user_stats(cursor)
+
+
+def rebuild_user_stats(cursor):
+    """Пересчитать user_stats и author_likers с нуля. Возвращает число строк статистики"""
+    cursor.execute('DELETE FROM author_likers')
+    cursor.execute('DELETE FROM user_stats')
+
+    # Пары (автор, лайкнувший) без срабатывания счетчика - unique_likers считаем ниже
+    cursor.execute('DROP TRIGGER IF EXISTS trg_user_stats_liker_insert')
+    cursor.execute('''
+        INSERT OR IGNORE INTO author_likers (author_id, liker_id)
+        SELECT d.user_id, l.user_id FROM likes l JOIN drawings d ON d.id = l.drawing_id
+    ''')
+    cursor.execute(next(t for t in TRIGGERS if 'trg_user_stats_liker_insert' in t))
+
+    cursor.execute('''
+        INSERT INTO user_stats (user_id, drawings_count, total_likes, unique_likers, last_upload_at)
+        SELECT
+            u.id,
+            (SELECT COUNT(*) FROM drawings d WHERE d.user_id = u.id AND d.processing_status = 'ready'),
+            (SELECT COUNT(*) FROM likes l JOIN drawings d ON d.id = l.drawing_id WHERE d.user_id = u.id),
+            (SELECT COUNT(*) FROM author_likers a WHERE a.author_id = u.id),
+            (SELECT MAX(created_at) FROM drawings d WHERE d.user_id = u.id AND d.processing_status = 'ready')
+        FROM users u
+    ''')
+    return cursor.rowcount
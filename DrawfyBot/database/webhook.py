@@ -0,0 +1,92 @@
+import json
+import threading
+from collections import OrderedDict
+
+from flask import Flask, jsonify, request
+
+# Сколько последних update_id помнить: Telegram повторяет доставку, если
+# не дождался ответа, и повтор приходит вскоре после оригинала
+DEDUP_SIZE = 10000
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+# Без секрета метрики отдаются только запросам с этого же сервера
+LOCAL_ADDRESSES = ('127.0.0.1', '::1')
+
+
+class UpdateDeduplicator:
+    """Последние принятые update_id; повтор того же обновления не обрабатывается"""
+
+    def __init__(self, size=DEDUP_SIZE):
+        self.size = size
+        self._seen = OrderedDict()
+        self._lock = threading.Lock()
+
+    def accept(self, update_id):
+        """True - обновление новое (и теперь запомнено), False - повтор"""
+        with self._lock:
+            if update_id in self._seen:
+                return False
+            self._seen[update_id] = None
+            while len(self._seen) > self.size:
+                self._seen.popitem(last=False)
+            return True
+
+    def forget(self, update_id):
+        """Обновление не принято в работу - повтор от Telegram нужно обработать"""
+        with self._lock:
+            self._seen.pop(update_id, None)
+
+
+class UpdateRecorder:
+    """Дописывает принятые обновления в JSONL - для повтора через bot_replay.py"""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def record(self, update):
+        line = json.dumps(update, ensure_ascii=False)
+        with self._lock, open(self.path, 'a', encoding='utf-8') as f:
+            f.write(line + '\n')
+
+
+def create_webhook_app(dispatcher, path='/telegram/webhook', secret=None, record_path=None):
+    """Легкое Flask-приложение, принимающее обновления Telegram
+
+    Обновления (dict) передаются диспетчеру (database/dispatch.py). Ответ
+    Telegram отдается сразу после постановки в очередь, до обработки;
+    заполненная очередь - 503, и Telegram доставит обновление позже.
+    Метрики требуют тот же секрет, что и обновления.
+    """
+    webhook = Flask(__name__)
+    dedup = UpdateDeduplicator()
+    recorder = UpdateRecorder(record_path) if record_path else None
+
+    @webhook.route(path, methods=['POST'])
+    def receive_update():
+        if secret and request.headers.get(SECRET_HEADER) != secret:
+            return jsonify({'error': 'Неверный секрет'}), 403
+        update = request.get_json(silent=True)
+        if not isinstance(update, dict) or not isinstance(update.get('update_id'), int):
+            return jsonify({'error': 'Ожидается обновление Telegram'}), 400
+
+        update_id = update['update_id']
+        if not dedup.accept(update_id):
+            return jsonify({'ok': True, 'duplicate': True})
+        if not dispatcher.submit(update):
+            dedup.forget(update_id)
+            return jsonify({'error': 'Очередь обновлений заполнена'}), 503
+        if recorder is not None:
+            recorder.record(update)
+        return jsonify({'ok': True})
+
+    @webhook.route('/telegram/metrics')
+    def metrics():
+        """Глубина очереди и задержки обработчиков"""
+        if secret:
+            if request.headers.get(SECRET_HEADER) != secret:
+                return jsonify({'error': 'Неверный секрет'}), 403
+        elif request.remote_addr not in LOCAL_ADDRESSES:
+            return jsonify({'error': 'Метрики доступны только локально'}), 403
+        return jsonify(dispatcher.metrics.snapshot())
+
+    return webhook
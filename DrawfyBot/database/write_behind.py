@@ -0,0 +1,79 @@
+import threading
+
+from database.background import PeriodicFlusher
+
+
+class LikeBatcher(PeriodicFlusher):
+    """Отложенная запись лайков: очередь в памяти и одна транзакция на интервал
+
+    Повторы отсекаются сразу: сначала по множеству уже принятых в этом
+    процессе пар (user_id, drawing_id), затем чтением уникального индекса
+    likes (чтение не ждет писателя). Flush пропускает уже записанные лайки,
+    поэтому гонки между воркерами не портят счетчики.
+    """
+
+    name = 'like-batcher'
+
+    def __init__(self, storage, interval=1.0, max_pending=5000, on_flush=None):
+        super().__init__(interval)
+        self.storage = storage
+        self.max_pending = max_pending
+        # Вызывается со списком записанных лайков после коммита
+        self.on_flush = on_flush
+        self._lock = threading.Lock()
+        self._pending = []
+        self._accepted = set()
+
+    def submit(self, user_id, drawing_id):
+        """Принять лайк в очередь. False - если пользователь уже лайкал рисунок"""
+        key = (user_id, drawing_id)
+        with self._lock:
+            if key in self._accepted:
+                return False
+
+        if self.storage.has_liked(user_id, drawing_id):
+            return False
+
+        with self._lock:
+            if key in self._accepted:
+                return False
+            self._accepted.add(key)
+            self._pending.append(key)
+            pending = len(self._pending)
+
+        self.start()
+        if pending >= self.max_pending:
+            self.wake()
+        return True
+
+    def after_fork(self):
+        self._lock = threading.Lock()
+        self._pending = []
+        self._accepted = set()
+
+    def pending(self):
+        """Сколько лайков ждут записи"""
+        with self._lock:
+            return len(self._pending)
+
+    def flush(self):
+        """Записать накопленные лайки одной транзакцией. Возвращает записанные"""
+        with self._lock:
+            batch, self._pending = self._pending, []
+        if not batch:
+            return []
+
+        try:
+            added = self.storage.add_likes(batch)
+        except Exception:
+            # Вернем пачку в начало очереди, следующий flush повторит попытку
+            with self._lock:
+                self._pending[:0] = batch
+            raise
+
+        # Теперь эти лайки видны в базе, фильтр в памяти больше не нужен
+        with self._lock:
+            self._accepted.difference_update(batch)
+        if self.on_flush is not None and added:
+            self.on_flush(added)
+        return added
@@ -0,0 +1,168 @@
+"""Фоновая обработка загрузок Drawfy
+
+Забирает задачи из очереди (database/jobs.py) и выполняет их в пуле процессов:
+
+    python jobs_worker.py                 - работать постоянно (процесс jobs в Procfile)
+    python jobs_worker.py --processes 4   - размер пула (по умолчанию JOBS_PROCESSES или число ядер)
+    python jobs_worker.py --once          - выполнить все готовые задачи и выйти
+"""
+import argparse
+import os
+import signal
+import threading
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+from database.ingest import InvalidImage
+from database.jobs import JobQueue
+from database.notifications import UPLOAD, NotificationQueue
+from database.packs import PackStore, absorb_upload
+from database.renditions import RENDITION_FORMATS, RENDITION_WIDTHS, ensure_rendition
+from database.storage import DRAWING_FAILED, DRAWING_PENDING, DRAWING_PROCESSING, DRAWING_READY, get_storage
+from database.uploads import process_upload
+
+UPLOAD_FOLDER = os.environ.get('UPLOAD_FOLDER', 'static/drawings')
+RENDITIONS_FOLDER = os.environ.get('RENDITIONS_FOLDER', 'static/renditions')
+JOBS_DATABASE = os.environ.get('JOBS_DATABASE', 'jobs.db')
+PACKS_FOLDER = os.environ.get('DRAWING_PACKS') or None
+NOTIFICATIONS = os.environ.get('NOTIFICATIONS', '1') == '1'
+NOTIFY_DATABASE = os.environ.get('NOTIFY_DATABASE', 'notifications.db')
+
+_packs = None
+
+
+def get_packs():
+    """Сегменты рисунков процесса пула (открываются при первой задаче)"""
+    global _packs
+    if _packs is None and PACKS_FOLDER:
+        _packs = PackStore(PACKS_FOLDER)
+    return _packs
+
+
+def process_drawing(payload):
+    """Проверить и перекодировать загрузку, посчитать хэш и заранее построить превью
+
+    Возвращает (имя файла, размер, хэш); в базу их записывает complete_drawing.
+    """
+    packs = get_packs()
+    filename, size, phash = process_upload(UPLOAD_FOLDER, payload['filename'], packs)
+    if packs is not None and filename != payload['filename']:
+        absorb_upload(packs, UPLOAD_FOLDER, filename)
+    for width in RENDITION_WIDTHS:
+        for fmt in RENDITION_FORMATS:
+            ensure_rendition(UPLOAD_FOLDER, RENDITIONS_FOLDER, filename, width, fmt, packs)
+    return filename, size, phash
+
+
+def complete_drawing(storage, notifications, payload, result):
+    """Записать итог обработки и начислить награду за загрузку (в основном процессе)
+
+    Рейтинг в памяти веб-воркеров подтянет опыт при следующей перезагрузке.
+    """
+    reward = payload.get('reward')
+    if storage.complete_upload(payload['drawing_id'], *result, reward=reward) is None and reward:
+        if notifications is not None and payload.get('telegram_id'):
+            notifications.add_events([(payload['telegram_id'], UPLOAD, payload['drawing_id'],
+                                       payload.get('title'), 1, result[0])])
+
+
+# Ошибки, после которых задача не повторяется: испорченный файл не починится
+PERMANENT_ERRORS = (InvalidImage,)
+
+# Вид задачи -> функция, выполняемая в процессе пула
+JOB_HANDLERS = {
+    'process_drawing': process_drawing,
+}
+
+# Вид задачи -> запись результата в основном процессе (у него есть хранилище)
+JOB_RESULTS = {
+    'process_drawing': complete_drawing,
+}
+
+
+def _set_drawing_status(storage, job, status, error=None):
+    """Показать состояние задачи в записи рисунка"""
+    drawing_id = job['payload'].get('drawing_id')
+    if drawing_id is not None:
+        storage.set_drawing_status(drawing_id, status, error)
+
+
+def run(processes, poll_interval=1.0, once=False):
+    """Цикл исполнителя: держит в работе не больше processes задач"""
+    queue = JobQueue(JOBS_DATABASE)
+    storage = get_storage()
+    notifications = NotificationQueue(NOTIFY_DATABASE) if NOTIFICATIONS else None
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *args: stop.set())
+
+    executor = ProcessPoolExecutor(max_workers=processes)
+    running = {}
+    print(f"⚙️ Обработчик задач запущен: {processes} процессов")
+    try:
+        while True:
+            # Новые задачи берем, только пока есть свободные процессы
+            while not stop.is_set() and len(running) < processes:
+                job = queue.claim()
+                if job is None:
+                    break
+                handler = JOB_HANDLERS.get(job['kind'])
+                if handler is None:
+                    queue.fail(job, f"Неизвестный вид задачи: {job['kind']}", permanent=True)
+                    continue
+                _set_drawing_status(storage, job, DRAWING_PROCESSING)
+                running[executor.submit(handler, job['payload'])] = job
+
+            if not running:
+                if stop.is_set() or once:
+                    break
+                stop.wait(poll_interval)
+                continue
+
+            done, _ = wait(running, timeout=poll_interval, return_when=FIRST_COMPLETED)
+            broken = False
+            for future in done:
+                job = running.pop(future)
+                try:
+                    result = future.result()
+                    if job['kind'] in JOB_RESULTS:
+                        JOB_RESULTS[job['kind']](storage, notifications, job['payload'], result)
+                except BrokenProcessPool as e:
+                    broken = True
+                    _finish_failed(queue, storage, job, e)
+                except Exception as e:
+                    _finish_failed(queue, storage, job, e)
+                else:
+                    queue.complete(job['id'])
+                    _set_drawing_status(storage, job, DRAWING_READY)
+
+            # Процесс пула упал (например, на испорченном файле) - пул нужно пересоздать
+            if broken:
+                for future, job in running.items():
+                    _finish_failed(queue, storage, job, BrokenProcessPool('Пул процессов перезапущен'))
+                running.clear()
+                executor.shutdown(wait=False, cancel_futures=True)
+                executor = ProcessPoolExecutor(max_workers=processes)
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+    print(f"✅ Обработчик задач остановлен: {queue.counts()}")
+
+
+def _finish_failed(queue, storage, job, error):
+    message = f"{type(error).__name__}: {error}"
+    retry = queue.fail(job, message, permanent=isinstance(error, PERMANENT_ERRORS))
+    _set_drawing_status(storage, job, DRAWING_PENDING if retry else DRAWING_FAILED, message)
+    print(f"❌ Задача {job['id']} ({job['kind']}), попытка {job['attempts']}: {message}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Фоновая обработка загрузок Drawfy')
+    parser.add_argument('--processes', type=int,
+                        default=int(os.environ.get('JOBS_PROCESSES', os.cpu_count() or 1)))
+    parser.add_argument('--poll', type=float, default=1.0, help='Пауза опроса пустой очереди, с')
+    parser.add_argument('--once', action='store_true', help='Выполнить готовые задачи и выйти')
+    args = parser.parse_args()
+    run(args.processes, args.poll, args.once)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,258 @@
+"""Служебные команды Drawfy
+
+    python manage.py reconcile-counters    - исправить расхождения в счетчиках лайков и комментариев
+    python manage.py rebuild-user-stats    - пересчитать статистику профилей (user_stats)
+    python manage.py warm-renditions       - заранее создать превью всех рисунков
+    python manage.py rehash-drawings       - переименовать старые файлы рисунков по содержимому
+    python manage.py gc-blobs              - удалить файлы, на которые не ссылается ни один рисунок
+    python manage.py gc-sprites            - удалить старые листы превью ленты (--max-age, с)
+    python manage.py shard-drawings        - разложить файлы рисунков из общей папки по подпапкам
+    python manage.py pack-drawings         - перенести файлы рисунков в сегменты (--packs, DRAWING_PACKS)
+    python manage.py unpack-drawings       - вернуть рисунки из сегментов в файлы
+    python manage.py compact-packs         - переписать сегменты, где много удаленных рисунков
+    python manage.py storage-report        - сколько места сэкономили перекодирование и дедупликация
+    python manage.py index-phashes         - посчитать перцептивные хэши старых рисунков
+    python manage.py file-ids              - доля повторных отправок по file_id (--prune - забыть удаленные файлы)
+
+reconcile-counters и rebuild-user-stats работают только с файлом SQLite.
+rehash-drawings и gc-blobs работают через хранилище приложения: --db
+принимает и путь к SQLite, и адрес postgresql://. После них из кэша
+file_id бота (--file-ids) удаляются записи переименованных и удаленных файлов.
+"""
+import argparse
+import os
+
+from database.blobs import GC_GRACE, collect_garbage, rehash_drawings
+from database.connection import get_pool
+from database.counters import RECONCILE_BATCH, reconcile_batches, reconcile_range
+from database.file_ids import FileIdCache
+from database.layout import SHARD_BATCH, drawing_path, shard_drawings
+from database.packs import COMPACT_RATIO, PackStore, pack_drawings, unpack_drawings
+from database.phash import index_phashes
+from database.renditions import RENDITION_FORMATS, RENDITION_WIDTHS, warm_renditions
+from database.sprites import SHEET_MAX_AGE, collect_sprites
+from database.strokes import strokes_filename
+from database.storage import DEFAULT_DATABASE_URL, get_storage
+from database.user_stats import rebuild_user_stats
+
+
+def sqlite_pool(args):
+    """Пул соединений к файлу SQLite из --db; адрес PostgreSQL - ошибка, а не файл с таким именем"""
+    if args.db.startswith(('postgres://', 'postgresql://')):
+        raise SystemExit(f"❌ {args.command} работает только с файлом SQLite, для PostgreSQL "
+                         f"пересчет не реализован. Укажите путь к базе SQLite в --db")
+    return get_pool(args.db)
+
+
+def reconcile_counters_command(args):
+    """Пересчитать денормализованные счетчики пачками, каждая пачка в своей транзакции"""
+    pool = sqlite_pool(args)
+    with pool.connection() as conn:
+        batches = reconcile_batches(conn.cursor(), args.batch)
+
+    fixed = {}
+    for first_id, last_id in batches:
+        with pool.connection(immediate=True) as conn:
+            for column, count in reconcile_range(conn.cursor(), first_id, last_id).items():
+                fixed[column] = fixed.get(column, 0) + count
+
+    print(f"✅ Проверено пачек: {len(batches)}")
+    for column, count in sorted(fixed.items()):
+        print(f"  {column}: исправлено {count}")
+
+
+def rebuild_user_stats_command(args):
+    """Пересчитать user_stats с нуля одной транзакцией"""
+    pool = sqlite_pool(args)
+    with pool.connection(immediate=True) as conn:
+        rows = rebuild_user_stats(conn.cursor())
+    print(f"✅ Статистика пересчитана: {rows} пользователей")
+
+
+def warm_renditions_command(args):
+    """Создать недостающие превью для уже загруженных рисунков"""
+    drawings, errors = warm_renditions(args.uploads, args.renditions, args.widths, args.formats, open_packs(args))
+    print(f"✅ Превью готовы: {drawings} рисунков, ошибок: {errors}")
+
+
+def open_packs(args):
+    """Сегменты рисунков, если они уже есть"""
+    return PackStore(args.packs) if os.path.isdir(args.packs) else None
+
+
+def rehash_drawings_command(args):
+    """Перевести старые имена файлов (drawing_<user>_<время>.png) на sha256 содержимого"""
+    storage = get_storage(args.db)
+    storage.init_schema()
+    files, drawings = rehash_drawings(storage, args.uploads, args.renditions)
+    print(f"✅ Переименовано файлов: {files}, обновлено рисунков: {drawings}")
+    prune_file_ids(args)
+
+
+def gc_blobs_command(args):
+    """Удалить файлы без ссылок (и их превью)"""
+    deleted = collect_garbage(get_storage(args.db), args.uploads, args.renditions, args.grace, open_packs(args))
+    print(f"✅ Удалено файлов: {deleted}")
+    prune_file_ids(args)
+
+
+def gc_sprites_command(args):
+    """Удалить листы превью, которые давно не строились"""
+    if not os.path.isdir(args.sprites):
+        print("✅ Листов превью нет")
+        return
+    removed, freed = collect_sprites(args.sprites, args.max_age)
+    print(f"✅ Удалено файлов листов: {removed}, освобождено {freed / (1024 * 1024):.1f} МБ")
+
+
+def prune_file_ids(args):
+    """Забыть file_id файлов, которых больше нет ни в папке, ни в сегментах. Возвращает число записей"""
+    if not os.path.exists(args.file_ids):
+        return 0
+    packs = open_packs(args)
+
+    def exists(filename):
+        # Рисунок из штрихов может быть еще не растрирован
+        if any(drawing_path(args.uploads, name) for name in (filename, strokes_filename(filename))):
+            return True
+        return packs is not None and packs.stored_at(filename) is not None
+
+    removed = FileIdCache(args.file_ids).prune(exists)
+    if removed:
+        print(f"🧹 Кэш file_id: забыто записей {removed}")
+    return removed
+
+
+def file_ids_command(args):
+    """Сколько отправок рисунков обошлось без загрузки файла"""
+    if args.prune:
+        prune_file_ids(args)
+    stats = FileIdCache(args.file_ids).stats()
+    hit_rate = f"{100 * stats['hit_rate']:.1f}%" if stats['hit_rate'] is not None else '—'
+    print(f"📊 Кэш file_id: {stats['entries']} файлов, попаданий {hit_rate}")
+    print(f"  по file_id: {stats['hits']}, без него: {stats['misses']} "
+          f"(устарело: {stats['stale']}), загружено в Telegram: {stats['uploads']}")
+
+
+def shard_drawings_command(args):
+    """Перенести файлы из общей папки в раскладку ab/cd/<имя> пачками"""
+    moved = shard_drawings(args.uploads, args.batch, args.pause)
+    print(f"✅ Перенесено файлов: {moved}")
+
+
+def pack_drawings_command(args):
+    """Перенести файлы рисунков в сегменты"""
+    store = PackStore(args.packs)
+    packed = pack_drawings(store, args.uploads)
+    print(f"✅ В сегментах: {packed} рисунков, {store.stats()}")
+
+
+def unpack_drawings_command(args):
+    """Вернуть рисунки из сегментов в отдельные файлы"""
+    store = open_packs(args)
+    unpacked = unpack_drawings(store, args.uploads) if store else 0
+    print(f"✅ Возвращено в файлы: {unpacked} рисунков")
+
+
+def compact_packs_command(args):
+    """Освободить место удаленных рисунков в сегментах"""
+    store = open_packs(args)
+    segments, freed = store.compact(args.ratio) if store else (0, 0)
+    print(f"✅ Сжато сегментов: {segments}, освобождено {freed / (1024 * 1024):.1f} МБ")
+
+
+def storage_report_command(args):
+    """Отчет об экономии места на рисунках"""
+    report = get_storage(args.db).size_report()
+    mb = 1024 * 1024
+    original, stored = report['original_bytes'], report['stored_bytes']
+    print(f"📊 Рисунков с известным размером: {report['drawings']}")
+    if original:
+        print(f"  загружено {original / mb:.1f} МБ, после перекодирования {stored / mb:.1f} МБ "
+              f"(-{(original - stored) / mb:.1f} МБ, {100 * (original - stored) / original:.0f}%)")
+    print(f"  на диске: {report['blobs']} файлов, {report['blob_bytes'] / mb:.1f} МБ "
+          f"(дедупликация -{max(stored - report['blob_bytes'], 0) / mb:.1f} МБ)")
+
+
+def index_phashes_command(args):
+    """Заполнить индекс похожих рисунков для уже загруженных работ"""
+    indexed, missing = index_phashes(get_storage(args.db), args.uploads, open_packs(args), args.batch)
+    print(f"✅ Хэши посчитаны: {indexed}, файл не найден: {missing}")
+
+
+COMMANDS = {
+    'reconcile-counters': reconcile_counters_command,
+    'rebuild-user-stats': rebuild_user_stats_command,
+    'warm-renditions': warm_renditions_command,
+    'rehash-drawings': rehash_drawings_command,
+    'gc-blobs': gc_blobs_command,
+    'gc-sprites': gc_sprites_command,
+    'shard-drawings': shard_drawings_command,
+    'pack-drawings': pack_drawings_command,
+    'unpack-drawings': unpack_drawings_command,
+    'compact-packs': compact_packs_command,
+    'storage-report': storage_report_command,
+    'index-phashes': index_phashes_command,
+    'file-ids': file_ids_command,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Служебные команды Drawfy')
+    parser.add_argument('--db', default=os.environ.get('DATABASE_URL', DEFAULT_DATABASE_URL),
+                        help='Путь к базе данных или DATABASE_URL')
+    parser.add_argument('--packs', default=os.environ.get('DRAWING_PACKS') or 'packs', help='Папка сегментов рисунков')
+    parser.add_argument('--file-ids', default=os.environ.get('FILE_IDS_DATABASE', 'file_ids.db'),
+                        help='База file_id бота')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    reconcile = subparsers.add_parser('reconcile-counters', help='Исправить счетчики лайков и комментариев')
+    reconcile.add_argument('--batch', type=int, default=RECONCILE_BATCH, help='Рисунков за транзакцию')
+
+    subparsers.add_parser('rebuild-user-stats', help='Пересчитать статистику профилей')
+
+    warm = subparsers.add_parser('warm-renditions', help='Создать превью всех рисунков')
+    warm.add_argument('--uploads', default='static/drawings', help='Папка с рисунками')
+    warm.add_argument('--renditions', default='static/renditions', help='Папка превью')
+    warm.add_argument('--widths', type=int, nargs='+', default=RENDITION_WIDTHS, choices=RENDITION_WIDTHS)
+    warm.add_argument('--formats', nargs='+', default=RENDITION_FORMATS, choices=RENDITION_FORMATS)
+
+    rehash = subparsers.add_parser('rehash-drawings', help='Переименовать файлы рисунков по содержимому')
+    gc = subparsers.add_parser('gc-blobs', help='Удалить файлы без ссылок')
+    gc.add_argument('--grace', type=int, default=GC_GRACE, help='Не трогать файлы моложе, с')
+    for command in (rehash, gc):
+        command.add_argument('--uploads', default='static/drawings', help='Папка с рисунками')
+        command.add_argument('--renditions', default='static/renditions', help='Папка превью')
+
+    sprites = subparsers.add_parser('gc-sprites', help='Удалить старые листы превью')
+    sprites.add_argument('--sprites', default='static/sprites', help='Папка листов превью')
+    sprites.add_argument('--max-age', type=int, default=SHEET_MAX_AGE, help='Удалять листы старше, с')
+
+    shard = subparsers.add_parser('shard-drawings', help='Разложить файлы рисунков по подпапкам')
+    shard.add_argument('--uploads', default='static/drawings', help='Папка с рисунками')
+    shard.add_argument('--batch', type=int, default=SHARD_BATCH, help='Файлов за пачку')
+    shard.add_argument('--pause', type=float, default=0.0, help='Пауза между пачками, с')
+
+    pack = subparsers.add_parser('pack-drawings', help='Перенести файлы рисунков в сегменты')
+    unpack = subparsers.add_parser('unpack-drawings', help='Вернуть рисунки из сегментов в файлы')
+    for command in (pack, unpack):
+        command.add_argument('--uploads', default='static/drawings', help='Папка с рисунками')
+    compact = subparsers.add_parser('compact-packs', help='Сжать сегменты рисунков')
+    compact.add_argument('--ratio', type=float, default=COMPACT_RATIO, help='Доля удаленного, с которой сегмент сжимается')
+
+    subparsers.add_parser('storage-report', help='Экономия места на рисунках')
+
+    phashes = subparsers.add_parser('index-phashes', help='Перцептивные хэши старых рисунков')
+    phashes.add_argument('--uploads', default='static/drawings', help='Папка с рисунками')
+    phashes.add_argument('--batch', type=int, default=500, help='Рисунков за запрос')
+
+    file_ids = subparsers.add_parser('file-ids', help='Доля отправок рисунков по file_id')
+    file_ids.add_argument('--uploads', default='static/drawings', help='Папка с рисунками')
+    file_ids.add_argument('--prune', action='store_true', help='Забыть file_id удаленных файлов')
+
+    args = parser.parse_args()
+    COMMANDS[args.command](args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+import importlib
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+
+@pytest.fixture
+def make_app(tmp_path, monkeypatch):
+    """Свежий модуль app.py в пустой папке; env - дополнительные переменные окружения"""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv('DATABASE_URL', str(tmp_path / 'drawfy.db'))
+    monkeypatch.setenv('JOBS_DATABASE', str(tmp_path / 'jobs.db'))
+    monkeypatch.setenv('IMAGE_JOBS', '0')
+    monkeypatch.setenv('NOTIFICATIONS', '0')
+
+    def make(**env):
+        for name, value in env.items():
+            monkeypatch.setenv(name, value)
+        sys.modules.pop('app', None)
+        return importlib.import_module('app')
+
+    yield make
+    sys.modules.pop('app', None)
+
+
+@pytest.fixture(scope='session')
+def postgres_url(tmp_path_factory):
+    """Адрес локального PostgreSQL: TEST_DATABASE_URL или сервер pgserver во временной папке"""
+    url = os.environ.get('TEST_DATABASE_URL')
+    if url:
+        return url
+    pgserver = pytest.importorskip('pgserver', reason='нужен TEST_DATABASE_URL или пакет pgserver')
+    server = pgserver.get_server(str(tmp_path_factory.mktemp('pgdata')))
+    yield server.get_uri()
+    server.cleanup()
+
+
+@pytest.fixture(params=['sqlite', 'postgres'])
+def storage(request, tmp_path):
+    """Пустое хранилище каждого бэкенда с начальными данными init_schema"""
+    if request.param == 'sqlite':
+        from database.sqlite_storage import SQLiteStorage
+        storage = SQLiteStorage(str(tmp_path / 'drawfy.db'))
+        storage.init_schema()
+        yield storage
+        return
+
+    pytest.importorskip('psycopg2')
+    url = request.getfixturevalue('postgres_url')
+    import psycopg2
+    from database.postgres_storage import PostgresStorage
+    with psycopg2.connect(url) as conn, conn.cursor() as cursor:
+        cursor.execute('DROP SCHEMA public CASCADE; CREATE SCHEMA public')
+    storage = PostgresStorage(url, pool_size=4)
+    storage.init_schema()
+    yield storage
+    storage._get_pool().closeall()
@@ -0,0 +1,40 @@
+import threading
+
+from database.leaderboard import BOARDS, Leaderboard
+
+
+class SnapshotStorage:
+    """Хранилище, которое считает перечитывания рейтинга"""
+
+    def __init__(self):
+        self.loads = 0
+        self.reloaded = threading.Event()
+        self.scores = {name: [(1, 10), (2, 5)] for name in BOARDS}
+
+    def leaderboard_snapshot(self, since):
+        self.loads += 1
+        if self.loads > 1:
+            self.reloaded.set()
+        return self.scores
+
+
+def test_refresh_runs_in_background():
+    storage = SnapshotStorage()
+    leaderboard = Leaderboard(storage, refresh_interval=0.05)
+    assert [entry['user_id'] for entry in leaderboard.top('experience')] == [1, 2]
+    assert storage.loads == 1
+
+    # Изменение из другого воркера приходит фоновой перезагрузкой, а не запросом
+    storage.scores = {name: [(1, 10), (2, 50)] for name in BOARDS}
+    assert storage.reloaded.wait(5)
+    assert leaderboard.rank('experience', 2) == {'rank': 1, 'score': 50}
+
+
+def test_requests_do_not_reload():
+    storage = SnapshotStorage()
+    leaderboard = Leaderboard(storage, refresh_interval=3600)
+    for _ in range(10):
+        leaderboard.top('likes')
+    leaderboard.add_experience(2, 100)
+    assert storage.loads == 1
+    assert leaderboard.rank('experience', 2) == {'rank': 1, 'score': 105}
@@ -0,0 +1,53 @@
+import io
+import random
+import threading
+import urllib.request
+
+from PIL import Image
+from werkzeug.serving import make_server
+
+from database.packs import CHUNK_SIZE
+
+
+def noise_png(size=256):
+    """PNG, который почти не сжимается: больше одного куска CHUNK_SIZE"""
+    rng = random.Random(1)
+    image = Image.frombytes('RGB', (size, size), bytes(rng.getrandbits(8) for _ in range(size * size * 3)))
+    buffer = io.BytesIO()
+    image.save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def upload_packed(make_app, tmp_path):
+    app_module = make_app(DRAWING_PACKS=str(tmp_path / 'packs'))
+    client = app_module.app.test_client()
+    response = client.post('/api/drawings/upload?token=user_5&title=noise', data=noise_png(),
+                           content_type='image/png')
+    assert response.status_code == 200, response.json
+    url = response.json['image_url']
+    filename = url.rsplit('/', 1)[1]
+    content = bytes(app_module.pack_store.get(filename))
+    assert len(content) > CHUNK_SIZE
+    return app_module, url, filename, content
+
+
+def test_pack_response_yields_bytes(make_app, tmp_path):
+    app_module, _, filename, content = upload_packed(make_app, tmp_path)
+    with app_module.app.test_request_context():
+        response = app_module.pack_response(app_module.pack_store.get(filename), filename)
+        chunks = list(response.response)
+    assert all(type(chunk) is bytes for chunk in chunks)
+    assert b''.join(chunks) == content
+
+
+def test_packed_drawing_through_real_server(make_app, tmp_path):
+    app_module, url, _, content = upload_packed(make_app, tmp_path)
+    server = make_server('127.0.0.1', 0, app_module.app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        with urllib.request.urlopen(f'http://127.0.0.1:{server.server_port}{url}', timeout=10) as response:
+            assert response.headers['Content-Type'] == 'image/png'
+            assert response.read() == content
+    finally:
+        server.shutdown()
@@ -0,0 +1,118 @@
+import random
+import threading
+
+from database.pagination import decode_cursor
+from database.phash import SIMILAR_DISTANCE
+from database.storage import ALREADY_OWNED, DRAWING_PENDING, NOT_ENOUGH_COINS, PURCHASED, TEST_USER_BALANCE
+
+
+def test_feed_pages_cover_ready_drawings_once(storage):
+    ready = [storage.add_drawing(1, f'r{i}', '', f'r{i}.png') for i in range(5)]
+    storage.add_drawing(1, 'pending', '', 'p.png', status=DRAWING_PENDING)
+
+    seen, cursor = [], None
+    while True:
+        rows, cursor = storage.feed_page(2, cursor)
+        seen += [row['id'] for row in rows]
+        if cursor is None:
+            break
+        cursor = decode_cursor(cursor)
+    assert seen == sorted(ready, reverse=True)
+
+
+def test_likes_are_counted_once(storage):
+    drawing_id = storage.add_drawing(1, 'a', '', 'a.png')
+    added = storage.add_likes([(2, drawing_id), (2, drawing_id), (3, drawing_id)])
+    assert sorted(added) == [(2, drawing_id, 1), (3, drawing_id, 1)]
+    assert storage.add_likes([(2, drawing_id)]) == []
+    assert storage.has_liked(2, drawing_id) and not storage.has_liked(1, drawing_id)
+
+    rows, _ = storage.feed_page(10)
+    assert rows[0]['like_count'] == 2
+    profile = storage.get_profile(1)
+    assert (profile['total_likes'], profile['unique_likers']) == (2, 2)
+
+
+def test_buy_item(storage):
+    item = storage.shop_items()[0]
+    assert storage.buy_item(1, item['id'], item['price']) == (PURCHASED, TEST_USER_BALANCE - item['price'])
+    assert storage.buy_item(1, item['id'], item['price']) == (ALREADY_OWNED, None)
+    assert storage.buy_item(2, item['id'], TEST_USER_BALANCE + 1) == (NOT_ENOUGH_COINS, None)
+    assert storage.get_profile(2)['balance'] == TEST_USER_BALANCE
+
+
+def test_concurrent_buys_charge_once(storage):
+    item = storage.shop_items()[0]
+    start = threading.Barrier(8)
+    results = []
+
+    def buy():
+        start.wait()
+        results.append(storage.buy_item(3, item['id'], item['price'])[0])
+
+    threads = [threading.Thread(target=buy) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(results) == sorted([PURCHASED] + [ALREADY_OWNED] * 7)
+    assert storage.get_profile(3)['balance'] == TEST_USER_BALANCE - item['price']
+
+
+def test_writes_bump_generations(storage):
+    feed, users = storage.read_generations(['feed', 'users'])
+    drawing_id = storage.add_drawing(1, 'a', '', 'a.png')
+    assert list(storage.read_generations(['feed', 'users'])) == [feed + 1, users]
+
+    item = storage.shop_items()[0]
+    storage.buy_item(1, item['id'], item['price'])
+    assert storage.read_generations(['users'])[0] == users + 1
+
+    storage.add_likes([(2, drawing_id)])
+    feed, views = storage.read_generations(['feed', 'views'])
+    assert feed > 1
+
+    # Просмотры сбрасывают только ленту, но не остальные ответы
+    storage.add_views({drawing_id: 3})
+    assert list(storage.read_generations(['feed', 'views'])) == [feed, views + 1]
+
+
+def test_concurrent_view_and_like_batches(storage):
+    ids = [storage.add_drawing(1, f'd{i}', '', f'd{i}.png') for i in range(20)]
+    users = [storage.get_or_create_user(1000 + n)['id'] for n in range(4)]
+    start = threading.Barrier(len(users))
+    errors = []
+
+    def flush(user_id):
+        order = ids[:]
+        random.shuffle(order)
+        start.wait()
+        try:
+            for _ in range(5):
+                storage.add_views({drawing_id: 1 for drawing_id in order})
+            storage.add_likes([(user_id, drawing_id) for drawing_id in order])
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=flush, args=(user_id,)) for user_id in users]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    rows, _ = storage.feed_page(len(ids))
+    assert {(row['views'], row['like_count']) for row in rows} == {(5 * len(users), len(users))}
+
+
+def test_similar_finds_everything_within_threshold(storage):
+    base = 0x123456789ABCDEF0
+    # Расстояние 3, три куска из четырех отличаются
+    near = base ^ (1 | 1 << 16 | 1 << 32)
+    # Расстояние 4, отличаются все куски - индекс не найдет, и порог его не пропускает
+    far = base ^ (1 | 1 << 16 | 1 << 32 | 1 << 48)
+    source = storage.add_drawing(1, 'base', '', 'base.png', phash=base)
+    near_id = storage.add_drawing(2, 'near', '', 'near.png', phash=near)
+    storage.add_drawing(2, 'far', '', 'far.png', phash=far)
+
+    rows = storage.similar_drawings(base, SIMILAR_DISTANCE, 10, exclude_id=source)
+    assert [(row['id'], row['distance']) for row in rows] == [(near_id, 3)]
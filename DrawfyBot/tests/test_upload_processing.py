@@ -0,0 +1,58 @@
+import importlib
+import io
+import sqlite3
+import sys
+
+from PIL import Image
+
+
+def png_bytes(color=(200, 30, 30), size=64):
+    image = Image.new('RGB', (size, size), color)
+    for x in range(size // 2):
+        image.putpixel((x, x), (0, 0, 0))
+    buffer = io.BytesIO()
+    image.save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def upload(client, data, token='user_5'):
+    return client.post(f'/api/drawings/upload?token={token}&title=t', data=data, content_type='image/png')
+
+
+def run_jobs(monkeypatch):
+    sys.modules.pop('jobs_worker', None)
+    jobs_worker = importlib.import_module('jobs_worker')
+    monkeypatch.setattr(jobs_worker, 'NOTIFICATIONS', False)
+    jobs_worker.run(1, poll_interval=0.05, once=True)
+
+
+def test_pending_upload_hidden_until_ready(make_app, monkeypatch):
+    app_module = make_app(IMAGE_JOBS='1')
+    client = app_module.app.test_client()
+    drawing_id = upload(client, png_bytes()).json['drawing_id']
+    user_id = app_module.get_or_create_user(5)['id']
+
+    assert drawing_id not in [d['id'] for d in client.get('/api/drawings').json['drawings']]
+    assert app_module.storage.get_profile(user_id)['drawings_count'] == 0
+    assert app_module.storage.user_drawings(user_id) == []
+
+    run_jobs(monkeypatch)
+    assert drawing_id in [d['id'] for d in client.get('/api/drawings').json['drawings']]
+    assert app_module.storage.get_profile(user_id)['drawings_count'] == 1
+
+
+def test_broken_upload_fails_without_retries(make_app, monkeypatch, tmp_path):
+    app_module = make_app(IMAGE_JOBS='1')
+    client = app_module.app.test_client()
+    data = png_bytes()
+    response = upload(client, data[:len(data) // 2])
+    assert response.status_code == 200
+    drawing_id = response.json['drawing_id']
+
+    run_jobs(monkeypatch)
+    with sqlite3.connect(tmp_path / 'jobs.db') as conn:
+        assert conn.execute('SELECT status, attempts FROM jobs').fetchall() == [('failed', 1)]
+    with sqlite3.connect(tmp_path / 'drawfy.db') as conn:
+        status, = conn.execute('SELECT processing_status FROM drawings WHERE id = ?', (drawing_id,)).fetchone()
+    assert status == 'failed'
+    assert drawing_id not in [d['id'] for d in client.get('/api/drawings').json['drawings']]